@@ -25,6 +25,27 @@ import os, re
 #LOG_FILE = '/var/log/httpd/%s.log' % os.path.basename(os.path.normpath(os.path.join(os.path.dirname(__file__),'..')))
 LOG_FILE = '/n/openauth/log/web.log'
 
+#LOG_BUFFERED -- boolean for whether or not to write the log from a background thread
+#When True, log() only queues lines, and a thread in each process writes them 
+#through a single open handle on LOG_FILE, in batches of up to LOG_FLUSH_LINES 
+#lines or every LOG_FLUSH_SECONDS seconds, whichever comes first.  If more than 
+#LOG_QUEUE_SIZE messages are waiting, log() writes them and its own directly 
+#instead.  Lines still queued when a process is killed (as opposed to exiting 
+#normally, e.g. an apache child killed for running too long) are lost, and 
+#this log is the record of who was issued secrets, so it's off by default; 
+#turn it on where losing the last second of lines is acceptable.  When False, 
+#every log() call opens, appends to, and closes LOG_FILE.
+LOG_BUFFERED = False
+LOG_FLUSH_LINES = 100
+LOG_FLUSH_SECONDS = 1.0
+LOG_QUEUE_SIZE = 10000
+
+#EVENT_LOG_FILE -- the absolute path of the structured event log, or None to not write one
+#Pages write one line of JSON per request here, with how long each stage of 
+#the request took (see core.Event).  The same permissions apply as for 
+#LOG_FILE, and it's written the same way (see LOG_BUFFERED).
+EVENT_LOG_FILE = '/n/openauth/log/events.log'
+
 #DEBUG -- boolean for whether or not to include full details in Exceptions and log messages
 #WARNING: True may cause tracebacks, shell command output, and other secrets to 
 #be included in the Exceptions that are raised.  Only use True in production if 
@@ -48,3 +69,38 @@ AUTH_TYPE = 'FORM'
 #properly quoted/escaped when passed to other programs, regardless of the 
 #expression here.
 RE_VALID_EMAIL_ADDRESS = re.compile('^[a-zA-Z0-9_\-.+%@]+$')
+
+#MAIL_BACKEND -- how core.sendEmail() sends email
+#choose one of:
+#	'shell' -- run the mail command line program (and uuencode, for 
+#	           attachments), and wait for it
+#	'smtp'  -- connect to the SMTP server MAIL_SMTP_HOST:MAIL_SMTP_PORT from 
+#	           python, and wait for it to accept the message
+#	'queue' -- write the message to MAIL_SPOOL_DIR and return right away; 
+#	           misc/mailqueue must be running (or run from cron) to deliver 
+#	           it, over SMTP as above
+#For 'queue', the web server user must be able to write to MAIL_SPOOL_DIR (it 
+#is created if it does not exist), and so must the user running the worker.  
+#Messages that fail temporarily are retried after MAIL_RETRY_BASE seconds, 
+#then twice that, etc., up to MAIL_RETRY_MAX seconds apart, for up to 
+#MAIL_MAX_AGE seconds.  The worker sends at most MAIL_BATCH_SIZE messages 
+#per connection.  See mailqueue for details.
+MAIL_BACKEND = 'shell'
+MAIL_SMTP_HOST = 'localhost'
+MAIL_SMTP_PORT = 25
+MAIL_SMTP_TIMEOUT = 30
+MAIL_SPOOL_DIR = '/n/openauth/mailq'
+MAIL_RETRY_BASE = 60
+MAIL_RETRY_MAX = 60*60
+MAIL_MAX_AGE = 60*60*24*2
+MAIL_BATCH_SIZE = 100
+
+#WSGI_SESSION_DIR -- where sessions are kept when the site runs as a WSGI application (see wsgi.py)
+#Under mod_python, its own session handling is used and this is ignored.  The 
+#user the WSGI server runs as must be able to write to it (it is created if it 
+#does not exist), and all the server's worker processes (and hosts, if there 
+#are several behind a load balancer) must see the same directory.  Sessions 
+#not used for WSGI_SESSION_TIMEOUT seconds expire (mod_python's default is 30 
+#minutes, too).
+WSGI_SESSION_DIR = '/n/openauth/sessions'
+WSGI_SESSION_TIMEOUT = 60*30
@@ -8,23 +8,28 @@ DESCRIPTION
 	This file is not intended to be modified.
 
 REQUIREMENTS
-	mail command line program, if using sendMail().
+	python 2.7 (for collections.OrderedDict and json).
 
-	uuencode, if using sendEmail() to sent attachments.
+	mail command line program, if using sendMail() with config.MAIL_BACKEND=='shell'.
+
+	uuencode, if using sendEmail() to sent attachments with config.MAIL_BACKEND=='shell'.
+
+	an SMTP server, if config.MAIL_BACKEND is 'smtp' or 'queue' (see mailqueue).
 
 AUTHOR
 	John Brunelle <john_brunelle@harvard.edu>
 	Harvard FAS Research Computing
 """
 
-import sys, os, time, subprocess, urllib, traceback
-from mod_python import util, apache
+import sys, os, time, subprocess, urllib, traceback, threading, atexit, collections, json
+from collections import OrderedDict
 import config
 
 
 #--- sanity checks
 
 if config.AUTH_TYPE not in ('NONE', 'HTTP', 'FORM'): raise Exception("unknown config.AUTH_TYPE [%s]" % config.AUTH_TYPE)
+if config.MAIL_BACKEND not in ('shell', 'smtp', 'queue'): raise Exception("unknown config.MAIL_BACKEND [%s]" % config.MAIL_BACKEND)
 
 
 #--- basic stuff
@@ -48,18 +53,204 @@ def log(msg, session=None, req=None, e=None):
 		else:
 			path = 'n/a'
 		prefix = "%s: %s: %s: " % (time.strftime('%Y-%m-%d %H:%M:%S'), sessionid, path)
+		lines = []
 		if config.DEBUG and e is not None:
 			tbstr = ''.join(traceback.format_exception(*sys.exc_info())).strip()
 			for line in tbstr.split('\n'):
-				open(config.LOG_FILE, 'a').write("%sDEBUG: %s\n" % (prefix, line))
-		open(config.LOG_FILE, 'a').write("%s%s\n" % (prefix, msg))
+				lines.append("%sDEBUG: %s\n" % (prefix, line))
+		lines.append("%s%s\n" % (prefix, msg))
+		_appendLog(config.LOG_FILE, ''.join(lines))
 	except Exception:
 		pass
 
+def flushLog():
+	"""write out everything log() and Event.emit() have queued so far (only applicable if config.LOG_BUFFERED)"""
+	for w in _logwriters.values():
+		if w.pid==os.getpid(): w.flush()
+
+def _appendLog(filename, text):
+	"""append text (one or more whole lines) to filename, through a background writer if config.LOG_BUFFERED"""
+	if config.LOG_BUFFERED:
+		_getLogWriter(filename).write(text)
+	else:
+		f = open(filename, 'a')
+		try:
+			f.write(text)
+		finally:
+			f.close()
+
+class _LogWriter(object):
+	"""a single open handle on a log file, written to in batches by a background thread"""
+
+	def __init__(self, filename):
+		self.filename = filename
+		self.pid = os.getpid()
+		self.pending = collections.deque()  #(appending and popping are atomic, so log() needs no lock)
+		self.wakeup = threading.Event()
+		self.f = None
+		self.lock = threading.Lock()  #(serializes writes to self.f)
+		self.thread = threading.Thread(target=self.run, name='lilpsp log writer')
+		self.thread.setDaemon(True)
+		self.thread.start()
+
+	def write(self, text):
+		"""queue text (one or more whole lines) to be written, or, if the queue is full, write it now (after what's queued, to keep the order)"""
+		n = len(self.pending)
+		if n >= config.LOG_QUEUE_SIZE:
+			self.lock.acquire()
+			try:
+				self._write(self._drain() + text)
+			finally:
+				self.lock.release()
+		else:
+			self.pending.append(text)
+			if n + 1 >= config.LOG_FLUSH_LINES: self.wakeup.set()
+
+	def run(self):
+		try:
+			while True:
+				self.wakeup.wait(config.LOG_FLUSH_SECONDS)
+				self.wakeup.clear()
+				self.flush()
+		except Exception:
+			pass  #(only happens as module globals are torn down at interpreter exit; atexit has already flushed)
+
+	def flush(self):
+		"""write everything queued"""
+		self.lock.acquire()
+		try:
+			text = self._drain()
+			if text: self._write(text)
+		finally:
+			self.lock.release()
+
+	def _drain(self):
+		"""take everything queued off the queue, and return it (caller must hold self.lock, so it's written in this order)"""
+		batch = []
+		try:
+			while True:
+				batch.append(self.pending.popleft())
+		except IndexError:
+			pass
+		return ''.join(batch)
+
+	def _write(self, text):
+		#should never raise an exception; caller must hold self.lock
+		try:
+			#reopen if the file has been rotated or removed out from under us
+			if self.f is not None:
+				try:
+					if os.stat(self.filename).st_ino!=os.fstat(self.f.fileno()).st_ino: raise OSError()
+				except OSError:
+					self.f.close()
+					self.f = None
+			if self.f is None:
+				self.f = open(self.filename, 'a')
+			self.f.write(text)
+			self.f.flush()
+		except Exception:
+			try:
+				self.f.close()
+			except Exception:
+				pass
+			self.f = None
+
+_logwriters = {}  #filename -> _LogWriter
+_logwriters_lock = threading.Lock()
+
+def _getLogWriter(filename):
+	"""return the _LogWriter for filename, starting one if this process does not have one yet"""
+	w = _logwriters.get(filename)
+	if w is None or w.pid!=os.getpid():  #(threads do not survive a fork, so a forked child needs its own)
+		_logwriters_lock.acquire()
+		try:
+			w = _logwriters.get(filename)
+			if w is None or w.pid!=os.getpid():
+				w = _logwriters[filename] = _LogWriter(filename)
+		finally:
+			_logwriters_lock.release()
+	return w
+
+atexit.register(flushLog)
+
+
+#--- structured events
+
+class Event(object):
+	"""a structured record of one request, written as one line of JSON to config.EVENT_LOG_FILE
+
+	This records how long each stage of handling the request took, for finding where latency goes (see misc/analyze_events).  Typical use:
+
+		event = core.Event('index', session, req)
+		...
+		event.begin('mail_send')
+		core.sendEmail(...)
+		event.end('mail_send')
+		...
+		event.emit()
+
+	A stage that is begun and ended more than once accumulates.  Other fields can be added with set().
+	None of the methods ever raise an Exception.
+	"""
+
+	def __init__(self, name, session=None, req=None):
+		self.t0 = time.time()
+		self.session = session
+		self.req = req
+		self.fields = {'event': name}
+		self.stages = {}
+		self._begun = {}
+		self._emitted = False
+
+	def set(self, key, value):
+		"""add a field to the record"""
+		self.fields[key] = value
+
+	def begin(self, stage):
+		"""start timing the named stage"""
+		self._begun[stage] = time.time()
+
+	def end(self, stage):
+		"""stop timing the named stage"""
+		try:
+			self.stages[stage] = self.stages.get(stage, 0) + time.time() - self._begun.pop(stage)
+		except Exception:
+			pass
+
+	def emit(self):
+		"""write the record (only the first call does anything)"""
+		#should never raise an exception
+		try:
+			if self._emitted or config.EVENT_LOG_FILE is None: return
+			self._emitted = True
+			now = time.time()
+			for stage in self._begun.keys():  #(stages never ended, e.g. because of an exception, run until now)
+				self.end(stage)
+			record = {
+				'time'    : time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.t0)),
+				'session' : 'n/a',
+				'uri'     : 'n/a',
+				'user'    : None,
+				'stages'  : self.stages,
+				'duration': now - self.t0,
+			}
+			if self.session is not None:
+				record['session'] = self.session.id()
+			if self.req is not None:
+				record['uri'] = self.req.uri
+			try:
+				record['user'] = getUsername(self.session, self.req)
+			except Exception:
+				pass
+			record.update(self.fields)
+			_appendLog(config.EVENT_LOG_FILE, '%s\n' % json.dumps(record, sort_keys=True))
+		except Exception:
+			pass
+
 
 #--- sessions/auth
 
-#Session management is done with mod_python's session object (http://www.modpython.org/live/current/doc-html/pyapi-sess.html).
+#Session management is done with mod_python's session object (http://www.modpython.org/live/current/doc-html/pyapi-sess.html), or, under WSGI, wsgi.Session, which works the same way.
 #The default session timeout is 30 minutes.
 #For config.AUTH_TYPE=='FORM', the presence of session['username'] implies there has been successful authentication, but always use getUsername() instead.
 
@@ -85,15 +276,34 @@ def sessionCheck(session, req):
 	elif config.AUTH_TYPE=='FORM':
 		if session.is_new() or not session.has_key('username'):
 			log("sessionCheck failed", session, req)
-			try:
-				util.redirect(req, 'login.psp?redirect=%s' % urllib.quote_plus(req.unparsed_uri))
-			except apache.SERVER_RETURN:  #fix for pre-3.3.1 bug where it uses apache.OK instead of apache.DONE (https://issues.apache.org/jira/browse/MODPYTHON-140)
-				raise apache.SERVER_RETURN, apache.DONE
+			redirect(req, 'login.psp?redirect=%s' % urllib.quote_plus(req.unparsed_uri))
 		else:
 			log("sessionCheck passed", session, req)
 	else:
 		raise Exception("sanity check")
 
+def serverReturn(req):
+	"""return the Exception class that redirect() raises (i.e. that ends a request early) for req, which may be an apache request object or a wsgi.Request"""
+	import wsgi
+	if isinstance(req, wsgi.Request):
+		return wsgi.SERVER_RETURN
+	from mod_python import apache  #(imported here so that the rest of this module is usable outside of apache, e.g. from cron scripts)
+	return apache.SERVER_RETURN
+
+def redirect(req, url):
+	"""redirect the client to url, ending the request by raising serverReturn(req)
+
+	Like sessionCheck(), this must be called before any output is written to the client.
+	"""
+	import wsgi
+	if isinstance(req, wsgi.Request):
+		req.redirect(url)
+	from mod_python import util, apache
+	try:
+		util.redirect(req, url)
+	except apache.SERVER_RETURN:  #fix for pre-3.3.1 bug where it uses apache.OK instead of apache.DONE (https://issues.apache.org/jira/browse/MODPYTHON-140)
+		raise apache.SERVER_RETURN, apache.DONE
+
 def getUsername(session, req):
 	"""return the username, or None if not applicable or not yet authenticated.
 	
@@ -148,6 +358,84 @@ def getStdout(sh, check=True):
 	return stdout
 
 
+#--- caching
+
+class TTLCache(object):
+	"""a bounded, least-recently-used cache whose entries also expire after a time-to-live
+
+	maxsize is the maximum number of entries kept; ttl is the default lifetime of entries, in seconds.
+	The hits and misses attributes count get() calls, for reporting.
+	This is per-process (each apache child has its own) and safe to use from multiple threads.
+	"""
+
+	def __init__(self, maxsize=128, ttl=300):
+		self.maxsize = maxsize
+		self.ttl = ttl
+		self.hits = 0
+		self.misses = 0
+		self._data = OrderedDict()  #key -> (expiration, value), least recently used first
+		self._lock = threading.Lock()
+
+	def get(self, key, default=None):
+		"""return the value cached for key, or default if there is none or it has expired"""
+		self._lock.acquire()
+		try:
+			try:
+				expiration, value = self._data.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			if time.time() >= expiration:
+				self.misses += 1
+				return default
+			self._data[key] = (expiration, value)  #(re-insert as the most recently used)
+			self.hits += 1
+			return value
+		finally:
+			self._lock.release()
+
+	def set(self, key, value, ttl=None):
+		"""cache value for key, for ttl seconds if given, else the default ttl"""
+		if ttl is None: ttl = self.ttl
+		self._lock.acquire()
+		try:
+			self._data.pop(key, None)
+			self._data[key] = (time.time() + ttl, value)
+			while len(self._data) > self.maxsize:
+				self._data.popitem(last=False)
+		finally:
+			self._lock.release()
+
+	def delete(self, key):
+		"""remove key from the cache, if present"""
+		self._lock.acquire()
+		try:
+			self._data.pop(key, None)
+		finally:
+			self._lock.release()
+
+	def clear(self):
+		"""remove everything from the cache (the counters are left alone)"""
+		self._lock.acquire()
+		try:
+			self._data.clear()
+		finally:
+			self._lock.release()
+
+	def __len__(self):
+		return len(self._data)
+
+
+#--- statistics
+
+def percentile(values, p):
+	"""return the p-th percentile (nearest rank) of the list values (which need not be sorted), or None if it's empty"""
+	if not values: return None
+	values = sorted(values)
+	i = int(len(values)*p/100.0 + 0.5) - 1
+	return values[max(0, min(i, len(values)-1))]
+
+
 #--- email
 
 def sendEmail(toEmailAddress, subject, body=None, fromEmailAddress=None, attachmentFilename=None, attachmentDisplayName=None):
@@ -156,22 +444,20 @@ def sendEmail(toEmailAddress, subject, body=None, fromEmailAddress=None, attachm
 	toEmailAddress can be a string (single email address) or list of strings (each a single email address).
 	If attachmentDisplayName is not None, use a different name for the attachment, else use the basename of the given attachmentFilename.
 	Having both a body and an attachment is currently not supported.
+	How the message is sent depends on config.MAIL_BACKEND; with 'queue', this returns as soon as the message is spooled.
 	"""
 	if isinstance(toEmailAddress, basestring):
 		if not config.RE_VALID_EMAIL_ADDRESS.match(toEmailAddress): raise Exception("[%s] is not a valid email address" % toEmailAddress)
-		toargs = shQuote(toEmailAddress)
+		toEmailAddresses = [toEmailAddress]
 	elif isinstance(toEmailAddress, list):
 		for x in toEmailAddress:
 			if not config.RE_VALID_EMAIL_ADDRESS.match(x): raise Exception("[%s] is not a valid email address" % x)
-		toargs = ' '.join([ shQuote(x) for x in toEmailAddress ])
+		toEmailAddresses = toEmailAddress
 	else:
 		raise TypeError("[%s] is not a string or list" % toEmailAddress)
 	
-	if fromEmailAddress is None:
-		fromargs = ''
-	else:
+	if fromEmailAddress is not None:
 		if not config.RE_VALID_EMAIL_ADDRESS.match(fromEmailAddress): raise Exception("[%s] is not a valid email address" % fromEmailAddress)
-		fromargs = '-- -r %s' % shQuote(fromEmailAddress)
 
 	if attachmentFilename is not None:
 		if body is not None: raise Exception("sending an attachment along with a message body is not supported")
@@ -179,7 +465,57 @@ def sendEmail(toEmailAddress, subject, body=None, fromEmailAddress=None, attachm
 		if attachmentDisplayName is None: attachmentDisplayName = os.path.basename(attachmentFilename)
 		if "'" in attachmentFilename   : raise Exception("malformed, dangerous input")
 		if "'" in attachmentDisplayName: raise Exception("malformed, dangerous input")
-		
+
+	if config.MAIL_BACKEND=='shell':
+		_sendEmailShell(toEmailAddresses, subject, body, fromEmailAddress, attachmentFilename, attachmentDisplayName)
+	else:
+		import mailqueue
+		if fromEmailAddress is None: fromEmailAddress = _defaultFromAddress()
+		message = _buildEmail(toEmailAddresses, subject, body, fromEmailAddress, attachmentFilename, attachmentDisplayName)
+		if config.MAIL_BACKEND=='smtp': mailqueue.send(fromEmailAddress, toEmailAddresses, message)
+		else                          : mailqueue.enqueue(fromEmailAddress, toEmailAddresses, message)
+
+def _defaultFromAddress():
+	"""return the sender address the mail command would use, i.e. the user this is running as, at this host"""
+	import pwd, socket
+	return '%s@%s' % (pwd.getpwuid(os.getuid())[0], socket.getfqdn())
+
+def _buildEmail(toEmailAddresses, subject, body, fromEmailAddress, attachmentFilename, attachmentDisplayName):
+	"""return the text (headers and body) of the message sendEmail() would send (for the 'smtp' and 'queue' backends)"""
+	from email.mime.text import MIMEText
+	from email.mime.base import MIMEBase
+	from email.mime.multipart import MIMEMultipart
+	from email import encoders, utils
+	if attachmentFilename is not None:
+		msg = MIMEMultipart()
+		part = MIMEBase('application', 'octet-stream')
+		f = open(attachmentFilename, 'rb')
+		try:
+			part.set_payload(f.read())
+		finally:
+			f.close()
+		encoders.encode_base64(part)
+		part.add_header('Content-Disposition', 'attachment', filename=attachmentDisplayName)
+		msg.attach(part)
+	else:
+		msg = MIMEText(body or '')
+	msg['Subject'] = subject
+	msg['From'] = fromEmailAddress
+	msg['To'] = ', '.join(toEmailAddresses)
+	msg['Date'] = utils.formatdate(localtime=True)
+	msg['Message-ID'] = utils.make_msgid()
+	return msg.as_string()
+
+def _sendEmailShell(toEmailAddresses, subject, body, fromEmailAddress, attachmentFilename, attachmentDisplayName):
+	"""send an email with the mail command line program (see sendEmail())"""
+	toargs = ' '.join([ shQuote(x) for x in toEmailAddresses ])
+
+	if fromEmailAddress is None:
+		fromargs = ''
+	else:
+		fromargs = '-- -r %s' % shQuote(fromEmailAddress)
+
+	if attachmentFilename is not None:
 		sh = "uuencode %s %s | mail -s %s %s %s" % (shQuote(attachmentFilename), shQuote(attachmentDisplayName), shQuote(subject), toargs, fromargs)
 		p = subprocess.Popen(
 			sh,
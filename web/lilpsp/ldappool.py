@@ -0,0 +1,224 @@
+"""
+pooled, failover-aware LDAP connections
+
+DESCRIPTION
+	A Pool keeps, per process, connections to a list of LDAP servers that
+	have already been set up (TCP connect and TLS handshake done), so that
+	authenticating a user is just a bind on a warm connection.
+
+	Servers are tried healthy ones first, fastest first.  A server that
+	cannot be reached is skipped for a cooldown period, instead of costing
+	every request the full timeout before the next server is tried.  If all
+	servers are cooling down, they are all tried anyway, least recently
+	failed first.
+
+REQUIREMENTS
+	python-ldap (only imported when a connection is actually made)
+
+IMPLEMENTATION NOTES
+	A connection is only used by one thread at a time -- it's taken out of
+	the pool for the duration of an operation and put back after.  Idle
+	connections older than idle_timeout are closed rather than reused, and
+	a pooled connection that turns out to have been closed by the server is
+	retried once on a fresh connection before the server is counted as
+	down.
+
+	Connections are not shared across a fork; a Pool notices it's in a new
+	process (see pid) and the owner should make a new one (see
+	org._getLDAPPool()).
+
+	To test against a stand-in server, pass a connect callable that returns
+	a connection object to it (anything with simple_bind_s(), unbind_s(),
+	etc.), or just give the Pool ldap://localhost URIs.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, time, threading
+import core
+
+
+class HostList(object):
+	"""LDAP server URIs, with when each last failed and how fast each has been answering"""
+
+	def __init__(self, uris, cooldown=60, alpha=0.3):
+		self.uris = list(uris)
+		self.cooldown = cooldown
+		self.alpha = alpha  #(weight of the newest sample in the moving average latency)
+		self.failed_at = {}  #uri -> time of the last failure
+		self.latency = {}  #uri -> moving average of the seconds an operation takes
+		self.lock = threading.Lock()
+
+	def order(self, now=None):
+		"""return the uris in the order they should be tried
+
+		Healthy ones come first, fastest first (ones without a measurement yet count as fastest, and ties keep the configured order), then the ones cooling down, least recently failed first.
+		"""
+		if now is None: now = time.time()
+		self.lock.acquire()
+		try:
+			healthy = [ uri for uri in self.uris if uri not in self.failed_at or now - self.failed_at[uri] >= self.cooldown ]
+			cooling = [ uri for uri in self.uris if uri not in healthy ]
+			healthy.sort(key=lambda uri: self.latency.get(uri, 0))
+			cooling.sort(key=lambda uri: self.failed_at[uri])
+			return healthy + cooling
+		finally:
+			self.lock.release()
+
+	def succeeded(self, uri, seconds):
+		"""record that uri answered, in the given number of seconds"""
+		self.lock.acquire()
+		try:
+			self.failed_at.pop(uri, None)
+			if uri in self.latency: self.latency[uri] = self.alpha*seconds + (1-self.alpha)*self.latency[uri]
+			else                  : self.latency[uri] = seconds
+		finally:
+			self.lock.release()
+
+	def failed(self, uri, now=None):
+		"""record that uri could not be reached"""
+		if now is None: now = time.time()
+		self.lock.acquire()
+		try:
+			self.failed_at[uri] = now
+		finally:
+			self.lock.release()
+
+class Pool(object):
+	"""a per-process pool of LDAP connections to a list of servers (see the module docstring)"""
+
+	def __init__(self, uris, size=2, cooldown=60, timeout=5, idle_timeout=300, connect=None):
+		self.pid = os.getpid()
+		self.hosts = HostList(uris, cooldown)
+		self.size = size  #(maximum idle connections kept per server)
+		self.timeout = timeout
+		self.idle_timeout = idle_timeout
+		if connect is None: connect = self._connect
+		self.connect = connect
+		self.idle = {}  #uri -> list of (time put back, connection), most recent last
+		self.lock = threading.Lock()
+		self.connects = 0
+		self.reuses = 0
+		self.failovers = 0
+
+	def _connect(self, uri):
+		import ldap
+		conn = ldap.initialize(uri)
+		conn.protocol_version = ldap.VERSION3
+		conn.set_option(ldap.OPT_NETWORK_TIMEOUT, self.timeout)
+		conn.set_option(ldap.OPT_TIMEOUT, self.timeout)
+		conn.set_option(ldap.OPT_REFERRALS, 0)
+		return conn
+
+	def _get(self, uri):
+		"""return (connection, True) for an idle connection to uri, or (a new connection, False) if there is none"""
+		now = time.time()
+		stale = []
+		conn = None
+		self.lock.acquire()
+		try:
+			idle = self.idle.get(uri, [])
+			while idle:
+				t, c = idle.pop()
+				if now - t < self.idle_timeout:
+					conn = c
+					break
+				stale.append(c)
+		finally:
+			self.lock.release()
+		for c in stale:
+			self._discard(c)
+		if conn is not None:
+			self.reuses += 1
+			return conn, True
+		self.connects += 1
+		return self.connect(uri), False
+
+	def _put(self, uri, conn):
+		"""return conn to the pool, or close it if the pool for uri is full"""
+		self.lock.acquire()
+		try:
+			idle = self.idle.setdefault(uri, [])
+			if len(idle) < self.size:
+				idle.append((time.time(), conn))
+				conn = None
+		finally:
+			self.lock.release()
+		if conn is not None: self._discard(conn)
+
+	def _discard(self, conn):
+		try:
+			conn.unbind_s()
+		except Exception:
+			pass
+
+	def run(self, op, session=None, req=None):
+		"""call op(connection) on the first server that answers, and return (uri, whatever op returned)
+
+		Errors the server answers with (e.g. ldap.INVALID_CREDENTIALS, ldap.NO_SUCH_OBJECT) are raised as-is.
+		If no server can be reached, this raises an Exception.
+		session and req, if given, are only used for logging.
+		"""
+		import ldap
+		for uri in self.hosts.order():
+			conn, pooled = self._get(uri)
+			while True:
+				t0 = time.time()
+				try:
+					result = op(conn)
+				except (ldap.SERVER_DOWN, ldap.TIMEOUT), e:
+					self._discard(conn)
+					if pooled:
+						#(the server may have just closed an idle connection, so try once more on a fresh one before giving up on it)
+						self.connects += 1
+						conn, pooled = self.connect(uri), False
+						continue
+					self.hosts.failed(uri)
+					self.failovers += 1
+					msg = "could not reach ldap server [%s]: %s; skipping it for %ss and trying other hosts if available" % (uri, e, self.hosts.cooldown)
+					core.log(msg, session, req)
+					break
+				except ldap.LDAPError:
+					#(the server answered, so the connection is still good)
+					self.hosts.succeeded(uri, time.time()-t0)
+					self._put(uri, conn)
+					raise
+				except Exception:
+					self._discard(conn)
+					raise
+				else:
+					self.hosts.succeeded(uri, time.time()-t0)
+					self._put(uri, conn)
+					return uri, result
+		raise Exception("cannot contact LDAP server(s)")
+
+	def bind(self, dn, password, session=None, req=None):
+		"""bind as dn with password, and return the uri of the server that did it
+
+		This raises ldap.INVALID_CREDENTIALS if the password is wrong.
+		Note that most servers treat an empty password as an anonymous bind, which succeeds; the caller must refuse those.
+		"""
+		return self.run(lambda conn: conn.simple_bind_s(dn, password), session, req)[0]
+
+	def warm(self):
+		"""open (with an anonymous bind) one connection to each server that doesn't already have an idle one, e.g. when a worker starts"""
+		for uri in self.hosts.order():
+			self.lock.acquire()
+			try:
+				have = len(self.idle.get(uri, []))
+			finally:
+				self.lock.release()
+			if have: continue
+			self.connects += 1
+			conn = self.connect(uri)
+			t0 = time.time()
+			try:
+				conn.simple_bind_s('', '')
+			except Exception:
+				self._discard(conn)
+				self.hosts.failed(uri)
+			else:
+				self.hosts.succeeded(uri, time.time()-t0)
+				self._put(uri, conn)
@@ -0,0 +1,219 @@
+"""
+spool-backed outbound mail queue
+
+DESCRIPTION
+	When config.MAIL_BACKEND=='queue', core.sendEmail() only drops the
+	message into config.MAIL_SPOOL_DIR (see enqueue()) and returns, so the
+	request does not wait on the MTA.  A separate worker (misc/mailqueue,
+	run from cron or as a daemon) delivers what's spooled in batches over one
+	SMTP connection (see deliver()).  Messages that fail temporarily are
+	retried with exponential backoff; ones that fail permanently, or for
+	longer than config.MAIL_MAX_AGE, are moved aside to failed/.
+
+	This also has the in-process smtplib delivery used when
+	config.MAIL_BACKEND=='smtp' (see send()).
+
+	To test without a real MTA, run python's debugging SMTP server, e.g.
+
+		python -m smtpd -n -c DebuggingServer localhost:1025
+
+	and set config.MAIL_SMTP_PORT (or the worker's --port) to 1025.
+
+REQUIREMENTS
+	an SMTP server (e.g. the local MTA) that accepts mail from this host
+
+IMPLEMENTATION NOTES
+	The spool is laid out like a maildir:
+
+		tmp/     messages being written
+		new/     messages waiting to be delivered
+		failed/  messages that will not be retried
+
+	Each message is one file: a line of JSON with the envelope and retry
+	state, then the message itself.  Files are written in tmp/, fsync'ed,
+	and renamed into new/, so the worker never sees a partial message and a
+	message that enqueue() returned for survives a crash.  Retry state is
+	updated the same way.
+
+	Only one worker delivers at a time (it holds an flock on the spool's
+	lock file), so messages are not sent twice.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, time, json, uuid, fcntl, socket, smtplib
+import config, core
+
+
+#--- internal helpers
+
+def _subdirs(spool_dir):
+	"""return the tmp, new, and failed directories of spool_dir, making them if necessary"""
+	dirs = []
+	for name in ('tmp', 'new', 'failed'):
+		path = os.path.join(spool_dir, name)
+		if not os.path.isdir(path): os.makedirs(path, 0700)
+		dirs.append(path)
+	return dirs
+
+def _writeFile(path, envelope, message):
+	"""atomically (re)write the spool file at path"""
+	tmppath = os.path.join(os.path.dirname(os.path.dirname(path)), 'tmp', os.path.basename(path))
+	f = open(tmppath, 'w')
+	try:
+		f.write('%s\n' % json.dumps(envelope))
+		f.write(message)
+		f.flush()
+		os.fsync(f.fileno())
+	finally:
+		f.close()
+	os.rename(tmppath, path)
+
+def _readFile(path):
+	"""return (envelope, message) from the spool file at path"""
+	f = open(path)
+	try:
+		envelope = json.loads(f.readline())
+		return envelope, f.read()
+	finally:
+		f.close()
+
+def _isPermanent(e):
+	"""return whether the smtplib Exception e means retrying will not help"""
+	if isinstance(e, smtplib.SMTPRecipientsRefused):
+		return min([ code for code, msg in e.recipients.values() ]) >= 500
+	if isinstance(e, smtplib.SMTPResponseException):
+		return e.smtp_code >= 500
+	return False
+
+
+#--- main methods
+
+def enqueue(fromaddr, toaddrs, message, spool_dir=None):
+	"""spool message (a string with headers) for delivery from fromaddr to the list of addresses toaddrs, and return its id"""
+	if spool_dir is None: spool_dir = config.MAIL_SPOOL_DIR
+	tmpdir, newdir, faileddir = _subdirs(spool_dir)
+	now = time.time()
+	msgid = '%d.%d.%s' % (now, os.getpid(), uuid.uuid4().hex)
+	envelope = {'from': fromaddr, 'to': toaddrs, 'created': now, 'attempts': 0, 'next': now}
+	_writeFile(os.path.join(newdir, msgid), envelope, message)
+	return msgid
+
+class SMTPConnection(object):
+	"""a persistent connection to an SMTP server, opened on first use and re-opened if the server drops it"""
+
+	def __init__(self, host=None, port=None, timeout=None):
+		if host    is None: host    = config.MAIL_SMTP_HOST
+		if port    is None: port    = config.MAIL_SMTP_PORT
+		if timeout is None: timeout = config.MAIL_SMTP_TIMEOUT
+		self.host = host
+		self.port = port
+		self.timeout = timeout
+		self.smtp = None
+
+	def send(self, fromaddr, toaddrs, message):
+		"""send one message; raises an smtplib.SMTPException or socket.error on failure"""
+		for attempt in (1, 2):
+			if self.smtp is None:
+				self.smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+			try:
+				self.smtp.sendmail(fromaddr, toaddrs, message)
+				return
+			except smtplib.SMTPServerDisconnected:
+				#(an idle connection may have been closed by the server; try once more on a new one)
+				self.smtp = None
+				if attempt==2: raise
+			except smtplib.SMTPRecipientsRefused:
+				raise
+			except (smtplib.SMTPException, socket.error):
+				self.close()
+				raise
+
+	def close(self):
+		if self.smtp is not None:
+			try:
+				self.smtp.quit()
+			except Exception:
+				pass
+			self.smtp = None
+
+def send(fromaddr, toaddrs, message):
+	"""deliver message right now, over a new SMTP connection (used when config.MAIL_BACKEND=='smtp')"""
+	conn = SMTPConnection()
+	try:
+		conn.send(fromaddr, toaddrs, message)
+	finally:
+		conn.close()
+
+def deliver(spool_dir=None, batch_size=None, conn=None):
+	"""deliver up to batch_size spooled messages that are due, over one SMTP connection
+
+	Returns a dict with counts of the messages sent, deferred (to be retried later), and failed (moved to failed/), plus locked (True if another worker holds the spool, in which case nothing was done) and seconds.
+	conn, if given, is an SMTPConnection to use (and leave open), else one is made from the config.
+	"""
+	if spool_dir  is None: spool_dir  = config.MAIL_SPOOL_DIR
+	if batch_size is None: batch_size = config.MAIL_BATCH_SIZE
+	t0 = time.time()
+	result = {'sent': 0, 'deferred': 0, 'failed': 0, 'locked': False}
+	tmpdir, newdir, faileddir = _subdirs(spool_dir)
+
+	lock = open(os.path.join(spool_dir, '.lock'), 'a')
+	try:
+		try:
+			fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			result['locked'] = True
+			result['seconds'] = time.time() - t0
+			return result
+
+		close = conn is None
+		if conn is None: conn = SMTPConnection()
+		try:
+			now = time.time()
+			for msgid in sorted(os.listdir(newdir)):  #(ids start with the time, so this is oldest first)
+				if result['sent'] + result['failed'] >= batch_size: break
+				path = os.path.join(newdir, msgid)
+				try:
+					envelope, message = _readFile(path)
+				except (IOError, OSError, ValueError), e:
+					msg = "ERROR: unreadable mail spool file [%s], moving it to failed: %s" % (path, e)
+					core.log(msg)
+					os.rename(path, os.path.join(faileddir, msgid))
+					result['failed'] += 1
+					continue
+				if envelope['next'] > now: continue
+				try:
+					conn.send(envelope['from'], envelope['to'], message)
+				except (smtplib.SMTPException, socket.error), e:
+					envelope['attempts'] += 1
+					envelope['error'] = str(e)
+					if _isPermanent(e) or now - envelope['created'] > config.MAIL_MAX_AGE:
+						_writeFile(path, envelope, message)
+						os.rename(path, os.path.join(faileddir, msgid))
+						result['failed'] += 1
+						msg = "ERROR: giving up on mail [%s] to %s after %d attempts: %s" % (msgid, envelope['to'], envelope['attempts'], e)
+						core.log(msg)
+					else:
+						envelope['next'] = now + min(config.MAIL_RETRY_BASE * 2**(envelope['attempts']-1), config.MAIL_RETRY_MAX)
+						_writeFile(path, envelope, message)
+						result['deferred'] += 1
+						msg = "failed to deliver mail [%s] to %s (attempt %d), will retry at %s: %s" % (msgid, envelope['to'], envelope['attempts'], time.ctime(envelope['next']), e)
+						core.log(msg)
+						if not isinstance(e, smtplib.SMTPRecipientsRefused): break  #(the server is having trouble; leave the rest for the next run)
+				else:
+					os.unlink(path)
+					result['sent'] += 1
+		finally:
+			if close: conn.close()
+	finally:
+		lock.close()  #(releases the flock)
+
+	result['seconds'] = time.time() - t0
+	return result
+
+def pending(spool_dir=None):
+	"""return the number of messages waiting in the spool (due or not)"""
+	if spool_dir is None: spool_dir = config.MAIL_SPOOL_DIR
+	return len(os.listdir(_subdirs(spool_dir)[1]))
@@ -18,13 +18,35 @@ AUTHOR
 """
 
 import os, time, pwd
-import config, core
+import config, core, ldappool
 
 
 email_from_address = 'rchelp@fas.harvard.edu'
 
 support_email_address = 'rchelp@fas.harvard.edu'
 
+#the LDAP servers authenticateUser() binds against, in order of preference (see ldappool for how they're picked)
+ldap_uris = ('ldaps://dc2-rc:636/', 'ldaps://dc3-rc:636/')
+#seconds to skip a server after it could not be reached
+ldap_cooldown = 60
+#seconds to wait for a server to connect/answer
+ldap_timeout = 5
+#idle connections to keep open per server, per process
+ldap_pool_size = 2
+
+#where lookupUser() searches for users, or None to use username2ldapatts instead of searching directly
+ldap_search_base = None
+#the filter for a user (%s is replaced with the escaped username)
+ldap_search_filter = '(sAMAccountName=%s)'
+#the dn and password to search as (None for an anonymous search)
+ldap_search_dn = None
+ldap_search_password = None
+#seconds to cache users that exist, and users that don't
+lookup_ttl = 300
+lookup_negative_ttl = 60
+#maximum number of users cached, per process
+lookup_cache_size = 1024
+
 
 #--- page content and error messages
 
@@ -115,15 +137,76 @@ def html_logout_link(session, req):
 
 #--- handling users
 
+_usercache = core.TTLCache(lookup_cache_size, lookup_ttl)
+_notcached = object()
+
+def _searchUser(username):
+	"""return the lookupUser() dict for username from an LDAP search, or None if there is no such user"""
+	import ldap, ldap.filter
+	def search(conn):
+		conn.simple_bind_s(ldap_search_dn or '', ldap_search_password or '')
+		return conn.search_s(ldap_search_base, ldap.SCOPE_SUBTREE, ldap_search_filter % ldap.filter.escape_filter_chars(username), ['mail', 'displayName'])
+	uri, results = _getLDAPPool().run(search)
+	results = [ (dn, atts) for dn, atts in results if dn is not None ]  #(skip search continuation references)
+	if not results: return None
+	dn, atts = results[0]
+	return {
+		'dn'      : dn,
+		'mail'    : (atts.get('mail') or [None])[0],
+		'fullname': (atts.get('displayName') or [None])[0],
+	}
+
+#lookupUser() key -> username2ldapatts attribute ('fullname' is not available that way, and is always None)
+_ldapatts = {'dn': 'distinguishedName', 'mail': 'mail'}
+
+def _username2ldapatts(username, user, keys):
+	"""add the given keys that aren't already in user, a lookupUser() dict, from /n/sw/rc/bin/username2ldapatts (one run for each); return user, or None if 'dn' is one of the keys and there is no such user"""
+	for key in keys:
+		if user.has_key(key): continue
+		value = None
+		if _ldapatts.has_key(key): value = core.getStdout("/n/sw/rc/bin/username2ldapatts -a %s %s" % (_ldapatts[key], core.shQuote(username))).strip() or None
+		if key=='dn' and value is None: return None
+		user[key] = value
+	return user
+
+def lookupUser(username, keys=('dn', 'mail', 'fullname')):
+	"""return a dict of the user's directory attributes, or None if there is no such user
+
+	The keys are 'dn', 'mail', and 'fullname' (the latter two may be None).
+	All of them come from one LDAP search under ldap_search_base.  If that is None, they come from username2ldapatts instead, which takes a subprocess per attribute, so only the given keys are looked up (and the dict may be missing the others), and whether the user exists is only known if 'dn' is one of them.
+	Results, including users that don't exist, are cached (see lookup_ttl and lookup_negative_ttl; lookupStats() has the counters).
+	Failures to look the user up at all raise an Exception and are not cached.
+	"""
+	user = _usercache.get(username, _notcached)
+	if user is None: return None
+	if ldap_search_base is not None:
+		if user is not _notcached: return user
+		user = _searchUser(username)
+	else:
+		if user is _notcached: user = {}
+		elif not [ key for key in keys if not user.has_key(key) ]: return user
+		user = _username2ldapatts(username, dict(user), keys)  #(a copy, since another thread may be using the cached one)
+	if user is None: _usercache.set(username, None, lookup_negative_ttl)
+	else           : _usercache.set(username, user)
+	return user
+
+def lookupStats():
+	"""return a dict of the lookupUser() cache counters (hits, misses, size) for this process"""
+	return {'hits': _usercache.hits, 'misses': _usercache.misses, 'size': len(_usercache)}
+
 def getFullName(username):
 	"""return the user's full name, or just the username (as given) if that fails
 	
 	This is provided for convenience only -- it not called anywhere be default, regardless of config.AUTH_TYPE.
 	"""
-	realname = username
-	try: realname = pwd.getpwnam(username)[4]
-	except Exception: pass
-	if realname=='': realname = username
+	realname = None
+	if ldap_search_base is not None:  #(username2ldapatts has no full names)
+		try: realname = lookupUser(username)['fullname']
+		except Exception: pass
+	if not realname:
+		try: realname = pwd.getpwnam(username)[4]
+		except Exception: pass
+	if not realname: realname = username
 	return realname
 
 def getEmailAddress(username):
@@ -131,7 +214,9 @@ def getEmailAddress(username):
 	
 	This is provided for convenience only -- it not called anywhere be default, regardless of config.AUTH_TYPE.
 	"""
-	return core.getStdout("/n/sw/rc/bin/username2ldapatts -a mail %s" % core.shQuote(username)).strip()
+	user = lookupUser(username, ('mail',))
+	if user is None or not user['mail']: raise Exception("no email address found for user [%s]" % username)
+	return user['mail']
 
 def authenticateUser(session, req, username, password):
 	"""authenticate the username/password combination.
@@ -143,32 +228,25 @@ def authenticateUser(session, req, username, password):
 
 	if password=='': raise Exception("empty password")  #the ldap bind does not fail for empty password, so must catch it before
 
-	import ldap
+	user = lookupUser(username, ('dn',))
+	if user is None: raise Exception("no such user")
+	_getLDAPPool().bind(user['dn'], password, session, req)  #will raise ldap.INVALID_CREDENTIALS in case of failure
 
-	ldap.set_option(ldap.OPT_DEBUG_LEVEL,255)
+_ldappool = None
 
+def _getLDAPPool():
+	"""return this process's ldappool.Pool for ldap_uris"""
+	global _ldappool
+	if _ldappool is None or _ldappool.pid!=os.getpid():
+		_ldappool = ldappool.Pool(ldap_uris, size=ldap_pool_size, cooldown=ldap_cooldown, timeout=ldap_timeout)
+	return _ldappool
+
+def warmLDAP():
+	"""open a connection to each of ldap_uris ahead of the first login (see ldappool.Pool.warm()), e.g. when a worker starts
+
+	Failures (e.g. the servers being down) are logged, not raised; logins will try again.
+	"""
 	try:
-		try:
-			authenticated = False
-			for host in ('dc2-rc', 'dc3-rc'):
-				try:
-					l = ldap.initialize("ldaps://%s:636/" % host)
-					l.protocol_version = ldap.VERSION3
-					l.simple_bind_s(
-						core.getStdout("/n/sw/rc/bin/username2ldapatts -a distinguishedName %s" % core.shQuote(username)).strip(),
-						password
-					)  #will raise ldap.INVALID_CREDENTIALS in case of failure
-					authenticated = True
-					break
-				except ldap.SERVER_DOWN, e:
-					msg = "got ldap.SERVER_DOWN for [%s]: %s; will retry other hosts if available" % (host, e)
-					core.log(msg, session, req)
-					continue
-			if not authenticated: raise Exception("cannot contact LDAP server(s)")
-		except ldap.INVALID_CREDENTIALS:
-			raise
-	finally:
-		try:
-			l.unbind_s()
-		except Exception:
-			pass
+		_getLDAPPool().warm()
+	except Exception, e:
+		core.log("ERROR: failed to open LDAP connections ahead of time: %s" % e, e=e)
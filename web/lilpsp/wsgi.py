@@ -0,0 +1,326 @@
+"""
+running pages as a WSGI application
+
+DESCRIPTION
+	Request, Session, and FieldStorage stand in for mod_python's request
+	object, Session.Session, and util.FieldStorage -- as much of them as lilpsp
+	and the pages' handlers use -- so that the same handler functions run under
+	any WSGI server (gunicorn, uwsgi, mod_wsgi, wsgiref, etc.), not just under
+	mod_python.  Application is the WSGI application; it routes each request,
+	by the last part of its path, to a handler function taking (req, session,
+	form).
+
+	Handlers should use core.redirect() and core.serverReturn() rather than
+	mod_python's util.redirect() and apache.SERVER_RETURN.
+
+REQUIREMENTS
+	n/a
+
+IMPLEMENTATION NOTES
+	Sessions are files of JSON in config.WSGI_SESSION_DIR, one per session,
+	so they are shared by all worker processes.  The cookie is the same as
+	mod_python's (pysid).  Like mod_python's FileSession, expired session files
+	are swept now and then, by whichever request happens to do it.
+
+	What a handler writes is buffered and returned to the server when the
+	handler is done, so, unlike under mod_python, a zip download is held in
+	memory for the duration of the request.
+
+	req.internal_redirect() does not run the other page right away, as
+	mod_python does, but after the current handler returns; what the current
+	handler wrote is discarded.  The session is the same.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, re, time, json, uuid, random, errno, cgi, urlparse, httplib, Cookie
+import config
+
+
+#the cookie holding the session id (same as mod_python's)
+COOKIE_NAME = 'pysid'
+
+#the page served for a path ending in /
+DEFAULT_PAGE = 'index.psp'
+
+#the chance, per new session, that expired session files are swept
+SWEEP_PROBABILITY = 0.001
+
+#the most internal redirects followed for one request
+MAX_INTERNAL_REDIRECTS = 5
+
+#reason phrases for statuses httplib doesn't know
+_reasons = {429: 'Too Many Requests'}
+
+_re_sid = re.compile('^[0-9a-f]{32}$')
+
+
+class SERVER_RETURN(Exception):
+	"""raised to end the handling of a request early (see core.redirect())"""
+	pass
+
+
+#--- request
+
+class Headers(object):
+	"""response headers, with the parts of mod_python's table interface used by the pages"""
+
+	def __init__(self):
+		self._items = []
+
+	def add(self, name, value):
+		self._items.append((name, str(value)))
+
+	def has_key(self, name):
+		return name.lower() in [ n.lower() for n, v in self._items ]
+
+	def __setitem__(self, name, value):
+		self._items = [ (n, v) for n, v in self._items if n.lower()!=name.lower() ]
+		self.add(name, value)
+
+	def items(self):
+		return list(self._items)
+
+class Request(object):
+	"""a mod_python-like request object for one WSGI request
+
+	script_dir is the directory the pages (and header.html, etc.) are in; req.filename is the page in there the path names.
+	path, if given, is used instead of the one in environ (for internal redirects).
+	"""
+
+	def __init__(self, environ, script_dir, path=None):
+		self.environ = environ
+		query = environ.get('QUERY_STRING', '')
+		if path is None:
+			path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+		else:
+			path, query = urlparse.urlsplit(path)[2:4]
+			environ = self.environ = dict(environ, QUERY_STRING=query, REQUEST_METHOD='GET', CONTENT_LENGTH='0')
+		self.uri = path or '/'
+		self.args = query or None
+		self.unparsed_uri = self.uri
+		if query: self.unparsed_uri += '?' + query
+		self.filename = os.path.join(script_dir, self.uri.split('/')[-1] or DEFAULT_PAGE)
+		self.method = environ.get('REQUEST_METHOD', 'GET')
+		self.user = environ.get('REMOTE_USER')
+
+		self.headers_in = {}
+		for k, v in environ.items():
+			if k.startswith('HTTP_'): self.headers_in[k[5:].replace('_', '-').title()] = v
+
+		host = environ.get('HTTP_HOST') or '%s:%s' % (environ.get('SERVER_NAME', 'localhost'), environ.get('SERVER_PORT', '80'))
+		self.subprocess_env = {
+			'REMOTE_ADDR'    : environ.get('REMOTE_ADDR', ''),
+			'SCRIPT_URI'     : '%s://%s%s' % (environ.get('wsgi.url_scheme', 'http'), host, self.uri),
+			'SCRIPT_FILENAME': self.filename,
+		}
+
+		self.status = 200
+		self.headers_out = Headers()
+		self.content_length = None
+		self.output = []
+		self.redirect_to = None
+
+	def add_common_vars(self):
+		"""(subprocess_env is always complete)"""
+		pass
+
+	def write(self, data):
+		self.output.append(str(data))
+
+	def set_content_length(self, length):
+		self.content_length = length
+
+	def internal_redirect(self, uri):
+		"""serve the page at uri instead, once the current handler returns (see the module docstring)"""
+		self.redirect_to = uri
+
+	def redirect(self, url):
+		"""redirect the client to url, and end the request (this raises SERVER_RETURN)"""
+		self.status = 302
+		self.headers_out['Location'] = url
+		raise SERVER_RETURN()
+
+
+#--- sessions
+
+def _str(value):
+	"""return value, loaded from JSON, with its unicode strings (at any depth) made utf-8 strs, as mod_python's sessions would have them"""
+	if isinstance(value, unicode): return value.encode('utf-8')
+	if isinstance(value, list): return [ _str(x) for x in value ]
+	if isinstance(value, dict): return dict([ (_str(k), _str(v)) for k, v in value.items() ])
+	return value
+
+def _sweepSessions(directory, timeout):
+	"""remove the session files in directory that have expired"""
+	now = time.time()
+	for name in os.listdir(directory):
+		if not _re_sid.match(name): continue
+		try:
+			path = os.path.join(directory, name)
+			if now - os.stat(path).st_mtime > timeout: os.remove(path)
+		except OSError:  #(removed by someone else)
+			pass
+
+class Session(object):
+	"""a mod_python-like session, kept in a file in directory (see the module docstring)"""
+
+	def __init__(self, req, directory=None, timeout=None):
+		if directory is None: directory = config.WSGI_SESSION_DIR
+		if timeout   is None: timeout   = config.WSGI_SESSION_TIMEOUT
+		self.directory = directory
+		self.timeout = timeout
+		self._data = {}
+		self._new = True
+		self._invalid = False
+
+		cookies = Cookie.SimpleCookie()
+		try:
+			cookies.load(req.environ.get('HTTP_COOKIE', ''))
+		except Cookie.CookieError:
+			pass
+		sid = cookies.has_key(COOKIE_NAME) and cookies[COOKIE_NAME].value or None
+		if sid is not None and _re_sid.match(sid):
+			try:
+				f = open(os.path.join(directory, sid))
+				try:
+					saved = json.load(f)
+				finally:
+					f.close()
+				if time.time() - saved['accessed'] <= timeout:
+					self._data = _str(saved['data'])  #(else e.g. the username is unicode, which breaks the zip, among other things)
+					self._new = False
+			except (IOError, ValueError, KeyError):
+				pass
+		if self._new:
+			sid = uuid.uuid4().hex
+			if random.random() < SWEEP_PROBABILITY:
+				try:
+					_sweepSessions(directory, timeout)
+				except OSError:
+					pass
+		self._sid = sid
+
+	def id(self):
+		return self._sid
+
+	def is_new(self):
+		return self._new
+
+	def has_key(self, key):
+		return self._data.has_key(key)
+
+	def __getitem__(self, key):
+		return self._data[key]
+
+	def __setitem__(self, key, value):
+		self._data[key] = value
+
+	def __delitem__(self, key):
+		del self._data[key]
+
+	def get(self, key, default=None):
+		return self._data.get(key, default)
+
+	def keys(self):
+		return self._data.keys()
+
+	def invalidate(self):
+		"""delete the session, and expire the client's cookie"""
+		self._invalid = True
+		self.delete()
+
+	def delete(self):
+		"""delete the session's saved data"""
+		try:
+			os.remove(os.path.join(self.directory, self._sid))
+		except OSError:
+			pass
+
+	def save(self):
+		"""save the session's data (unless it has been invalidated)"""
+		if self._invalid: return
+		if not os.path.isdir(self.directory):
+			try:
+				os.makedirs(self.directory, 0700)
+			except OSError, e:
+				if e.errno!=errno.EEXIST: raise
+		path = os.path.join(self.directory, self._sid)
+		tmppath = '%s.%d' % (path, os.getpid())
+		f = open(tmppath, 'w')
+		try:
+			json.dump({'accessed': time.time(), 'data': self._data}, f)
+		finally:
+			f.close()
+		os.rename(tmppath, path)
+
+	def cookie(self):
+		"""return the Set-Cookie header value for the response"""
+		if self._invalid: return '%s=; path=/; expires=Thu, 01-Jan-1970 00:00:00 GMT' % COOKIE_NAME
+		return '%s=%s; path=/' % (COOKIE_NAME, self._sid)
+
+
+#--- forms
+
+class FieldStorage(object):
+	"""the form fields of a request (the query string, and the body of a POST), like mod_python's util.FieldStorage: form[name] is a str (the first value given)"""
+
+	def __init__(self, req, keep_blank_values=1):
+		self._fields = {}
+		environ = dict(req.environ, QUERY_STRING=req.environ.get('QUERY_STRING', ''))  #(else cgi looks at sys.argv)
+		fp = environ.get('wsgi.input')
+		if environ.get('REQUEST_METHOD', 'GET')!='POST': fp = None
+		fs = cgi.FieldStorage(fp=fp, environ=environ, keep_blank_values=keep_blank_values)
+		for item in fs.list or []:
+			if not self._fields.has_key(item.name): self._fields[item.name] = item.value
+
+	def has_key(self, key):
+		return self._fields.has_key(key)
+
+	def __getitem__(self, key):
+		return self._fields[key]
+
+	def get(self, key, default=None):
+		return self._fields.get(key, default)
+
+	def keys(self):
+		return self._fields.keys()
+
+
+#--- application
+
+class Application(object):
+	"""a WSGI application serving handler functions
+
+	route is a callable taking the name of the page (the last part of the path, e.g. 'index.psp', or DEFAULT_PAGE for a path ending in /) and returning the handler for it, a callable taking (req, session, form), or None if there is no such page.
+	script_dir and session_dir are as for Request and Session.
+	"""
+
+	def __init__(self, route, script_dir, session_dir=None):
+		self.route = route
+		self.script_dir = script_dir
+		self.session_dir = session_dir
+
+	def __call__(self, environ, start_response):
+		req = Request(environ, self.script_dir)
+		session = Session(req, self.session_dir)
+		for i in range(MAX_INTERNAL_REDIRECTS + 1):
+			handler = self.route(os.path.basename(req.filename))
+			if handler is None:
+				start_response('404 Not Found', [('Content-Type', 'text/plain')])
+				return ['not found\n']
+			handler(req, session, FieldStorage(req))
+			if req.redirect_to is None: break
+			req = Request(req.environ, self.script_dir, req.redirect_to)
+		else:
+			raise Exception("too many internal redirects, last to [%s]" % req.uri)
+		session.save()
+
+		headers = req.headers_out.items()
+		if not req.headers_out.has_key('Content-Type'): headers.append(('Content-Type', 'text/html'))
+		if req.content_length is not None: headers.append(('Content-Length', str(req.content_length)))
+		headers.append(('Set-Cookie', session.cookie()))
+		start_response('%d %s' % (req.status, httplib.responses.get(req.status) or _reasons.get(req.status, '')), headers)
+		return req.output
@@ -0,0 +1,60 @@
+"""
+the site as a WSGI application
+
+DESCRIPTION
+	application is a WSGI application serving the same pages the .psp files
+	and openauth.downloadHandler() serve under mod_python (see handlers.py),
+	so the site can run under any multi-worker WSGI server, e.g., from the
+	web directory:
+
+		gunicorn -w 8 -b :8080 openauth.app:application
+
+	or under misc/wsgid, for testing.  Sessions are kept in
+	config.WSGI_SESSION_DIR (see lilpsp/wsgi.py).
+
+	Only the pages are served, not static files (the installers, images,
+	etc.); put a web server in front for those.  For config.AUTH_TYPE=='HTTP',
+	the authentication wall is the server's (REMOTE_USER).
+
+REQUIREMENTS
+	a WSGI server
+
+IMPLEMENTATION NOTES
+	Importing this sets up the process to serve pages (see handlers.init()),
+	so a server that imports the application in each worker (e.g. gunicorn
+	without --preload) does that once per worker, when it starts.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os
+from lilpsp import wsgi
+import handlers
+
+
+#SCRIPT_DIR -- the directory with the pages, header.html, and footer.html
+SCRIPT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_pages = {
+	'index.psp'       : handlers.index,
+	'login.psp'       : handlers.login,
+	'revoke.psp'      : handlers.revoke,
+	'revoke'          : handlers.revoke,  #(index.psp links to this; under apache, MultiViews finds revoke.psp)
+	'fail_otec.psp'   : handlers.fail_otec,
+	'fail_general.psp': handlers.fail_general,
+	'qrcode.png'      : handlers.download,
+}
+
+def route(name):
+	"""return the handler for the page name, or None (see wsgi.Application)"""
+	if name.endswith('-openauth.zip'): return handlers.download
+	return _pages.get(name)
+
+def makeApplication(script_dir=SCRIPT_DIR, session_dir=None):
+	"""return a wsgi.Application for the site, after setting up this process to serve it"""
+	handlers.init(script_dir)
+	return wsgi.Application(route, script_dir, session_dir)
+
+application = makeApplication()
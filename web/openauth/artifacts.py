@@ -0,0 +1,419 @@
+"""
+building QR codes and zips in a separate pool of processes
+
+DESCRIPTION
+	The artifact service (see misc/artifactd) is a bounded pool of worker
+	processes, behind a unix socket, that builds qrcode.png and
+	USERNAME-openauth.zip for the web server, so that the CPU-heavy part of
+	the continuation page's downloads doesn't tie up the apache children (or
+	WSGI workers) the cheap pages need.
+
+	openauth.getQRCodeBytes() and openauth.getZipChunks() use it when
+	config2.ARTIFACT_SOCKET is set, and build inline, as before, when it's
+	not running.  When it is running but its queue is full they raise Busy,
+	and when a build fails or takes too long they raise ArtifactError,
+	rather than building inline, so that load is shed instead of moved back
+	into the web server.
+
+REQUIREMENTS
+	n/a
+
+IMPLEMENTATION NOTES
+	The service is one process running a select() loop over the listening
+	socket, the clients' connections, and one socketpair per worker.
+	Workers are forked from it after the zip template is loaded, so they
+	share it, and each builds one artifact at a time.  Requests wait for a
+	worker in a FIFO queue of at most queue_max; one that arrives when it's
+	full is answered busy right away.  A request still queued or building
+	timeout seconds after it arrived is answered with a timeout, and the
+	worker building it, if any, is killed and replaced.
+
+	The protocol, for clients and workers alike, is a line of JSON, e.g.
+	{"kind": "zip", "username": "alice"}, answered by a line of JSON,
+	{"ok": true, "length": N, "wait": SECONDS, "build": SECONDS}, followed
+	by N bytes, or {"ok": false, "error": "..."}.  The kind "stats" is
+	answered with the service's metrics (see Service.stats()), as JSON.
+
+	The service reads any user's secret it's asked for, so the socket must
+	only be accessible to the web server's user (it's made mode 0600).
+	What's sent to each client is written with a blocking send (the clients
+	are local, and waiting to read it).
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, time, json, socket, select, signal, errno, collections
+from lilpsp import core
+
+
+#the kinds of artifact built
+KINDS = ('qr', 'zip')
+
+#how many recent jobs of each kind the percentiles in Service.stats() are over
+SAMPLES = 1000
+
+#the most bytes a request line may be
+MAX_REQUEST = 4096
+
+#seconds the service waits on a client to take what it's sent
+SEND_TIMEOUT = 10
+
+
+class ArtifactError(Exception):
+	"""the artifact service failed to build something"""
+	pass
+
+class Busy(ArtifactError):
+	"""the artifact service's queue is full"""
+	pass
+
+
+#--- messages
+
+def _send(sock, header, data=''):
+	"""send a message: header (a dict, to which the length is added), then data"""
+	header = dict(header, length=len(data))
+	sock.sendall('%s\n%s' % (json.dumps(header), data))
+
+class _Buffer(object):
+	"""bytes read from a socket, until there's a whole message"""
+
+	def __init__(self):
+		self.chunks = []
+		self.size = 0
+
+	def feed(self, data):
+		self.chunks.append(data)
+		self.size += len(data)
+
+	def message(self):
+		"""return (header, data) for the first whole message read, removing it, or None if there's not one yet; raises ValueError if it's malformed"""
+		data = ''.join(self.chunks)
+		self.chunks = [data]
+		i = data.find('\n')
+		if i < 0: return None
+		header = json.loads(data[:i])
+		if not isinstance(header, dict): raise ValueError("not a JSON object")
+		end = i + 1 + header.get('length', 0)
+		if len(data) < end: return None
+		self.chunks = [data[end:]]
+		self.size = len(data) - end
+		return header, data[i+1:end]
+
+
+#--- client
+
+def request(path, kind, username, timeout):
+	"""return the bytes of the kind of artifact for the user, built by the service listening on path, or None if it's not running
+
+	Raises Busy if its queue is full, ArtifactError if the build failed or timed out there, and socket.error (socket.timeout) if nothing came back within timeout seconds.
+	"""
+	sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	try:
+		sock.settimeout(timeout)
+		try:
+			sock.connect(path)
+		except socket.error, e:
+			if e.args[0] in (errno.ENOENT, errno.ECONNREFUSED): return None
+			raise
+		_send(sock, {'kind': kind, 'username': username})
+		buf = _Buffer()
+		while True:
+			m = buf.message()
+			if m is not None: break
+			data = sock.recv(256*1024)
+			if not data: raise ArtifactError("the artifact service closed the connection")
+			buf.feed(data)
+	finally:
+		sock.close()
+	header, data = m
+	if not header.get('ok'):
+		if header.get('error')=='busy': raise Busy("the artifact service is busy")
+		raise ArtifactError("the artifact service did not build [%s] for user [%s]: %s" % (kind, username, header.get('error')))
+	return data
+
+def stats(path, timeout=10):
+	"""return the metrics of the service listening on path (see Service.stats())"""
+	return json.loads(request(path, 'stats', '', timeout))
+
+
+#--- workers
+
+def _build(kind, username):
+	import openauth  #(openauth imports this)
+	if kind=='qr': return openauth._getQRCodeBytes(username)
+	size, chunks = openauth._getZipChunks(username)
+	return ''.join(chunks)
+
+def _work(sock):
+	"""build what's asked for on sock until it's closed (in a worker process)"""
+	buf = _Buffer()
+	while True:
+		data = sock.recv(64*1024)
+		if not data: return
+		buf.feed(data)
+		while True:
+			m = buf.message()
+			if m is None: break
+			header = m[0]
+			t0 = time.time()
+			try:
+				data = _build(str(header['kind']), str(header['username']))  #(json gives unicode)
+			except Exception, e:
+				core.log("artifacts: ERROR: failed to build [%s] for user [%s]: %s" % (header['kind'], header['username'], e), e=e)
+				_send(sock, {'ok': False, 'error': 'failed: %s' % e})
+			else:
+				_send(sock, {'ok': True, 'build': time.time() - t0}, data)
+
+class _Worker(object):
+	def __init__(self, pid, sock):
+		self.pid = pid
+		self.sock = sock
+		self.buf = _Buffer()
+		self.job = None
+
+class _Job(object):
+	def __init__(self, conn, kind, username, queued):
+		self.conn = conn
+		self.kind = kind
+		self.username = username
+		self.queued = queued
+		self.started = None
+
+
+#--- service
+
+class Service(object):
+	"""the artifact service (see the module docstring), listening on the unix socket path"""
+
+	def __init__(self, path, workers=2, queue_max=32, timeout=30):
+		self.path = path
+		self.nworkers = workers
+		self.queue_max = queue_max
+		self.timeout = timeout
+		self.clients = {}  #connection -> _Buffer, for connections whose request hasn't all been read
+		self.queue = collections.deque()
+		self.workers = []
+		self.metrics = {}
+		for kind in KINDS:
+			self.metrics[kind] = {'done': 0, 'failed': 0, 'timeout': 0, 'busy': 0, 'wait': collections.deque(maxlen=SAMPLES), 'build': collections.deque(maxlen=SAMPLES)}
+		self.stopped = False
+
+		try:
+			os.remove(path)  #(left by one that didn't exit cleanly)
+		except OSError, e:
+			if e.errno!=errno.ENOENT: raise
+		self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		umask = os.umask(0177)
+		try:
+			self.sock.bind(path)
+		finally:
+			os.umask(umask)
+		self.sock.listen(128)
+		self.sock.setblocking(0)
+
+	#--- workers
+
+	def _fork(self):
+		parent, child = socket.socketpair()
+		pid = os.fork()
+		if pid==0:
+			try:
+				try:
+					signal.signal(signal.SIGTERM, signal.SIG_DFL)
+					signal.signal(signal.SIGINT, signal.SIG_IGN)  #(^C goes to the whole process group; the service stops the workers itself)
+					parent.close()
+					self.sock.close()
+					for s in [ w.sock for w in self.workers ] + self.clients.keys() + [ job.conn for job in self.queue ]:
+						s.close()
+					_work(child)
+				except Exception, e:
+					core.log("artifacts: ERROR: worker failed: %s" % e, e=e)
+			finally:
+				core.flushLog()
+				os._exit(0)
+		child.close()
+		self.workers.append(_Worker(pid, parent))
+
+	def _replace(self, w):
+		"""kill the worker w and start another"""
+		try:
+			os.kill(w.pid, signal.SIGKILL)
+		except OSError:
+			pass
+		os.waitpid(w.pid, 0)
+		w.sock.close()
+		self.workers.remove(w)
+		self._fork()
+
+	def start(self):
+		"""start the workers (load what they share, e.g. the zip template, before calling this)"""
+		while len(self.workers) < self.nworkers:
+			self._fork()
+
+	#--- answering
+
+	def _reply(self, conn, header, data=''):
+		try:
+			conn.setblocking(1)
+			conn.settimeout(SEND_TIMEOUT)
+			_send(conn, header, data)
+		except socket.error, e:
+			core.log("artifacts: failed to answer a client: %s" % e)
+		conn.close()
+
+	def _finish(self, job, header, data=''):
+		"""answer job's client with header and data, and count it"""
+		m = self.metrics[job.kind]
+		if header.get('ok'):
+			m['done'] += 1
+			m['wait'].append(job.started - job.queued)
+			m['build'].append(header['build'])
+			header = {'ok': True, 'wait': job.started - job.queued, 'build': header['build']}
+		elif header.get('error')=='timeout':
+			m['timeout'] += 1
+		else:
+			m['failed'] += 1
+		self._reply(job.conn, header, data)
+
+	def stats(self):
+		"""return a dict of metrics: for each kind, the number done, failed, timed out, and turned away busy, and the median, 95th percentile, and maximum seconds waiting in the queue and building, over the last SAMPLES done; and the number of workers, busy workers, and queued requests"""
+		result = {'workers': len(self.workers), 'building': len([ w for w in self.workers if w.job is not None ]), 'queued': len(self.queue)}
+		for kind, m in self.metrics.items():
+			result[kind] = {'done': m['done'], 'failed': m['failed'], 'timeout': m['timeout'], 'busy': m['busy']}
+			for name in ('wait', 'build'):
+				samples = list(m[name])
+				result[kind][name] = {'p50': core.percentile(samples, 50), 'p95': core.percentile(samples, 95), 'max': max(samples or [None])}
+		return result
+
+	#--- the loop
+
+	def _accept(self):
+		while True:
+			try:
+				conn, address = self.sock.accept()
+			except socket.error, e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+				raise
+			conn.setblocking(0)
+			self.clients[conn] = _Buffer()
+
+	def _readClient(self, conn, now):
+		import openauth  #(openauth imports this)
+		buf = self.clients[conn]
+		try:
+			data = conn.recv(MAX_REQUEST)
+		except socket.error, e:
+			if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+			data = ''
+		try:
+			if not data: raise ValueError("closed")
+			buf.feed(data)
+			m = buf.message()
+			if m is None:
+				if buf.size > MAX_REQUEST: raise ValueError("request too long")
+				return
+		except ValueError:
+			del self.clients[conn]
+			conn.close()
+			return
+		del self.clients[conn]
+		header = m[0]
+		kind, username = header.get('kind'), header.get('username')
+		if kind=='stats':
+			self._reply(conn, {'ok': True}, json.dumps(self.stats()))
+		elif kind not in KINDS or not isinstance(username, basestring) or not openauth.isValidUsername(username):
+			self._reply(conn, {'ok': False, 'error': 'bad request'})
+		elif len(self.queue) >= self.queue_max:
+			self.metrics[kind]['busy'] += 1
+			self._reply(conn, {'ok': False, 'error': 'busy'})
+		else:
+			self.queue.append(_Job(conn, kind, str(username), now))
+
+	def _readWorker(self, w):
+		try:
+			data = w.sock.recv(256*1024)
+		except socket.error, e:
+			if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+			data = ''
+		if not data:
+			core.log("artifacts: ERROR: worker [%d] exited" % w.pid)
+			if w.job is not None: self._finish(w.job, {'ok': False, 'error': 'worker exited'})
+			self._replace(w)
+			return
+		w.buf.feed(data)
+		m = w.buf.message()
+		if m is None: return
+		job, w.job = w.job, None
+		self._finish(job, m[0], m[1])
+
+	def _expire(self, now):
+		"""answer, with a timeout, the jobs that have taken too long"""
+		for w in list(self.workers):
+			if w.job is not None and now - w.job.queued > self.timeout:
+				core.log("artifacts: building [%s] for user [%s] took too long, killing worker [%d]" % (w.job.kind, w.job.username, w.pid))
+				job, w.job = w.job, None
+				job.started = job.started or now
+				self._finish(job, {'ok': False, 'error': 'timeout'})
+				self._replace(w)
+		while self.queue and now - self.queue[0].queued > self.timeout:
+			job = self.queue.popleft()
+			job.started = now
+			self._finish(job, {'ok': False, 'error': 'timeout'})
+
+	def _dispatch(self, now):
+		for w in self.workers:
+			if not self.queue: return
+			if w.job is not None: continue
+			job = self.queue.popleft()
+			job.started = now
+			w.job = job
+			_send(w.sock, {'kind': job.kind, 'username': job.username})
+
+	def serveOnce(self, timeout=1.0):
+		"""wait up to timeout seconds for something to do, and do it"""
+		now = time.time()
+		self._expire(now)
+		self._dispatch(now)
+		deadlines = [ w.job.queued for w in self.workers if w.job is not None ] + [ job.queued for job in self.queue ]
+		if deadlines: timeout = max(0, min(timeout, min(deadlines) + self.timeout - now))
+		byworker = dict([ (w.sock, w) for w in self.workers ])
+		try:
+			r, w, x = select.select([self.sock] + self.clients.keys() + byworker.keys(), [], [], timeout)
+		except select.error, e:
+			if e.args[0]!=errno.EINTR: raise
+			return
+		now = time.time()
+		for s in r:
+			if s is self.sock       : self._accept()
+			elif s in self.clients  : self._readClient(s, now)
+			elif byworker.has_key(s): self._readWorker(byworker[s])
+		self._dispatch(now)
+
+	def run(self):
+		"""start the workers and serve until stopped is set"""
+		self.start()
+		while not self.stopped:
+			self.serveOnce()
+
+	def close(self):
+		"""stop the workers and stop listening"""
+		for w in self.workers:
+			w.sock.close()
+			try:
+				os.kill(w.pid, signal.SIGTERM)
+			except OSError:
+				pass
+			os.waitpid(w.pid, 0)
+		self.workers = []
+		for job in self.queue:
+			job.conn.close()
+		for conn in self.clients:
+			conn.close()
+		self.sock.close()
+		try:
+			os.remove(self.path)
+		except OSError:
+			pass
@@ -0,0 +1,219 @@
+"""
+integrity checks of the secrets tree
+
+DESCRIPTION
+	Fix up the metadata of the secrets tree that replication (e.g. a hung or
+	killed rsync, or a failover race) can leave wrong: directories and files
+	not owned by OWNER:GROUP or not mode DIR_MODE/FILE_MODE, and leftover
+	temporary secret files (pam_google_authenticator's s~, and this
+	package's own .s.* files) older than STALE_SECONDS.  This replaces the
+	find/stat/chown/chmod loops of the old fix_openauth_sync_fails script;
+	see misc/fix_openauth_sync_fails for the command-line wrapper.
+
+	Each action is reported (and, unless dry_run, taken) as it is found;
+	check() returns a summary.
+
+REQUIREMENTS
+	scandir module, if available and not on python 3.5+ (optional, it's just
+	faster)
+
+IMPLEMENTATION NOTES
+	The tree is walked once, and each entry is lstat'ed once; everything is
+	decided from that one stat result.
+
+	With a state file, only directories that changed since the last run are
+	looked into.  A directory's mtime changes whenever an entry in it is
+	added, removed, or renamed -- which is what a replication does -- so a
+	directory whose mtime is unchanged is not listed again, and its files
+	are not stat'ed again (the directory itself still is, to check it, and
+	its subdirectories are still visited).  Directories with a temporary
+	file that was not old enough to remove yet, or a file that could not be
+	fixed, or that changed during the run, are always looked into again next
+	time.  Metadata changed in place
+	(e.g. a chmod by hand) is only noticed by a full run, which happens when
+	there is no state yet, or when asked for (e.g. weekly).
+
+	Only one check runs at a time; a second one fails right away (an flock
+	on the state file's lock file).
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import sys, os, stat, time, json, fcntl, pwd, grp
+
+try:
+	from os import scandir  #(python 3.5+)
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+#Something that imports this module may choose to change these values.
+
+#OWNER, GROUP -- who must own everything in the tree
+OWNER = 'apache'
+GROUP = 'apache'
+
+#DIR_MODE, FILE_MODE -- the permission bits directories and files must have
+DIR_MODE = 0770
+FILE_MODE = 0400
+
+#STALE_SECONDS -- temporary files older than this are removed (younger ones may be in use)
+STALE_SECONDS = 60
+
+
+#--- internal helpers
+
+def _isTempFile(name):
+	"""return whether name is a temporary secret file (pam_google_authenticator's s~, or one of openauth._writeSecretFile()'s)"""
+	return name=='s~' or name.startswith('.s.')
+
+def _entries(path):
+	"""return a list of (name, is a real directory (not a symlink)) for the entries of directory path"""
+	if scandir is not None:
+		return [ (e.name, e.is_dir(follow_symlinks=False)) for e in scandir(path) ]
+	entries = []
+	for name in os.listdir(path):
+		try:
+			entries.append((name, stat.S_ISDIR(os.lstat(os.path.join(path, name)).st_mode)))
+		except OSError:  #(removed since it was listed)
+			pass
+	return entries
+
+class _Check(object):
+	"""one run over the tree"""
+
+	def __init__(self, root, state, dry_run, out):
+		self.root = root
+		self.old = state  #relative dir path -> [mtime, [subdir names]]
+		self.new = {}
+		self.dry_run = dry_run
+		self.out = out
+		self.uid = pwd.getpwnam(OWNER).pw_uid
+		self.gid = grp.getgrnam(GROUP).gr_gid
+		self.t0 = time.time()
+		self.counts = {'dirs': 0, 'dirs_listed': 0, 'files': 0, 'chown': 0, 'chmod': 0, 'rm': 0, 'errors': 0}
+
+	def act(self, what, path, f, *args):
+		"""report, and unless dry_run, do f(path, *args); return False if it failed"""
+		self.counts[what] += 1
+		if self.dry_run: self.out.write('(dry run) %s %s\n' % (what, path))
+		else           : self.out.write('+ %s %s\n' % (what, path))
+		if not self.dry_run:
+			try:
+				f(path, *args)
+			except OSError, e:
+				self.counts['errors'] += 1
+				self.out.write('ERROR: %s %s: %s\n' % (what, path, e))
+				return False
+		return True
+
+	def checkMeta(self, path, st, mode):
+		"""fix the owner and mode of path; return False if that failed"""
+		ok = True
+		if st.st_uid!=self.uid or st.st_gid!=self.gid:
+			if not self.act('chown', path, os.lchown, self.uid, self.gid): ok = False
+		if stat.S_IMODE(st.st_mode)!=mode:
+			if not self.act('chmod', path, os.chmod, mode): ok = False
+		return ok
+
+	def checkFile(self, path):
+		"""check one file; return whether it must be looked at again later (it's a temporary file, or fixing it failed)"""
+		try:
+			st = os.lstat(path)
+		except OSError:  #(removed since it was listed)
+			return False
+		if not stat.S_ISREG(st.st_mode): return False
+		self.counts['files'] += 1
+		if _isTempFile(os.path.basename(path)):
+			if self.t0 - st.st_mtime > STALE_SECONDS:
+				return not self.act('rm', path, os.remove)
+			return True
+		return not self.checkMeta(path, st, FILE_MODE)
+
+	def checkDir(self, relpath):
+		path = os.path.join(self.root, relpath)
+		try:
+			st = os.lstat(path)
+		except OSError:  #(removed since it was listed)
+			return
+		self.counts['dirs'] += 1
+		if relpath!='': self.checkMeta(path, st, DIR_MODE)
+
+		old = self.old.get(relpath)
+		if old is not None and old[0]==st.st_mtime:
+			subdirs = old[1]
+			clean = True
+		else:
+			self.counts['dirs_listed'] += 1
+			subdirs = []
+			clean = self.t0 - st.st_mtime > 2  #(a change within the mtime's granularity of now might be missed)
+			try:
+				entries = _entries(path)
+			except OSError:
+				return
+			for name, isdir in sorted(entries):
+				if isdir: subdirs.append(name)
+				elif self.checkFile(os.path.join(path, name)): clean = False
+		if clean: self.new[relpath] = [st.st_mtime, subdirs]
+		for name in subdirs:
+			self.checkDir(os.path.join(relpath, name))
+
+def _loadState(state_file, root):
+	try:
+		f = open(state_file)
+	except IOError:
+		return {}
+	try:
+		try:
+			state = json.load(f)
+		except ValueError:
+			return {}
+	finally:
+		f.close()
+	if state.get('root')!=root: return {}
+	return state['dirs']
+
+def _saveState(state_file, root, dirs):
+	tmpname = '%s.%d' % (state_file, os.getpid())
+	f = open(tmpname, 'w')
+	try:
+		json.dump({'root': root, 'dirs': dirs}, f)
+	finally:
+		f.close()
+	os.rename(tmpname, state_file)
+
+
+#--- main methods
+
+def check(root, state_file=None, full=False, dry_run=False, out=sys.stderr):
+	"""check (and fix, unless dry_run) the tree under root, reporting each action to out; return a dict summarizing what was done
+
+	With state_file, only directories that changed since the last (non-dry) run are looked into, unless full (see the module docstring).
+	Raises an Exception if another check holding the same state file is already running.
+	"""
+	root = os.path.abspath(root)
+	if state_file is not None: lockname = '%s.lock' % state_file
+	else                     : lockname = os.path.join('/tmp', '.openauth-checker-%d.lock' % os.getuid())
+	lock = open(lockname, 'a')
+	try:
+		try:
+			fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+		except IOError:
+			raise Exception("another check is already running (lock [%s] is held)" % lockname)
+
+		state = {}
+		if state_file is not None and not full: state = _loadState(state_file, root)
+		c = _Check(root, state, dry_run, out)
+		c.checkDir('')
+		if state_file is not None and not dry_run: _saveState(state_file, root, c.new)
+	finally:
+		lock.close()  #(releases the flock)
+
+	summary = dict(c.counts)
+	summary['full'] = not state
+	summary['seconds'] = time.time() - c.t0
+	return summary
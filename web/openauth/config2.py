@@ -20,16 +20,45 @@ import os
 #common parent directory for pretty much everything
 ROOT_DIR = '/n/openauth'
 
+#how to generate new secrets
+#choose one of:
+#	'python' -- generate the secret file in-process (same format as google-authenticator writes)
+#	'google-authenticator' -- run the google-authenticator program (see GABIN below)
+SECRET_GENERATOR = 'python'
+
 #directory containing the google-authenticator binary
 #this is prepended to PATH; set it to None if already in the PATH
+#(only used if SECRET_GENERATOR is 'google-authenticator')
 GABIN    = os.path.join(ROOT_DIR, 'sw', 'google-authenticator', 'usr', 'bin')
 
 #directory containing the qrencode binary
 #this is prepended to PATH; set it to None if already in the PATH
+#(only used if QR_ENCODER is 'qrencode')
 QRBIN    = os.path.join(ROOT_DIR, 'sw', 'qrencode', 'bin')
 
+#how to render QR codes
+#choose one of:
+#	'python' -- encode in-process (see qr.py)
+#	'qrencode' -- run the qrencode program (see QRBIN above)
+QR_ENCODER = 'python'
+
+#error correction level for the in-process QR encoder, 'L' or 'M' (qrencode's default is 'L')
+QR_ECC_LEVEL = 'L'
+
+#rendered QR code images are cached in each process, keyed on the otpauth uri
+#this is the maximum number of images kept and the number of seconds each is kept
+QR_CACHE_SIZE = 256
+QR_CACHE_TTL  = 300
+
+#parsed secret files are cached in each process, and used only while the file's mtime, size, and inode are unchanged
+#(those are checked on an open file each time, so on NFS a revoke or rotation on another host is seen right away, not after the attribute cache times out)
+#this is the maximum number of files kept and the number of seconds each is kept
+SECRET_CACHE_SIZE = 1024
+SECRET_CACHE_TTL  = 60
+
 #path to the java jar binary
 #this is prepended to PATH; set it to None if already in the PATH
+#(only used if ZIP_BUILDER is 'shell')
 JARBIN   = '/n/sw/jdk1.6.0_23/bin'
 
 #place where all the secrets are to be kept
@@ -39,9 +68,92 @@ SECRETS_ROOT_DIR = os.path.join(ROOT_DIR, 'secrets', 'default')
 #the filename to use for the output of the google-authenticator secret generator
 SECRET_FILE_BASENAME = 's'
 
+#how user directories are arranged in SECRETS_ROOT_DIR
+#choose one of:
+#	'flat' -- SECRETS_ROOT_DIR/USERNAME/s
+#	'hashed' -- SECRETS_ROOT_DIR/ab/cd/USERNAME/s, where abcd are the first four hex digits of the md5 of USERNAME (for tens of thousands of users)
+#secrets not yet in this layout are still found in the other one; use misc/migrate_secrets to move them
+#anything else that reads the secrets (e.g. the pam config on the RADIUS servers) must find them in the same layout
+SECRETS_LAYOUT = 'flat'
+
+#when changes to the secrets directories (secret files renamed into place or removed, user directories made or removed) are fsync'ed, i.e. sure to survive a crash:
+#	'write' -- right away, so each change is on disk when the call making it returns (one more round trip per change, on NFS)
+#	'batch' -- only when openauth.flushSecretWrites() is called (misc/secretctl does so after each progress report, misc/replicad after each set of copies), and at exit
+#	'time' -- at most SECRET_FSYNC_SECONDS after the change, along with every other change made in the meantime
+#a secret file's contents are always fsync'ed before it's renamed into place, so after a crash a user has either the old secret or the new one, whichever the policy, never a partial one
+SECRET_FSYNC = 'write'
+SECRET_FSYNC_SECONDS = 1.0
+
+#a packed copy of all the secret files, mapped into memory by every process that reads secrets (see snapshot.py), or None to not use one
+#build it (and rebuild it, e.g. every few minutes from cron) with misc/secret_snapshot; it must be on local disk, and only readable by the users that read the secrets
+#secrets changed since it was built are still read from their files, so a stale snapshot is only slower, never wrong
+SECRET_SNAPSHOT_FILE = None
+
+#where misc/replicad keeps a local copy of SECRETS_ROOT_DIR (see replica.py), e.g. hadir's local cache
+#it's kept in SECRETS_LAYOUT; changes are copied as they're seen, and a scan every REPLICA_SCAN_SECONDS finds the rest (make that short when SECRETS_ROOT_DIR is on NFS)
+SECRETS_REPLICA_DIR = '/var/lib/openauth/secrets'
+REPLICA_SCAN_SECONDS = 10
+
+#the RADIUS clients misc/radiusd answers, one "IP_ADDRESS SHARED_SECRET" per line (see radius.py)
+#this must only be readable by whoever runs misc/radiusd
+RADIUS_CLIENTS_FILE = os.path.join(ROOT_DIR, 'etc', 'radius_clients')
+
+#where misc/fix_openauth_sync_fails remembers the secrets tree from its last run, so it only looks at what changed (see checker.py)
+#this should be on local disk, and writable by whoever runs that from cron
+CHECKER_STATE_FILE = '/var/lib/openauth/checker.state'
+
+#how to build the zip of the JAuth client
+#choose one of:
+#	'python' -- build it in memory from a copy of ZIP_CONTENTS_DIR loaded once per process (see jauth.py)
+#	'shell' -- copy ZIP_CONTENTS_DIR to a temporary directory and run rsync, jar, and zip (see JARBIN above)
+ZIP_BUILDER = 'python'
+
 #directory containing the starting contents for the zip of the JAuth client
 ZIP_CONTENTS_DIR = os.path.join(ROOT_DIR, 'sw', 'web', 'openauth_zip_starter')
 
 #the client code download has the secret embedded
 #this is the placeholder that must be subsituted with the real secret on a per-user basis
 SECRET_PLACEHOLDER = 'WVTLMS2BRKCY3X5A'
+
+#how to store the one-time, expiring codes used for continuation links and downloads (see otec.py)
+#choose one of:
+#	'dir' -- one file per code, in ROOT_DIR/otec
+#	'sqlite' -- one SQLite database, OTEC_DB
+OTEC_BACKEND = 'dir'
+
+#the otec database file, if OTEC_BACKEND is 'sqlite'
+#this must be on local disk, not a network filesystem (so codes are only good on the web server that made them)
+OTEC_DB = '/var/lib/openauth/otec.sqlite'
+
+#if non-zero, sweep out some expired otecs every this many new ones (for deployments not running misc/otecctl from cron)
+OTEC_SWEEP_EVERY = 0
+
+#the database of rate limit buckets (see ratelimit.py), or None to not limit request rates
+#this must be on local disk, not a network filesystem (so the limits are per web server)
+RATE_LIMIT_DB = None
+
+#the rate limit of each flow, per user and per client address, as (burst, seconds per request):
+#	'email' -- index.psp without an otec, which makes an otec and emails the continuation link
+#	'page' -- index.psp with an otec, and revoke.psp
+#	'download' -- qrcode.png and the zip
+#a request over the limit gets 429 Too Many Requests, before any otec or secret work is done
+RATE_LIMITS = {
+	'email'   : {'user': (3, 10*60), 'ip': (20, 60)},
+	'page'    : {'user': (10, 30), 'ip': (60, 1)},
+	'download': {'user': (10, 30), 'ip': (60, 1)},
+}
+
+#how many zip builds and mail sends may run at once on each web server, and the directory of the lock files that bound them (None to not bound them)
+#a request that gets no slot within RATE_SLOT_WAIT seconds is turned away with a message to try again
+RATE_SLOTS_DIR = None
+RATE_SLOTS = {'zip': 4, 'mail': 4}
+RATE_SLOT_WAIT = 5.0
+
+#the unix socket of the artifact service (misc/artifactd, see artifacts.py), which builds the QR code images and zips in its own pool of processes, or None to build them in the web server's processes
+#while it's not running, they're built in the web server's processes, as if this were None
+ARTIFACT_SOCKET = None
+
+#how many processes the artifact service builds with, how many requests may wait for one (more are turned away busy), and the seconds a request may take, waiting and building, before it's given up on
+ARTIFACT_WORKERS = 2
+ARTIFACT_QUEUE_MAX = 32
+ARTIFACT_TIMEOUT = 30
@@ -0,0 +1,767 @@
+"""
+the pages of the site
+
+DESCRIPTION
+	Each page is a function taking (req, session, form), which writes the
+	whole response, and handles all exceptions itself.  The .psp pages and
+	openauth.downloadHandler() just call these with mod_python's objects; the
+	WSGI application (app.py) calls them with lilpsp.wsgi's.  Nothing here uses
+	mod_python directly -- ending a request early goes through core.redirect()
+	and core.serverReturn().
+
+	init() sets up what every request would otherwise redo (the otec and rate
+	limit settings, header.html and footer.html, the zip template, and, for
+	form logins, the LDAP connections); a worker should call it once when it
+	starts, but the pages call it anyway if it has not been.
+
+	Every page but login.psp takes a token from a rate limit bucket (see
+	ratelimit.py and config2.RATE_LIMITS) right after the session check,
+	before any otec or secret work, and answers 429 Too Many Requests with a
+	short message if there is none.  Zip builds and mail sends also each
+	need one of a bounded number of slots (config2.RATE_SLOTS), and are
+	turned away with a "try again" message if none frees up soon.  So are
+	downloads when the artifact service (see artifacts.py) is too busy.
+
+REQUIREMENTS
+	n/a
+
+IMPLEMENTATION NOTES
+	header.html and footer.html are read once per process, so changes to them
+	take a restart (of apache, or of the WSGI server) to show up.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, time, urllib
+from lilpsp import config, core, org
+import config2, org2, otec, openauth, jauth, ratelimit, artifacts
+
+
+class BreakOut(Exception): pass
+
+
+#--- setup
+
+_initialized = False
+_html = {}  #path -> contents, for header.html and footer.html
+
+def init(base_fs_dir=None):
+	"""set up this process to serve pages (see the module docstring); base_fs_dir, if given, is the directory with header.html and footer.html, to read them now"""
+	global _initialized
+	if not _initialized:
+		otec.BACKEND = config2.OTEC_BACKEND
+		otec.OTEC_DIR = os.path.join(config2.ROOT_DIR, 'otec')
+		otec.OTEC_DB = config2.OTEC_DB
+		otec.SWEEP_EVERY = config2.OTEC_SWEEP_EVERY
+		otec.DEBUG = config.DEBUG
+		ratelimit.DB = config2.RATE_LIMIT_DB
+		ratelimit.LIMITS = config2.RATE_LIMITS
+		ratelimit.SLOTS_DIR = config2.RATE_SLOTS_DIR
+		ratelimit.SLOTS = config2.RATE_SLOTS
+		ratelimit.SLOT_WAIT = config2.RATE_SLOT_WAIT
+		if config2.ZIP_BUILDER=='python':
+			try:
+				jauth.getTemplate(config2.ZIP_CONTENTS_DIR, config2.SECRET_PLACEHOLDER)
+			except Exception, e:
+				msg = "ERROR: failed to load the zip template from [%s]: %s" % (config2.ZIP_CONTENTS_DIR, e)
+				core.log(msg, e=e)
+		if config.AUTH_TYPE=='FORM': org.warmLDAP()
+		_initialized = True
+	if base_fs_dir is not None:
+		for name in ('header.html', 'footer.html'):
+			_readHTML(base_fs_dir, name)
+
+def _readHTML(base_fs_dir, name):
+	"""return the contents of the file name in base_fs_dir, read only the first time"""
+	path = os.path.join(base_fs_dir, name)
+	html = _html.get(path)
+	if html is None:
+		f = open(path)
+		try:
+			html = _html[path] = f.read()
+		finally:
+			f.close()
+	return html
+
+
+#--- template
+
+class _Page(object):
+	"""what a page body has to work with"""
+
+	def __init__(self, req, session, form, event):
+		self.req = req
+		self.session = session
+		self.form = form
+		self.event = event
+		self.base_url_dir = os.path.dirname(req.subprocess_env['SCRIPT_URI'])  #e.g. 'https://SERVER/PATH/'
+		self.base_fs_dir  = os.path.dirname(req.subprocess_env['SCRIPT_FILENAME'])
+		self.wrote_header = False
+		self.wrote_footer = False
+
+	def write(self, text):
+		self.req.write(text)
+
+	def writeHeader(self):
+		self.req.write(_readHTML(self.base_fs_dir, 'header.html'))
+		self.wrote_header = True
+
+	def writeFooter(self):
+		self.req.write(_readHTML(self.base_fs_dir, 'footer.html'))
+		self.wrote_footer = True
+
+def _tooMany(req, session, flow, event):
+	"""take a token for flow (see ratelimit.admit()); if there is none, set the response status to 429, log it, and return the seconds to wait, else return None"""
+	wait = ratelimit.admit(flow, core.getUsername(session, req), req.subprocess_env['REMOTE_ADDR'])
+	if wait is None: return None
+	wait = int(wait) + 1
+	req.status = 429
+	req.headers_out['Retry-After'] = str(wait)
+	msg = "rate limited [%s] from ip [%s] for user [%s], retry in %ds" % (flow, req.subprocess_env['REMOTE_ADDR'], core.getUsername(session, req), wait)
+	core.log(msg, session, req)
+	event.set('rate_limited', flow)
+	return wait
+
+def _page(req, session, form, body, check_session=True, flow=None):
+	"""run body(page), where page is a _Page, wrapped in everything every page does: logging, the session check, the rate limit for flow (if given), the event, the header and footer (the header is written before body() is called, unless check_session is False, in which case body() must write it), and error handling
+
+	body() may raise BreakOut to skip to the footer.
+	"""
+	page = None
+	event = None
+	try:
+		try:
+			init()
+
+			req.add_common_vars()
+
+			msg = "request from ip [%s] from user [%s]" % (req.subprocess_env['REMOTE_ADDR'], core.getUsername(session, req))
+			core.log(msg, session, req)
+			event = core.Event(os.path.basename(req.filename), session, req)
+
+			if check_session: core.sessionCheck(session, req)
+
+			page = _Page(req, session, form, event)
+
+			if flow is not None:
+				wait = _tooMany(req, session, flow, event)
+				if wait is not None:
+					page.writeHeader()
+					page.write(org2.errmsg_too_many(session, req, wait))
+					raise BreakOut()
+
+			if check_session: page.writeHeader()
+
+			body(page)
+		except BreakOut:
+			pass
+
+		page.writeFooter()
+	except core.serverReturn(req):
+		##if it's re-raised, sessions start over; passing seems wrong but it's the only way I know of to make sessions persist across redirect
+		#raise
+		pass
+	except Exception, e:
+		if page is None:
+			raise  #just bailout and let the server handle it (if configured with PythonDebug On, the traceback will be shown to the user)
+		else:
+			msg = "ERROR: uncaught exception when handling user [%s]: %s" % (core.getUsername(session, req), e)
+			core.log(msg, session, req, e)
+			if not page.wrote_header: page.writeHeader()
+			req.write(org.errmsg_general(session, req))
+			if not page.wrote_footer: page.writeFooter()
+			event.set('error', str(e))
+
+	if event is not None: event.emit()
+
+def _failPage(req, session, errmsg):
+	"""write a page with just the given error message (a function taking (session, req)), for when other pages redirect to one"""
+	try:
+		init()
+		req.add_common_vars()
+		msg = "request from ip [%s] from user [%s]" % (req.subprocess_env['REMOTE_ADDR'], core.getUsername(session, req))
+		core.log(msg, session, req)
+	except Exception:
+		pass
+	base_fs_dir = os.path.dirname(req.subprocess_env['SCRIPT_FILENAME'])
+	req.write(_readHTML(base_fs_dir, 'header.html'))
+	try:
+		if config.AUTH_TYPE=='FORM': req.write(org.html_logout_link(session, req))
+		req.write(errmsg(session, req))
+	except Exception:
+		req.write("<h3>ERROR</h3>")
+	req.write(_readHTML(base_fs_dir, 'footer.html'))
+
+
+#--- pages
+
+def index(req, session, form):
+	"""the main page (index.psp): sends the continuation link email, and, when following it, displays the secret key information"""
+	if form.has_key('otec'): flow = 'page'
+	else                   : flow = 'email'
+	_page(req, session, form, _index, flow=flow)
+
+def _index(p):
+	req, session, form, event = p.req, p.session, p.form, p.event
+
+	base_url = req.subprocess_env['SCRIPT_URI']  #e.g. 'https://SERVER/PATH/'
+	if base_url.endswith('index.psp'): base_url = base_url[:-len('index.psp')]
+
+	username = core.getUsername(session, req)
+	if username is None:
+		raise Exception("internal error: openauth must be behind some compatible authentication wall")
+
+	if config.AUTH_TYPE=='FORM': p.write(org.html_logout_link(session, req))
+
+	if not form.has_key('otec'):
+		try:
+			event.begin('email_lookup')
+			email = org.getEmailAddress(username)
+			event.end('email_lookup')
+		except Exception, e:
+			msg = "failed to get email address for user [%s]: %s" % (username, e)
+			core.log(msg, session, req)
+			p.write(org2.errmsg_no_email(session, req))
+			raise BreakOut()
+
+		lifetime = 60*60*24*1  #seconds
+		expiration = int(time.time()+lifetime)
+		try:
+			event.begin('otec_create')
+			code = otec.new(expiration, '%s-' % username)
+			event.end('otec_create')
+			msg = "created otec [%s] for user [%s]" % (code, username)
+			core.log(msg, session, req)
+		except Exception, e:
+			msg = "ERROR: failed to create otec for user [%s]: %s" % (username, e)
+			core.log(msg, session, req, e)
+			p.write(org.errmsg_general(session, req))
+			raise BreakOut()
+
+		url = '%s?otec=%s' % (base_url, code)
+		subject = org2.otec_email_subject(session, req)
+		body = """\
+%s
+
+%s
+
+This link will expire on:
+
+%s
+
+%s
+""" % (org2.otec_email_body_header(session, req), url, time.ctime(expiration), org2.otec_email_body_footer(session, req))
+		slot = ratelimit.Slot('mail')
+		event.begin('mail_wait')
+		if not slot.acquire():
+			msg = "no mail slot came free for user [%s], turned away" % username
+			core.log(msg, session, req)
+			event.set('busy', 'mail')
+			p.write(org2.errmsg_busy(session, req))
+			raise BreakOut()
+		event.end('mail_wait')
+		try:
+			try:
+				event.begin('mail_send')
+				core.sendEmail(email, subject, body, fromEmailAddress=org.support_email_address)
+				event.end('mail_send')
+			except Exception, e:
+				msg = "ERROR: failed to send otec link email to user [%s] at [%s]: %s" % (username, email, e)
+				core.log(msg, session, req, e)
+				p.write(org.errmsg_general(session, req))
+				raise BreakOut()
+		finally:
+			slot.release()
+
+		msg = "emailed otec [%s] to [%s] for user [%s]" % (code, email, username)
+		core.log(msg, session, req)
+
+		p.write("""
+			%s
+
+			%s
+
+			<p>
+			As an added layer of security during this sensitive step, an email has been sent to:
+			</p>
+			<pre>        %s</pre>
+			<p>
+			with the link needed to continue.
+			The link will expire on %s.
+			</p>
+			<p>
+			<em>Please wait for that email and follow that link.</em>
+			</p>
+""" % (org2.greeting(session, req), org2.intro(session, req), email, time.ctime(expiration).replace(' ','&nbsp;')))
+		return
+
+	code = str(form['otec'])
+	if not otec.isValid(code) or not code.startswith(username):
+		#(it may not even exist)
+		msg = "expired, invalid, or unprovided otec for user [%s]: %s" % (username, code)
+		core.log(msg, session, req)
+		p.write(org2.errmsg_bad_otec(session, req))
+		raise BreakOut()
+
+	msg = "accepted otec [%s] for user [%s]" % (code, username)
+	core.log(msg, session, req)
+
+	new_secret = True  #(maybe)
+	if not openauth.secretFileExists(username):
+		msg = "no secret found for user [%s], making one" % username
+		core.log(msg, session, req)
+		try:
+			event.begin('secret_generate')
+			openauth.makeSecretFile(username)
+			event.end('secret_generate')
+		except Exception, e:
+			msg = "ERROR: failed to make secret file for user [%s]: %s" % (username, e)
+			core.log(msg, session, req, e)
+			p.write(org.errmsg_general(session, req))
+			raise BreakOut()
+	else:
+		new_secret = False
+		msg = "using existing secret for user [%s]" % username
+		core.log(msg, session, req)
+
+	try:
+		lifetime_qr = 120  #seconds (this otec is for an image included in this page, it's lifetime should only be the maximum amount of time it might take to load this page)
+		lifetime_oa = 60*30  #seconds (this otec is for the zip file download, so needs to be long enough for the user to read the page and decide to download it)
+		now = time.time()
+		event.begin('otec_create')
+		code_qr, code_oa = otec.newMany([
+			(int(now+lifetime_qr), '%s-qr-' % username),
+			(int(now+lifetime_oa), '%s-oa-' % username),
+		])
+		event.end('otec_create')
+		msg = "created otec for qrcode.png [%s] for user [%s]" % (code_qr, username)
+		core.log(msg, session, req)
+		msg = "created otec for zip file [%s] for user [%s]" % (code_oa, username)
+		core.log(msg, session, req)
+	except Exception, e:
+		msg = "ERROR: failed to create otecs for qrcode.png and zip file for user [%s]: %s" % (username, e)
+		core.log(msg, session, req, e)
+		p.write(org.errmsg_general(session, req))
+		raise BreakOut()
+
+	p.write(org2.greeting(session, req))
+	if new_secret:
+		p.write("""
+			<p>
+			A new openauth secret key has been generated for your account.
+			You now must load your mobile device with this secret key or download a customized desktop application that contains this secret key.
+""")
+	else:
+		revoke_url = os.path.join(base_url, 'revoke')
+		p.write("""
+			<p>
+			You already have an openauth secret key associated with your account.
+			The information below lets you configure another device to use this key without stopping your previous devices from working.
+			If you have lost or insecurely handled the device on which you have had your secret key, or otherwise wish to create a new secret key, go to <a href="%s">%s</a> to revoke your secret key.
+""" % (revoke_url, revoke_url))
+
+	secret = openauth.getSecret(username)
+	p.write("""
+			</p>
+			<br /><!--(because our paragraph margin-* css is off; remove on other sites)-->
+			<p>
+			Please pick the most convenient method for you below.
+			</p>
+			<p>
+			<em>When finished, close your browser in order to fully log out of this site.</em>
+			</p>
+
+			<h3>Mobile Device with Camera</h3>
+			<ol>
+				<li>
+					Download the Google-Authenticator app from the <a href="http://itunes.apple.com/us/app/google-authenticator/id388497605?mt=8">Apple App Store</a> or <a href="https://play.google.com/store/apps/details?id=com.google.android.apps.authenticator2">Google Play</a>.
+				</li>
+				<li>
+					Open the app, tap the button to add an account or the + symbol to add a key, and tap the button to scan in the code rather than enter it manually.
+					You may be prompted to install a QR code reader such as ZXing scanner; do this.
+				</li>
+				<li>
+					Point your device's camera at the following QR code:
+					<br />
+					<img src="qrcode.png?otec=%(code_qr)s" />
+				</li>
+			</ol>
+
+			<h3>Desktop Application</h3>
+			<p>
+			The desktop application requires <code>java</code>, which you can get at <a href="http://www.java.com/">http://www.java.com/</a> or through your system's software package manager.
+			You must have version 1.6 or newer.
+			</p>
+			<br /><!--(because our paragraph margin-* css is off; remove on other sites)-->
+			<p>
+			Download <a href="%(username)s-openauth.zip?otec=%(code_oa)s">%(username)s-openauth.zip</a> and unzip it in a convenient location that you will be able to find later.
+			There is nothing to install &mdash; each time you need to launch the application, just double-click <code>JAuth.jar</code>.
+			If you prefer launching from the command-line, there are also the scripts <code>%(username)s-openauth.sh</code> (if you use a Mac or Linux) and <code>%(username)s-openauth.bat</code> (if you use Windows).
+			</p>
+			<br /><!--(because our paragraph margin-* css is off; remove on other sites)-->
+			<p>
+			If you prefer a more conventional installation program, you can use <a href="JAuth_windows_1_0.exe">JAuth_windows_1_0.exe</a> (for Windows), <a href="JAuth_macos_1_0.dmg">JAuth_macos_1_0.dmg</a> (for Mac), or <a href="JAuth_unix_1_0.sh">JAuth_unix_1_0.sh</a> (for Linux) instead of downloading the above zip file.
+			<em>However, you will have to enter your secret key manually</em> &mdash; your secret key is <code>%(secret)s</code>.
+			</p>
+			<p>
+			Also, with the gui installer, Mac OSX 10.8 Mountain Lion users may receive a message saying the app cannot be opened, as it's from an unknown developer.
+			In that case you will need to open the app differently the first time you run it:
+			</p>
+			<ul>
+				<li>Hold down <em>Control</em> and click on the app icon</li>
+				<li>From the popup menu, select <em>Open</em></li>
+				<li>Another message will appear asking if you're sure</li>
+				<li>Click the <em>Open</em> button to continue and open the app</li>
+				<li>From here on, the app will be allowed to open normally</li>
+			</ul>
+			<br /><!--(because our paragraph margin-* css is off; remove on other sites)-->
+			<p>
+			Note that openauth uses a time-based algorithm.
+			<em>Your computer's clock must be in sync with official time</em> in order for this to work consistently.
+			%(extra_info_on_time_skew)s
+			</p>
+			<br /><!--(because our paragraph margin-* css is off; remove on other sites)-->
+			<p>
+			This application is specifically customized to your identity and contains a secret key only you should have.
+			Do <em>NOT</em> share it with anyone else.
+			<!-- If you lose this file, you can get it again by coming back to <a href="%(base_url)s">%(base_url)s</a> and going through the same email verification process. -->
+			</p>
+
+			<h3>Other</h3>
+			<p>
+			If you have an iOS or Android device without a camera, have a broken camera, are using the alternative installers above, or have some other client that implements <a href="http://tools.ietf.org/html/rfc6238">TOTP</a>, you will need to enter your secret key manually.
+			Your secret key is:
+			</p>
+			<br /><!--(because our paragraph margin-* css is off; remove on other sites)-->
+			<p>
+			<code>%(secret)s</code>
+			</p>
+			<br /><!--(because our paragraph margin-* css is off; remove on other sites)-->
+			<p>
+			Treat this string as carefully as you would your normal password.
+			</p>
+
+			<br />
+			%(outro)s
+""" % {
+		'code_qr': code_qr,
+		'code_oa': code_oa,
+		'username': username,
+		'secret': secret,
+		'base_url': base_url,
+		'extra_info_on_time_skew': org2.extra_info_on_time_skew(session, req),
+		'outro': org2.outro(session, req),
+	})
+
+	try:
+		otec.delete(code)
+		msg = "deleted otec [%s] for user [%s]" % (code, username)
+		core.log(msg, session, req)
+	except Exception, e:
+		msg = "ERROR: failed to delete otec [%s] for user [%s]: %s" % (code, username, e)
+		core.log(msg, session, req, e)
+		pass  #everything else worked, and the user is good to go; the otec will expire anyways
+	msg = "SUCCESS for user [%s]" % username
+	core.log(msg, session, req)
+	event.set('success', True)
+
+def revoke(req, session, form):
+	"""secret revocation (revoke.psp): warns the user, then, with confirm=n in the query string, does the deletion"""
+	_page(req, session, form, _revoke, flow='page')
+
+def _revoke(p):
+	req, session, form, event = p.req, p.session, p.form, p.event
+
+	username = core.getUsername(session, req)
+	if username is None:
+		raise Exception("internal error: openauth must be behind some compatible authentication wall")
+
+	if config.AUTH_TYPE=='FORM': p.write(org.html_logout_link(session, req))
+
+	p.write(org2.greeting(session, req))
+
+	if not openauth.secretFileExists(username):
+		msg = "user [%s] tried to revoke but there is no secret to revoke" % username
+		core.log(msg, session, req)
+		p.write("""
+			<p>
+			There are already no openauth credentials associated with your account.
+			</p>
+""")
+	elif not (form.has_key('confirm') and form['confirm'].startswith('n')):
+		p.write("""
+			<h1><span style='color:red;'>WARNING</span></h1>
+			<p>
+			By continuing this process, you will permanently delete your current openauth credentials.
+			All devices you have will have to be reconfigured in order to work again using this self-service website.
+			</p>
+			<p>
+			Click <a href="revoke.psp?confirm=n">here</a> to continue.
+			</p>
+""")
+		msg = "warned user [%s] about permanently deleting credentials" % username
+		core.log(msg, session, req)
+	else:
+		try:
+			event.begin('secret_delete')
+			openauth.deleteSecretFile(username)
+			event.end('secret_delete')
+		except Exception, e:
+			msg = "ERROR: unable to revoke secret for user [%s]: %s" % (username, e)
+			core.log(msg, session, req, e)
+			p.write(org.errmsg_general(session, req))
+			raise BreakOut()
+		msg = "revoked secret for user [%s]" % username
+		core.log(msg, session, req)
+		p.write("""
+			<p>
+			All of your existing openauth credentials have been deleted.
+			</p>
+			<p>
+			Click <a href="%s">%s</a> if you wish to create new ones.
+			</p>
+""" % (p.base_url_dir, p.base_url_dir))
+
+def login(req, session, form):
+	"""the login page (login.psp), used when config.AUTH_TYPE=='FORM'; visiting it while logged in logs the user out"""
+	_page(req, session, form, _login, check_session=False)
+
+def _login(p):
+	req, session, form, event = p.req, p.session, p.form, p.event
+
+	#--- sanity check
+
+	if config.AUTH_TYPE!='FORM':
+		raise Exception("internal error: request to login.psp when config.AUTH_TYPE!='FORM'")
+
+
+	#--- begin handling posts to self (or prep for form)
+
+	logged_in = False
+	logged_out = False
+	login_failed = False
+
+	#handle posts to self (the actual user authentication step)
+	if req.headers_in.has_key('Referer') and req.headers_in['Referer'].split('?')[0]==req.subprocess_env['SCRIPT_URI']:
+		if form.has_key('username') and form.has_key('password'):
+			username = str(form['username']).strip()
+			password = str(form['password']).strip()
+
+			try:
+				if username=='': raise Exception("username cannot be empty")
+				if password=='': raise Exception("password cannot be empty")
+				event.begin('ldap_bind')
+				org.authenticateUser(session, req, username, password)
+				event.end('ldap_bind')
+			except Exception, e:
+				session.invalidate()  #(this is done below, too)
+				session.delete()
+				login_failed = True
+				msg = "autentication of user [%s] failed" % username  #the error message is purposefully not here, so as to not leak information...
+				core.log(msg, session, req, e)  #...if config.DEBUG is set, the full error will be logged
+			else:
+				session['username'] = username
+				logged_in = True
+				msg = "authenticated user [%s]" % username  #(session id will be logged automatically)
+				core.log(msg, session, req)
+
+				if form.has_key('redirect'):
+					core.redirect(req, urllib.unquote_plus(str(form['redirect'])))
+
+	#if visiting this page while already logged in, logout
+	if not logged_in and core.getUsername(session, req) is not None:
+		session.invalidate()  #(this is done below, too)
+		session.delete()
+		logged_out = True
+
+
+	#--- begin page construction
+
+	p.writeHeader()
+
+	if logged_in:
+		#(if code gets here, it means there was no redirect to follow)
+		p.write(org.html_login_successful(session, req))
+		return
+
+	session.invalidate()  #want to start with a brand new session (so this one is invalidated, and the one created above, upon submission will be the good one)
+	session.delete()
+	msg = "invalidated this session"
+	core.log(msg, session, req)
+
+	if logged_out:
+		p.write(org.html_logout_successful(session, req))
+	if login_failed:
+		p.write(org.html_login_failed(session, req))
+
+	p.write(org.html_login_intro(session, req))
+	p.write("""
+			<p>
+			<form method="post" action="login.psp">
+				<table>
+					<tr>
+						<td style="text-align:right;">
+							username:
+						</td>
+						<td>
+							<input type="text" name="username" /><br />
+						</td>
+					</tr>
+					<tr>
+						<td style="text-align:right;">
+							password:
+						</td>
+						<td>
+							<input type="password" name="password" /><br />
+						</td>
+					</tr>
+					<tr>
+						<td>
+							&nbsp;
+						</td>
+						<td>
+							<input type="submit" value="Login" />
+						</td>
+					</tr>
+""")
+	if form.has_key('redirect'):
+		p.write("""
+				<input type="hidden" name="redirect" value="%s" />
+""" % str(form['redirect']))
+	p.write("""
+				</table>
+			</form>
+			</p>
+""")
+	p.write(org.html_login_outro(session, req))
+
+def fail_otec(req, session, form):
+	"""the page (fail_otec.psp) download() redirects to when the otec is not valid"""
+	_failPage(req, session, org2.errmsg_bad_otec)
+
+def fail_general(req, session, form):
+	"""the page (fail_general.psp) download() redirects to on other errors"""
+	_failPage(req, session, org.errmsg_general)
+
+def download(req, session, form):
+	"""otec protection for, and customization of, file downloads (qrcode.png and USERNAME-openauth.zip), i.e. dynamic non-html content"""
+	event = core.Event('download', session, req)
+	try:
+		_download(req, session, form, event)
+	finally:
+		event.emit()
+
+def _download(req, session, form, event):
+	try:
+		init()
+
+		req.add_common_vars()
+
+		base_url_dir = os.path.dirname(req.subprocess_env['SCRIPT_URI'])  #e.g. 'https://SERVER/PATH/'
+
+		msg = "request from ip [%s] from user [%s]" % (req.subprocess_env['REMOTE_ADDR'], core.getUsername(session, req))
+		core.log(msg, session, req)
+
+		core.sessionCheck(session, req)
+
+		username = core.getUsername(session, req)
+		if username is None:
+			raise Exception("internal error: openauth must be behind some compatible authentication wall")
+
+		wait = _tooMany(req, session, 'download', event)
+		if wait is not None:
+			req.headers_out.add('Content-Type', 'text/plain')
+			req.write("too many requests, try again in %d seconds\n" % wait)
+			return
+
+		#check the otec
+		code = None
+		try:
+			code = form['otec']
+		except KeyError:
+			pass
+		if code is None or not otec.isValid(code) or not code.startswith(username):
+			msg = "expired, invalid, or unprovided otec for user [%s]: %s" % (username, code)
+			core.log(msg, session, req)
+			req.internal_redirect(os.path.join(base_url_dir, 'fail_otec.psp'))
+			return
+
+		msg = "accepted otec [%s] for user [%s]" % (code, username)
+		core.log(msg, session, req)
+
+		#detemine what file to serve up
+		f = os.path.basename(req.uri)
+		if f not in ('qrcode.png', '%s-openauth.zip' % username):
+			msg = "unexpected download [%s] by user [%s]" % (f, username)
+			core.log(msg, session, req)
+			req.internal_redirect(os.path.join(base_url_dir, 'fail_general.psp'))
+			return
+
+		#handle feeding out the bytes
+		event.set('file', f)
+		if   f=='qrcode.png':
+			event.begin('qr_render')
+			bytes = openauth.getQRCodeBytes(username)
+			event.end('qr_render')
+			req.headers_out.add('Pragma', 'no-cache')
+			req.headers_out.add('Content-Type', 'image/png')
+			req.set_content_length(len(bytes))
+			req.write(bytes)
+		elif f==('%s-openauth.zip' % username):
+			slot = ratelimit.Slot('zip')
+			event.begin('zip_wait')
+			if not slot.acquire():
+				msg = "no zip slot came free for user [%s], turned away" % username
+				core.log(msg, session, req)
+				event.set('busy', 'zip')
+				req.status = 503
+				req.headers_out.add('Retry-After', '10')
+				req.headers_out.add('Content-Type', 'text/plain')
+				req.write("busy, try again in a few seconds\n")
+				return  #(the otec is left, so the same link works then)
+			event.end('zip_wait')
+			try:
+				event.begin('zip_build')
+				size, chunks = openauth.getZipChunks(username)
+				event.end('zip_build')
+			finally:
+				slot.release()
+			req.headers_out.add('Content-Disposition', 'attachment; filename="%s"' % f)
+			req.headers_out.add('Content-Type'       , 'application/zip')
+			req.set_content_length(size)
+			event.begin('zip_send')
+			for chunk in chunks:
+				req.write(chunk)  #(under mod_python, each write is flushed to the client)
+			event.end('zip_send')
+
+		#delete the otec
+		try:
+			otec.delete(code)
+			msg = "deleted otec [%s] for user [%s]" % (code, username)
+			core.log(msg, session, req)
+		except Exception, e:
+			msg = "ERROR: failed to delete otec [%s] for user [%s]: %s" % (code, username, e)
+			core.log(msg, session, req, e)
+			pass  #everything else worked, and the user is good to go; the otec will expire anyways
+	except core.serverReturn(req):
+		##if it's re-raised, sessions start over; passing seems wrong but it's the only way I know of to make sessions persist across redirect
+		#raise
+		pass
+	except artifacts.Busy, e:
+		msg = "artifact service busy, turned away user [%s]" % core.getUsername(session, req)
+		core.log(msg, session, req)
+		event.set('busy', 'artifacts')
+		req.status = 503
+		req.headers_out.add('Retry-After', '10')
+		req.headers_out.add('Content-Type', 'text/plain')
+		req.write("busy, try again in a few seconds\n")  #(the otec is left, so the same link works then)
+	except Exception, e:
+		if not 'base_url_dir' in locals():
+			raise  #just bailout and let the server handle it (if configured with PythonDebug On, the traceback will be shown to the user)
+		else:
+			msg = "ERROR: uncaught exception when handling user [%s]: %s" % (core.getUsername(session, req), e)
+			core.log(msg, session, req, e)
+			event.set('error', str(e))
+			req.internal_redirect(os.path.join(base_url_dir, 'fail_general.psp'))
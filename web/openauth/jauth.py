@@ -0,0 +1,263 @@
+"""
+building the customized JAuth client download
+
+DESCRIPTION
+	The JAuth zip download is the starter tree in config2.ZIP_CONTENTS_DIR
+	with the user's secret patched into AuthenticatorGUI.class inside
+	JAuth.jar, and the launcher scripts renamed for the user.
+
+	The starter tree is read once per process into a ZipTemplate, with the
+	jar pre-parsed and the placeholder offset in the class file precomputed,
+	so building a user's zip is all in memory -- no temporary directory, no
+	rsync/jar/zip subprocesses.
+
+	The zip is produced as a stream of chunks (local file headers, member
+	data, then the central directory) whose total size is known before the
+	first one is written, so it can be sent with a Content-Length and without
+	ever holding the whole archive in memory.
+
+REQUIREMENTS
+	n/a
+
+IMPLEMENTATION NOTES
+	The starter tree is expected to contain:
+
+		JAuth.jar
+		JAuth/AuthenticatorGUI.class  (containing config2.SECRET_PLACEHOLDER)
+		openauth.sh
+		openauth.bat
+
+	plus anything else, which is included as-is.  The class file is put into
+	the jar and not included on its own, as was done by the original shell
+	pipeline.
+
+	Everything that is the same for all users is compressed once, when the
+	template is loaded (the jar's members are used as they are in JAuth.jar,
+	without recompressing).  Per user, only the class file and the launcher
+	scripts are compressed.  The jar is stored uncompressed inside the zip (it
+	is already compressed); its CRC is computed by running through its chunks
+	once before streaming, so no data descriptors are needed.
+
+	A new starter tree is only picked up by new processes (i.e. restart
+	apache).
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, time, struct, zlib, zipfile, io
+
+
+JAR_NAME = 'JAuth.jar'
+CLASS_NAME = 'JAuth/AuthenticatorGUI.class'
+SCRIPT_NAMES = ('openauth.sh', 'openauth.bat')
+
+#the size of the pieces the zip is streamed in
+CHUNK_SIZE = 64*1024
+
+
+#--- internal helpers
+
+def _readFile(path):
+	f = open(path, 'rb')
+	try:
+		return f.read()
+	finally:
+		f.close()
+
+def _deflate(data):
+	"""return data compressed the way zip members are (raw deflate stream, no zlib header)"""
+	c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+	return c.compress(data) + c.flush()
+
+def _chunked(data):
+	"""iterate over data in pieces of at most CHUNK_SIZE"""
+	for i in xrange(0, len(data), CHUNK_SIZE):
+		yield data[i:i+CHUNK_SIZE]
+
+class _Member(object):
+	"""one member of a zip being streamed
+
+	chunks is a callable that returns an iterable over the (possibly compressed) data, which must add up to csize bytes.
+	"""
+
+	def __init__(self, name, date_time, external_attr, method, crc, csize, usize, chunks):
+		self.name = name
+		self.date_time = date_time
+		self.external_attr = external_attr
+		self.method = method
+		self.crc = crc
+		self.csize = csize
+		self.usize = usize
+		self.chunks = chunks
+
+	def rename(self, name):
+		"""return a copy of this member with a different name"""
+		return _Member(name, self.date_time, self.external_attr, self.method, self.crc, self.csize, self.usize, self.chunks)
+
+	def dostime(self):
+		Y, M, D, h, m, s = self.date_time
+		return (h << 11) | (m << 5) | (s // 2), ((Y - 1980) << 9) | (M << 5) | D
+
+def _bytesMember(name, st, data, method=zipfile.ZIP_DEFLATED):
+	"""return a _Member for data, with the metadata of stat result st"""
+	external_attr = (st.st_mode & 0xFFFF) << 16
+	if name.endswith('/'):
+		external_attr |= 0x10  #(MS-DOS directory flag)
+		method = zipfile.ZIP_STORED
+	if method==zipfile.ZIP_DEFLATED: cdata = _deflate(data)
+	else                           : cdata = data
+	return _Member(name, time.localtime(st.st_mtime)[:6], external_attr, method, zlib.crc32(data) & 0xffffffff, len(cdata), len(data), lambda: _chunked(cdata))
+
+def _rawMember(zbytes, info):
+	"""return a _Member for the already-compressed data of info, a member of the zip whose bytes are zbytes"""
+	namelen, extralen = struct.unpack('<HH', zbytes[info.header_offset+26:info.header_offset+30])
+	start = info.header_offset + 30 + namelen + extralen
+	cdata = zbytes[start:start+info.compress_size]
+	return _Member(info.filename, info.date_time, info.external_attr, info.compress_type, info.CRC, info.compress_size, info.file_size, lambda: _chunked(cdata))
+
+def _zipSize(members):
+	"""return the size of the zip that _zipChunks() makes of members"""
+	return sum([ 30 + len(m.name) + m.csize + 46 + len(m.name) for m in members ]) + 22
+
+def _zipChunks(members):
+	"""iterate over the bytes of a zip of members: each local file header and member data, then the central directory"""
+	offset = 0
+	central = []
+	for m in members:
+		dostime, dosdate = m.dostime()
+		yield struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0, m.method, dostime, dosdate, m.crc, m.csize, m.usize, len(m.name), 0) + m.name
+		for chunk in m.chunks():
+			yield chunk
+		central.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, (3 << 8) | 20, 20, 0, m.method, dostime, dosdate, m.crc, m.csize, m.usize, len(m.name), 0, 0, 0, 0, m.external_attr, offset) + m.name)
+		offset += 30 + len(m.name) + m.csize
+	central = ''.join(central)
+	yield central + struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(members), len(members), len(central), offset, 0)
+
+def _coalesce(chunks):
+	"""iterate over chunks joined into pieces of about CHUNK_SIZE (so that small headers aren't written on their own)"""
+	buf = []
+	buflen = 0
+	for chunk in chunks:
+		buf.append(chunk)
+		buflen += len(chunk)
+		if buflen >= CHUNK_SIZE:
+			yield ''.join(buf)
+			buf = []
+			buflen = 0
+	if buf: yield ''.join(buf)
+
+
+#--- main methods
+
+class ZipTemplate(object):
+	"""the starter tree, loaded into memory and ready to be customized per user"""
+
+	def __init__(self, contents_dir, placeholder):
+		self.contents_dir = contents_dir
+		self.placeholder = placeholder
+
+		#everything but the files that get customized, named relative to the top directory (which is named per user)
+		self.members = [ _bytesMember('/', os.stat(contents_dir), '') ]
+		self.scripts = {}  #script name -> (stat result, bytes)
+		self.jar_stat = None
+		self.class_bytes = None
+		for dirpath, dirnames, filenames in os.walk(contents_dir):
+			dirnames.sort()
+			filenames.sort()
+			reldir = os.path.relpath(dirpath, contents_dir)
+			if reldir=='.': reldir = ''
+			else          : self.members.append(_bytesMember('/%s/' % reldir, os.stat(dirpath), ''))
+			for filename in filenames:
+				relpath = reldir and '%s/%s' % (reldir, filename) or filename
+				path = os.path.join(dirpath, filename)
+				st = os.stat(path)
+				if relpath==JAR_NAME:
+					self.jar_stat = st
+					jar_bytes = _readFile(path)
+				elif relpath==CLASS_NAME:
+					self.class_bytes = _readFile(path)
+				elif relpath in SCRIPT_NAMES:
+					self.scripts[relpath] = (st, _readFile(path))
+				else:
+					self.members.append(_bytesMember('/%s' % relpath, st, _readFile(path)))
+		missing = [ name for name in SCRIPT_NAMES if name not in self.scripts ]
+		if self.jar_stat    is None: missing.append(JAR_NAME)
+		if self.class_bytes is None: missing.append(CLASS_NAME)
+		if missing: raise Exception("zip starter directory [%s] is missing %s" % (contents_dir, ', '.join(missing)))
+
+		#where the secret goes
+		self.placeholder_offset = self.class_bytes.find(placeholder)
+		if self.placeholder_offset < 0:
+			raise Exception("[%s] does not contain the secret placeholder" % os.path.join(contents_dir, CLASS_NAME))
+
+		#the jar's members, with None where the customized class goes
+		jar = zipfile.ZipFile(io.BytesIO(jar_bytes), 'r')
+		self.jar_members = []
+		self.class_info = None
+		for info in jar.infolist():
+			if info.filename==CLASS_NAME:
+				self.class_info = info
+				self.jar_members.append(None)
+			else:
+				self.jar_members.append(_rawMember(jar_bytes, info))
+		jar.close()
+		if self.class_info is None:
+			#(`jar uf` would add it at the end)
+			self.class_info = zipfile.ZipInfo(CLASS_NAME, time.localtime(os.stat(os.path.join(contents_dir, CLASS_NAME)).st_mtime)[:6])
+			self.class_info.compress_type = zipfile.ZIP_DEFLATED
+			self.class_info.external_attr = 0644 << 16
+			self.jar_members.append(None)
+
+	def classBytes(self, secret):
+		"""return the bytes of the class file with secret in place of the placeholder"""
+		if len(secret)!=len(self.placeholder): raise Exception("secret is not the same length as the placeholder")
+		return self.class_bytes[:self.placeholder_offset] + secret + self.class_bytes[self.placeholder_offset+len(self.placeholder):]
+
+	def _jarMembers(self, secret):
+		data = self.classBytes(secret)
+		if self.class_info.compress_type==zipfile.ZIP_DEFLATED: cdata = _deflate(data)
+		else                                                  : cdata = data
+		info = self.class_info
+		member = _Member(info.filename, info.date_time, info.external_attr, info.compress_type, zlib.crc32(data) & 0xffffffff, len(cdata), len(data), lambda: _chunked(cdata))
+		return [ m or member for m in self.jar_members ]
+
+	def _zipMembers(self, username, secret):
+		top = '%s-openauth' % username
+		members = [ m.rename(top + m.name) for m in self.members ]
+
+		jar_members = self._jarMembers(secret)
+		size = _zipSize(jar_members)
+		crc = 0
+		for chunk in _zipChunks(jar_members):
+			crc = zlib.crc32(chunk, crc)
+		st = self.jar_stat
+		members.append(_Member('%s/%s' % (top, JAR_NAME), time.localtime(st.st_mtime)[:6], (st.st_mode & 0xFFFF) << 16, zipfile.ZIP_STORED, crc & 0xffffffff, size, size, lambda: _zipChunks(jar_members)))
+
+		for name in SCRIPT_NAMES:
+			st, data = self.scripts[name]
+			members.append(_bytesMember('%s/%s-%s' % (top, username, name), st, data))
+		return members
+
+	def zipChunks(self, username, secret):
+		"""return (size, chunks) for USERNAME-openauth.zip with secret embedded, where chunks iterates over the bytes
+
+		Everything that might fail is done before this returns, so once the caller starts sending chunks, the whole zip will follow.
+		"""
+		members = self._zipMembers(username, secret)
+		return _zipSize(members), _coalesce(_zipChunks(members))
+
+	def zipBytes(self, username, secret):
+		"""return the bytes of USERNAME-openauth.zip, with secret embedded"""
+		size, chunks = self.zipChunks(username, secret)
+		return ''.join(chunks)
+
+_template = None
+
+def getTemplate(contents_dir, placeholder):
+	"""return the ZipTemplate for contents_dir, loading it if this process has not already"""
+	global _template
+	if _template is None or _template.contents_dir!=contents_dir or _template.placeholder!=placeholder:
+		_template = ZipTemplate(contents_dir, placeholder)
+	return _template
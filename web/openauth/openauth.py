@@ -15,9 +15,10 @@ REQUIREMENTS
 		The directories named in config2.py must exist, be readable by whatever 
 		calls this, and in some cases writable, too.
 	
-	google-authenticator program for generating secrets
+	google-authenticator program for generating secrets, if 
+	config2.SECRET_GENERATOR is 'google-authenticator'
 	
-	qrencode package
+	qrencode package, if config2.QR_ENCODER is 'qrencode'
 
 AUTHOR
 	John Brunelle <john_brunelle@harvard.edu>
@@ -25,12 +26,18 @@ AUTHOR
 """
 
 from lilpsp import config, core
-import config2, org2
-import os, errno, tempfile
+import config2, org2, qr, jauth, snapshot, artifacts
+import os, re, errno, time, tempfile, base64, random, hashlib, threading, atexit
 
 
 #--- misc prep
 
+if config2.SECRET_GENERATOR not in ('python', 'google-authenticator'): raise Exception("unknown config2.SECRET_GENERATOR [%s]" % config2.SECRET_GENERATOR)
+if config2.QR_ENCODER not in ('python', 'qrencode'): raise Exception("unknown config2.QR_ENCODER [%s]" % config2.QR_ENCODER)
+if config2.ZIP_BUILDER not in ('python', 'shell'): raise Exception("unknown config2.ZIP_BUILDER [%s]" % config2.ZIP_BUILDER)
+if config2.SECRETS_LAYOUT not in ('flat', 'hashed'): raise Exception("unknown config2.SECRETS_LAYOUT [%s]" % config2.SECRETS_LAYOUT)
+if config2.SECRET_FSYNC not in ('write', 'batch', 'time'): raise Exception("unknown config2.SECRET_FSYNC [%s]" % config2.SECRET_FSYNC)
+
 if config2.GABIN is not None:
 	os.environ['PATH'] = '%s:%s' % (config2.GABIN, os.environ['PATH'])
 if config2.QRBIN is not None and config2.QRBIN != config2.GABIN:
@@ -39,88 +46,275 @@ if config2.JARBIN is not None and (config2.JARBIN != config2.GABIN and config2.J
 	os.environ['PATH'] = '%s:%s' % (config2.JARBIN, os.environ['PATH'])
 
 
-#--- internal helpers
+#--- secret file format
 
-def _getSecretDir(username):
-	"""return the full path to the directory in which to store the secret file (regardless of whether or not it exists)"""
-	return os.path.join(config2.SECRETS_ROOT_DIR, username)
+#These mirror the command-line options makeSecretFile() gives google-authenticator; the in-process generator must write the same thing.
+_SECRET_BYTES = 10  #(80 bits, i.e. 16 base32 characters)
+_WINDOW_SIZE = 5
+_SCRATCH_CODES = 5
 
-def _getSecretFilename(username):
-	"""return the full path to the secret file (regardless of whether or not it exists)"""
-	return os.path.join(_getSecretDir(username), config2.SECRET_FILE_BASENAME)
+_random = random.SystemRandom()
 
-def _makeSecretDir(username):
-	"""create the user's directory if it does not already exist; return its full path"""
-	dirname = _getSecretDir(username)
-	#(most use cases will be creating it anew, so assume that as the default action)
+#what a username must look like to be given a secret file (see isValidUsername())
+_re_valid_username = re.compile('^[a-zA-Z0-9_][a-zA-Z0-9_.\-]*\Z')
+
+
+#--- caches
+
+#rendered QR code pngs, keyed on the data encoded (the otpauth uri)
+_qrcache = core.TTLCache(config2.QR_CACHE_SIZE, config2.QR_CACHE_TTL)
+
+#parsed secret files, keyed on path, each as ((mtime, size, inode), parsed contents); see _readSecretFile()
+_secretcache = core.TTLCache(config2.SECRET_CACHE_SIZE, config2.SECRET_CACHE_TTL)
+_secretstats = {'opens': 0, 'opens_saved': 0, 'snapshot_hits': 0}
+
+#the shared snapshot of all secret files, if config2.SECRET_SNAPSHOT_FILE is set; see _readSecretFile()
+_snapshot = None
+
+
+#--- write durability
+
+#directories whose entries changed (secret files renamed in or removed, user directories made or removed) and have not been fsync'ed yet, under config2.SECRET_FSYNC 'batch' or 'time'; see _dirChanged()
+_syncpending = set()
+_synclock = threading.Lock()
+_synctimer = None  #(the pid that started it, and the threading.Timer), under 'time'
+_writestats = {'file_fsyncs': 0, 'dir_fsyncs': 0}
+
+def _fsyncDir(path):
+	"""fsync the directory, so the changes to its entries are on disk; return False if it no longer exists"""
 	try:
-		os.makedirs(dirname, 0770)  #(umask is still applied)
+		fd = os.open(path, os.O_RDONLY)
 	except OSError, e:
-		if e.errno != errno.EEXIST: raise  #(we're implementing mkdir -p)
-	return dirname
+		if e.errno==errno.ENOENT: return False  #(removed since, e.g. a revoked user's directory)
+		raise
+	try:
+		try:
+			os.fsync(fd)
+		except OSError, e:
+			if e.errno!=errno.EINVAL: raise  #(filesystems that can't fsync directories say so this way)
+	finally:
+		os.close(fd)
+	_writestats['dir_fsyncs'] += 1
+	return True
+
+def _dirChanged(path):
+	"""note that entries were added to or removed from the directory, and fsync it now or later, according to config2.SECRET_FSYNC"""
+	global _synctimer
+	if config2.SECRET_FSYNC=='write':
+		_fsyncDir(path)
+		return
+	_synclock.acquire()
+	try:
+		_syncpending.add(path)
+		if config2.SECRET_FSYNC=='time' and (_synctimer is None or _synctimer[0]!=os.getpid()):  #(a timer running in a parent doesn't run in a forked child)
+			t = threading.Timer(config2.SECRET_FSYNC_SECONDS, _flushTimer)
+			t.setDaemon(True)
+			_synctimer = (os.getpid(), t)
+			t.start()
+	finally:
+		_synclock.release()
 
-def _deleteSecretDir(username):
-	"""attempt to delete the directory; raise an Exception upon failure, including if it's not empty"""
-	os.rmdir(_getSecretDir(username))
+def _flushTimer():
+	global _synctimer
+	_synclock.acquire()
+	try:
+		_synctimer = None
+	finally:
+		_synclock.release()
+	try:
+		flushSecretWrites()
+	except Exception, e:
+		core.log("ERROR: failed to fsync secret directories: %s" % e, e=e)
 
-def _QRCode(data):
-	"""encode data as QR Code png image
-	
-	This returns the bytes; there is no file stored on disk.
-	"""
-	sh = 'qrencode -o - -s 6 %s' % core.shQuote(data)
-	return core.getStdout(sh)
 
+#--- internal helpers
 
-#--- main methods
+def _shardDirs(username):
+	"""return the two levels of directories the user's directory goes in for the 'hashed' layout, e.g. ('ab', 'cd')"""
+	h = hashlib.md5(username).hexdigest()
+	return h[0:2], h[2:4]
 
-def secretFileExists(username):
-	"""boolean of whether or not the secret for the user already exists"""
-	return os.path.exists(_getSecretFilename(username))
+def _otherLayout():
+	"""return the layout that is not config2.SECRETS_LAYOUT (where secrets may still be during a migration)"""
+	if config2.SECRETS_LAYOUT=='hashed': return 'flat'
+	return 'hashed'
 
-def makeSecretFile(username):
-	"""create the secret for the user
+def _getSecretDir(username, layout=None, root=None):
+	"""return the full path to the directory in which to store the secret file (regardless of whether or not it exists)
 	
-	This will overwrite the secret if it already exists (that's the behavior of google-authenticator itself).
+	This is for the given layout, default config2.SECRETS_LAYOUT, in the tree at root, default config2.SECRETS_ROOT_DIR.
 	"""
-	sdir = _makeSecretDir(username)
-	##old version had no command-line options, the below accomplishes a custom --secret with hack of $HOME -> $SDIR and manually changing the hard-coded filename
-	#sh = "echo -e 'y\nn\nn\nn' | SDIR='%s' '%s/google-authenticator'" % (sdir, config2.GABIN)
-	sh = "google-authenticator --secret=%s/s --time-based --force --disallow-reuse --window-size=5 --no-rate-limit" % core.shQuote(sdir)
-	return core.getStdout(sh)
-
-def deleteSecretFile(username):
-	"""delete the secret belonging to the user
+	if layout is None: layout = config2.SECRETS_LAYOUT
+	if root   is None: root   = config2.SECRETS_ROOT_DIR
+	if layout=='hashed':
+		a, b = _shardDirs(username)
+		return os.path.join(root, a, b, username)
+	return os.path.join(root, username)
+
+def _getSecretFilename(username, layout=None, root=None):
+	"""return the full path to the secret file (regardless of whether or not it exists), for the given layout and root (see _getSecretDir())"""
+	return os.path.join(_getSecretDir(username, layout, root), config2.SECRET_FILE_BASENAME)
+
+def _findSecretFilename(username):
+	"""return the full path to the user's existing secret file, else the path it would have in config2.SECRETS_LAYOUT
 	
-	This does nothing if the file doesn't exist.
-	This also tries to remove the directory for the user; any failure to remove the directory (including if it's not empty) is ignored.
+	This falls back to the other layout, for users not yet migrated (see migrateSecret()).
 	"""
-	if secretFileExists(username):
-		os.remove(_getSecretFilename(username))  #(let it raise any exception)
-	try:
-		os.rmdir(_deleteSecretDir(username))
-	except Exception:  #(including OSError: [Errno 39] Directory not empty: '...')
-		pass
+	filename = _getSecretFilename(username)
+	if not os.path.exists(filename):
+		other = _getSecretFilename(username, _otherLayout())
+		if os.path.exists(other): return other
+	return filename
+
+def _parseSecretFile(contents):
+	"""return a dict of the parts of a secret file: 'secret' (None if the file is empty), 'options' (a dict of option name to value, or True for options without one), and 'scratch_codes' (a list of strings)"""
+	parsed = {'secret': None, 'options': {}, 'scratch_codes': []}
+	lines = contents.splitlines()
+	if lines: parsed['secret'] = lines[0].strip()
+	for line in lines[1:]:
+		line = line.strip()
+		if line.startswith('"'):
+			words = line[1:].split(None, 1)
+			if not words: continue
+			if len(words)==1: parsed['options'][words[0]] = True
+			else            : parsed['options'][words[0]] = words[1]
+		elif line!='':
+			parsed['scratch_codes'].append(line)
+	return parsed
+
+def _readSecretFile(username):
+	"""return the _parseSecretFile() dict of the user's secret file
+	
+	The parsed file is cached per process, keyed on its path, and only used again while the file's (mtime, size, inode) are unchanged, so a file that is rewritten (always by a rename, which changes the inode) or removed is never served from the cache.
+	Those come from an fstat of the opened file, not a stat of the path: on NFS, a stat may be answered from the client's attribute cache (for up to the mount's actimeo, 60 seconds by default) without noticing a rename done on another host, but an open makes the client revalidate (close-to-open consistency).
+	So there is still one open and fstat per call; what's saved is the read and parse (see secretCacheStats()).
+	When the file isn't cached, it's looked for in the snapshot (see snapshot.py), under the same rule, before it's read.
+	Raises IOError if there is no secret file.
+	"""
+	global _snapshot
+	for layout in (config2.SECRETS_LAYOUT, _otherLayout()):
+		filename = _getSecretFilename(username, layout)
+		try:
+			f = open(filename)
+		except IOError, e:
+			if e.errno==errno.ENOENT: continue
+			raise
+		try:
+			st = os.fstat(f.fileno())
+			key = (st.st_mtime, st.st_size, st.st_ino)
+			cached = _secretcache.get(filename)
+			if cached is not None and cached[0]==key:
+				_secretstats['opens_saved'] += 1
+				return cached[1]
+			contents = None
+			if config2.SECRET_SNAPSHOT_FILE is not None:
+				if _snapshot is None or _snapshot.path!=config2.SECRET_SNAPSHOT_FILE: _snapshot = snapshot.Reader(config2.SECRET_SNAPSHOT_FILE)
+				contents = _snapshot.get(username, key)
+			if contents is not None:
+				_secretstats['snapshot_hits'] += 1
+			else:
+				contents = f.read()
+				_secretstats['opens'] += 1
+		finally:
+			f.close()
+		parsed = _parseSecretFile(contents)
+		_secretcache.set(filename, (key, parsed))
+		return parsed
+	raise IOError(errno.ENOENT, "no secret file for user [%s]" % username)
 
-def getSecret(username):
-	"""get the secret (the 16-character string) belonging to the user"""
+def _removeScratchCode(username, code):
+	"""remove an emergency scratch code from the user's secret file, as pam_google_authenticator does when one is used; return False if it isn't there (e.g. it was already used)
+
+	The file is read afresh, not through the cache, and replaced with _writeSecretFile(); nothing else in it changes.
+	Two processes removing the same code at the very same moment may both see it there (there's no lock); any later use sees it gone.
+	Raises IOError if there is no secret file.
+	"""
+	filename = _findSecretFilename(username)
+	f = open(filename)
 	try:
-		f = open(_getSecretFilename(username))
-		for line in f:
-			return line.strip()  #the first line is the secret
+		contents = f.read()
 	finally:
+		f.close()
+	lines = contents.splitlines(True)
+	kept = lines[:1] + [ line for line in lines[1:] if line.strip()!=code ]  #(the first line is the secret, never a scratch code)
+	if len(kept)==len(lines): return False
+	_writeSecretFile(filename, ''.join(kept))
+	_forgetSecretFile(username)
+	return True
+
+def _forgetSecretFile(username):
+	"""drop the user's secret file from the cache, in both layouts"""
+	for layout in ('flat', 'hashed'):
+		_secretcache.delete(_getSecretFilename(username, layout))
+
+def _makeDirs(path):
+	"""mkdir -p path, noting each directory made with _dirChanged(); return whether path itself was made"""
+	#(most use cases will be creating it anew, in a parent that exists, so assume that as the default action)
+	try:
+		os.mkdir(path, 0770)  #(umask is still applied)
+	except OSError, e:
+		if e.errno==errno.EEXIST: return False
+		if e.errno!=errno.ENOENT: raise
+		_makeDirs(os.path.dirname(path))
 		try:
+			os.mkdir(path, 0770)
+		except OSError, e:
+			if e.errno==errno.EEXIST: return False  #(made by someone else meanwhile)
+			raise
+	_dirChanged(os.path.dirname(path))
+	return True
+
+def _makeSecretDir(username):
+	"""create the user's directory if it does not already exist; return its full path"""
+	dirname = _getSecretDir(username)
+	_makeDirs(dirname)
+	return dirname
+
+def _deleteSecretDir(username, layout=None):
+	"""attempt to delete the directory; raise an Exception upon failure, including if it's not empty"""
+	os.rmdir(_getSecretDir(username, layout))
+
+def _generateSecretFileContents():
+	"""return the contents for a new secret file
+	
+	This is byte-compatible with what `google-authenticator --time-based --disallow-reuse --window-size=5 --no-rate-limit` writes: the base32 secret, the option lines, then the emergency scratch codes (8 digits, no leading zero).
+	"""
+	lines = [ base64.b32encode(os.urandom(_SECRET_BYTES)) ]
+	lines.append('" WINDOW_SIZE %d' % _WINDOW_SIZE)
+	lines.append('" DISALLOW_REUSE')
+	lines.append('" TOTP_AUTH')
+	for i in range(_SCRATCH_CODES):
+		lines.append('%d' % _random.randint(10000000, 99999999))
+	return ''.join([ '%s\n' % line for line in lines ])
+
+def _writeSecretFile(filename, contents):
+	"""atomically replace filename with the given contents, leaving it mode 0400
+	
+	The contents go to a temporary file in the same directory that is then renamed into place, so readers (e.g. the RADIUS servers) see either the old secret or the new one, never a partial file.
+	The temporary file is fsync'ed before the rename, so that's true after a crash, too; when the rename itself is sure to be on disk depends on config2.SECRET_FSYNC (see _dirChanged()).
+	"""
+	fd, tmpname = tempfile.mkstemp(prefix='.%s.' % os.path.basename(filename), dir=os.path.dirname(filename))
+	try:
+		f = os.fdopen(fd, 'w')
+		try:
+			os.fchmod(f.fileno(), 0400)
+			f.write(contents)
+			f.flush()
+			os.fsync(f.fileno())
+		finally:
 			f.close()
+		_writestats['file_fsyncs'] += 1
+		os.rename(tmpname, filename)
+	except Exception:
+		try:
+			os.remove(tmpname)
 		except Exception:
 			pass
+		raise
+	_dirChanged(os.path.dirname(filename))
 
-def getQRCodeBytes(username):
-	"""get the bytes of a QR Code png containing the secret belonging to the user"""
-	data = 'otpauth://totp/%s?secret=%s' % (org2.getSecretKeyLabel(username), getSecret(username))
-	return _QRCode(data)
-
-def getZipBytes(username):
-	"""get the bytes of the zip file with the JAuth client, customized to the user (secret is embedded)"""
+def _getZipBytesShell(username):
+	"""build the zip of the JAuth client in a temporary directory using rsync, jar, and zip (config2.ZIP_BUILDER=='shell')"""
 	tmpd = tempfile.mkdtemp(dir='/tmp')
 	try:
 		zipdbasename = '%s-openauth' % username
@@ -153,106 +347,218 @@ def getZipBytes(username):
 		except Exception:
 			pass
 
+def _QRCode(data):
+	"""encode data as QR Code png image
+	
+	This returns the bytes; there is no file stored on disk.
+	The result is cached in-process (see config2.QR_CACHE_SIZE and config2.QR_CACHE_TTL), so repeat loads of the same page skip the encoding.
+	"""
+	bytes = _qrcache.get(data)
+	if bytes is None:
+		if config2.QR_ENCODER=='python':
+			bytes = qr.png(data, config2.QR_ECC_LEVEL, scale=6)
+		else:
+			sh = 'qrencode -o - -s 6 %s' % core.shQuote(data)
+			bytes = core.getStdout(sh)
+		_qrcache.set(data, bytes)
+	return bytes
 
-#--- handlers (since they're directly called by apache, they should handle all exceptions, too)
 
-def downloadHandler(req):
-	"""otec protection for, and customization of, file downloads, i.e. dynamic non-html content"""
+#--- main methods
 
+def isValidUsername(username):
+	"""return whether username looks like a username (letters, digits, and _ . -, not starting with . or -), and so is safe to name a secret file after"""
+	return _re_valid_username.match(username) is not None
 
-	#--- BEGIN TEMPLATE CODE...
+def secretFileExists(username):
+	"""boolean of whether or not the secret for the user already exists"""
+	return os.path.exists(_findSecretFilename(username))
 
+def makeSecretFile(username):
+	"""create the secret for the user
+	
+	This will overwrite the secret if it already exists (that's the behavior of google-authenticator itself).
+	The secret is always made in config2.SECRETS_LAYOUT; one in the other layout is removed after.
+	Returns the output of google-authenticator, or the empty string for the in-process generator.
+	"""
+	_forgetSecretFile(username)
+	sdir = _makeSecretDir(username)
+	if config2.SECRET_GENERATOR=='python':
+		_writeSecretFile(os.path.join(sdir, config2.SECRET_FILE_BASENAME), _generateSecretFileContents())
+		output = ''
+	else:
+		##old version had no command-line options, the below accomplishes a custom --secret with hack of $HOME -> $SDIR and manually changing the hard-coded filename
+		#sh = "echo -e 'y\nn\nn\nn' | SDIR='%s' '%s/google-authenticator'" % (sdir, config2.GABIN)
+		sh = "google-authenticator --secret=%s/s --time-based --force --disallow-reuse --window-size=5 --no-rate-limit" % core.shQuote(sdir)
+		output = core.getStdout(sh)
+		_dirChanged(sdir)
+	_deleteSecretFileLayout(username, _otherLayout())
+	_forgetSecretFile(username)
+	return output
+
+def _deleteSecretFileLayout(username, layout):
+	"""delete the user's secret and directory in the given layout, if they're there (see deleteSecretFile())
+
+	The directory is only tried when there was a file, so the common case of no secret in the other layout costs one remove, not a remove and an rmdir.
+	"""
+	filename = _getSecretFilename(username, layout)
 	try:
-		from mod_python import apache, util, Session
-		
-		session = Session.Session(req)
-		form = util.FieldStorage(req, keep_blank_values=1)
-
-		req.add_common_vars()
-		
-		base_url_dir = os.path.dirname(req.subprocess_env['SCRIPT_URI'])  #e.g. 'https://SERVER/PATH/'
-		base_fs_dir  = os.path.dirname(req.subprocess_env['SCRIPT_FILENAME'])
-		
-		msg = "request from ip [%s] from user [%s]" % (req.subprocess_env['REMOTE_ADDR'], core.getUsername(session, req))
-		core.log(msg, session, req)
-		
-		core.sessionCheck(session, req)
-
-		#--- ...END TEMPLATE CODE
-		
-		
-		import otec
+		os.remove(filename)
+	except OSError, e:
+		if e.errno!=errno.ENOENT: raise
+		return
+	try:
+		_deleteSecretDir(username, layout)
+	except Exception:  #(including OSError: [Errno 39] Directory not empty: '...')
+		_dirChanged(os.path.dirname(filename))
+	else:
+		_dirChanged(os.path.dirname(os.path.dirname(filename)))  #(the directory is gone, so the file in it is, too)
 
-		#reset otec defaults; make sure this is in sync with index.psp, else import order will matter
-		otec.OTEC_DIR = os.path.join(config2.ROOT_DIR, 'otec')
-		otec.DEBUG = config.DEBUG
+def deleteSecretFile(username):
+	"""delete the secret belonging to the user
+	
+	This does nothing if the file doesn't exist.
+	This also tries to remove the directory for the user; any failure to remove the directory (including if it's not empty) is ignored.
+	Both layouts are cleaned out, the other one first, so that a concurrent migrateSecret() cannot leave a copy behind.
+	"""
+	_forgetSecretFile(username)
+	_deleteSecretFileLayout(username, _otherLayout())
+	_deleteSecretFileLayout(username, config2.SECRETS_LAYOUT)
 
-		username = core.getUsername(session, req)
-		if username is None:
-			raise Exception("internal error: openauth must be behind some compatible authentication wall")
-		
-		#check the otec
-		code = None
+def migrateSecret(username):
+	"""move the user's secret from the other layout into config2.SECRETS_LAYOUT, if it's there; return whether it was moved
+	
+	The file is hard-linked into its new place before it's removed from the old one, so there is no moment when the user has no secret.
+	A secret already in the new place (e.g. one made since the migration started) is never overwritten; the old one is just removed.
+	"""
+	old = _getSecretFilename(username, _otherLayout())
+	if not os.path.exists(old): return False
+	_makeSecretDir(username)
+	try:
+		os.link(old, _getSecretFilename(username))
+	except OSError, e:
+		if e.errno==errno.ENOENT: return False  #(revoked or moved since the check above)
+		if e.errno!=errno.EEXIST: raise
+	else:
+		_dirChanged(_getSecretDir(username))
+	_deleteSecretFileLayout(username, _otherLayout())
+	return True
+
+def buildSecretSnapshot(path=None):
+	"""write a snapshot (see snapshot.py) of every secret file under config2.SECRETS_ROOT_DIR, in either layout, to path, default config2.SECRET_SNAPSHOT_FILE; return a dict with the number of users, bytes, generation, and seconds it took"""
+	if path is None: path = config2.SECRET_SNAPSHOT_FILE
+	t0 = time.time()
+	entries = {}  #username -> (contents, key)
+	for dirpath, dirnames, filenames in os.walk(config2.SECRETS_ROOT_DIR):
+		if config2.SECRET_FILE_BASENAME not in filenames or dirpath==config2.SECRETS_ROOT_DIR: continue
+		username = os.path.basename(dirpath)
+		filename = os.path.join(dirpath, config2.SECRET_FILE_BASENAME)
+		if username in entries and filename!=_getSecretFilename(username): continue  #(mid-migration, the one in config2.SECRETS_LAYOUT is the one used)
 		try:
-			code = form['otec']
-		except KeyError:
-			pass
-		if code is None or not otec.isValid(code) or not code.startswith(username):
-			msg = "expired, invalid, or unprovided otec for user [%s]: %s" % (username, code)
-			core.log(msg, session, req)
-			req.internal_redirect(os.path.join(base_url_dir, 'fail_otec.psp'))
-			return apache.OK
-				
-		msg = "accepted otec [%s] for user [%s]" % (code, username)
-		core.log(msg, session, req)
-		
-		#detemine what file to serve up
+			f = open(filename)
+		except IOError, e:
+			if e.errno==errno.ENOENT: continue  #(revoked since it was listed)
+			raise
 		try:
-			f = os.path.basename(req.uri)
-			if f not in ('qrcode.png', '%s-openauth.zip' % username): raise BreakOut
-		except (KeyError, BreakOut):
-			msg = "unexpected download [%s] by user [%s]" % (f, username)
-			core.log(msg, session, req)
-			req.internal_redirect(os.path.join(base_url_dir, 'fail_general.psp'))
-			return apache.OK
-		
-		#handle feeding out the bytes
-		if   f=='qrcode.png':
-			bytes = getQRCodeBytes(username)
-			req.headers_out.add('Pragma', 'no-cache')
-			req.headers_out.add('Content-Type', 'image/png')
-			req.write(bytes)
-		elif f==('%s-openauth.zip' % username):
-			bytes = getZipBytes(username)
-			req.headers_out.add('Content-Disposition', 'attachment; filename="%s"' % f)
-			req.headers_out.add('Content-Type'       , 'application/zip')
-			req.write(bytes)
-		
-		#delete the otec
+			st = os.fstat(f.fileno())
+			entries[username] = (f.read(), (st.st_mtime, st.st_size, st.st_ino))
+		finally:
+			f.close()
+	generation = snapshot.write(path, [ (username, contents, key) for username, (contents, key) in entries.iteritems() ])
+	return {'users': len(entries), 'bytes': os.path.getsize(path), 'generation': generation, 'seconds': time.time()-t0}
+
+def getSecret(username):
+	"""get the secret (the 16-character string) belonging to the user"""
+	return _readSecretFile(username)['secret']
+
+def getSecretOptions(username):
+	"""get the option lines of the user's secret file, as a dict of option name to value (True for options without one), e.g. {'WINDOW_SIZE': '5', 'TOTP_AUTH': True}"""
+	return _readSecretFile(username)['options']
+
+def secretCacheStats():
+	"""return a dict of this process's secret cache counters: opens (files actually read), opens_saved (reads answered from the cache), and snapshot_hits (reads answered from the snapshot)"""
+	return dict(_secretstats)
+
+def flushSecretWrites():
+	"""fsync every directory with secret file changes not yet on disk (see config2.SECRET_FSYNC); return how many were fsync'ed
+	
+	Under 'write' there are never any.  This is also run at exit.
+	"""
+	_synclock.acquire()
+	try:
+		pending = list(_syncpending)
+		_syncpending.clear()
+	finally:
+		_synclock.release()
+	n = 0
+	for i, path in enumerate(pending):
 		try:
-			otec.delete(code)
-			msg = "deleted otec [%s] for user [%s]" % (code, username)
-			core.log(msg, session, req)
-		except Exception, e:
-			msg = "ERROR: failed to delete otec [%s] for user [%s]: %s" % (code, username, e)
-			core.log(msg, session, req, e)
-			pass  #everything else worked, and the user is good to go; the otec will expire anyways
+			if _fsyncDir(path): n += 1
+		except Exception:
+			_synclock.acquire()
+			try:
+				_syncpending.update(pending[i:])  #(so they're tried again)
+			finally:
+				_synclock.release()
+			raise
+	return n
 
+def _flushAtExit():
+	if _synctimer is not None and _synctimer[0]==os.getpid(): _synctimer[1].cancel()  #(else it can wake during interpreter shutdown)
+	flushSecretWrites()
 
-		#--- BEGIN TEMPLATE CODE...
-		
-		return apache.OK
-	except apache.SERVER_RETURN:
-		##if it's re-raised, sessions start over; passing seems wrong but it's the only way I know of to make sessions persist across redirect
-		#raise
-		pass
-	except Exception, e:
-		if not ( 'core' in globals() and 'session' in locals() and 'base_url_dir' in locals() ):
-			raise  #just bailout and let the server handle it (if configured with PythonDebug On, the traceback will be shown to the user)
-		else:
-			msg = "ERROR: uncaught exception when handling user [%s]: %s" % (core.getUsername(session, req), e)
-			core.log(msg, session, req, e)
-			req.internal_redirect(os.path.join(base_url_dir, 'fail_general.psp'))
-			return apache.OK  #(not sure if this does anything)
+atexit.register(_flushAtExit)
+
+def secretWriteStats():
+	"""return a dict of this process's fsync counters: file_fsyncs (secret files) and dir_fsyncs (directories)"""
+	return dict(_writestats)
+
+def _fromService(kind, username):
+	"""return the bytes of the kind of artifact for the user built by the artifact service, or None if there's none to use (see artifacts.py)"""
+	if config2.ARTIFACT_SOCKET is None: return None
+	return artifacts.request(config2.ARTIFACT_SOCKET, kind, username, config2.ARTIFACT_TIMEOUT + 5)  #(the service times jobs out itself; this is in case it hangs)
+
+def getQRCodeBytes(username):
+	"""get the bytes of a QR Code png containing the secret belonging to the user
 	
-	#--- ...END TEMPLATE CODE
+	With config2.ARTIFACT_SOCKET set, this is built by the artifact service, or here if it's not running; see artifacts.py for the exceptions it adds.
+	"""
+	bytes = _fromService('qr', username)
+	if bytes is None: bytes = _getQRCodeBytes(username)
+	return bytes
+
+def _getQRCodeBytes(username):
+	data = 'otpauth://totp/%s?secret=%s' % (org2.getSecretKeyLabel(username), getSecret(username))
+	return _QRCode(data)
+
+def getZipBytes(username):
+	"""get the bytes of the zip file with the JAuth client, customized to the user (secret is embedded)"""
+	size, chunks = getZipChunks(username)
+	return ''.join(chunks)
+
+def getZipChunks(username):
+	"""like getZipBytes(), but return (size, chunks), where chunks is an iterator over the bytes, for streaming the zip to the client
+	
+	Any failure happens before this returns, not while iterating.
+	With config2.ARTIFACT_SOCKET set, this is built by the artifact service, or here if it's not running; see artifacts.py for the exceptions it adds.
+	"""
+	bytes = _fromService('zip', username)
+	if bytes is not None: return len(bytes), iter([bytes])
+	return _getZipChunks(username)
+
+def _getZipChunks(username):
+	if config2.ZIP_BUILDER=='python':
+		return jauth.getTemplate(config2.ZIP_CONTENTS_DIR, config2.SECRET_PLACEHOLDER).zipChunks(username, getSecret(username))
+	else:
+		bytes = _getZipBytesShell(username)
+		return len(bytes), iter([bytes])
+
+
+#--- handlers (since they're directly called by apache, they should handle all exceptions, too)
+
+def downloadHandler(req):
+	"""otec protection for, and customization of, file downloads, i.e. dynamic non-html content (see handlers.download())"""
+	from mod_python import apache, util, Session
+	import handlers
+	handlers.download(req, Session.Session(req), util.FieldStorage(req, keep_blank_values=1))
+	return apache.OK
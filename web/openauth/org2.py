@@ -42,7 +42,10 @@ def greeting(session, req):
 	"""html used at the very top of pages"""
 	greeting = "Hello"
 	username = core.getUsername(session, req)
-	if username is not None: greeting += " %s" % org.getFullName(username)
+	fullname = None
+	if username is not None:
+		fullname = org.getFullName(username)
+		greeting += " %s" % fullname
 	msg = """\
 <p>
 %s,
@@ -142,3 +145,29 @@ The link you are using has expired or is not valid.
 Please go to <a href="%s">%s</a> to start over.
 </p>
 """ % (org.err_str, base_url_dir, base_url_dir)
+
+
+def errmsg_too_many(session, req, seconds):
+	"""html error message when the user or address has made too many requests too quickly (see ratelimit.py)"""
+	return """\
+%s
+<p>
+There have been too many requests from you in a short time.
+</p>
+<p>
+Please wait %d seconds and try again.
+</p>
+""" % (org.err_str, seconds)
+
+
+def errmsg_busy(session, req):
+	"""html error message when the server is too busy to do something now (see ratelimit.Slot)"""
+	return """\
+%s
+<p>
+The server is too busy to do this right now.
+</p>
+<p>
+Please wait a minute and try again.
+</p>
+""" % (org.err_str,)
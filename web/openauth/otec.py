@@ -12,12 +12,29 @@ DESCRIPTION
 REQUIREMENTS
 	filesystem:
 		make sure OTEC_DIR below exists and is writable by whatever runs this 
-		process (e.g. apache)
+		process (e.g. apache), or, for the 'sqlite' BACKEND, that the 
+		directory containing OTEC_DB is
 
-	uuidgen command
+	sqlite3 python module, if using the 'sqlite' BACKEND
 
 IMPLEMENTATION NOTES
-	The filename is the code; the contents are the expiration date.
+	Codes are kept in a store, picked by BACKEND below.  For the 'dir' 
+	backend, the filename is the code and the contents are the expiration 
+	date, as an integer number of seconds since the epoch.  (Files written by 
+	older versions have it formatted according to TIME_FORMAT instead; those 
+	are still read, and migrate() adds them to the index below, but leaves 
+	them as they are, since rewriting one could bring it back if it was used 
+	meanwhile, and they all expire within a day anyway.)  For the 'sqlite' 
+	backend, there is one table of codes and expiration dates, indexed on 
+	the expiration date.
+
+	Nothing removes codes that expire without being used, so something must 
+	call sweep() now and then (e.g. misc/otecctl from cron, or set 
+	SWEEP_EVERY below).  So that sweeping does not have to look at every 
+	code, the 'dir' backend also keeps an index of codes by expiration time: 
+	an empty file named for the code in OTEC_DIR/.expiry/BUCKET/, where 
+	BUCKET is the expiration time divided by SWEEP_BUCKET_SECONDS.  Codes 
+	made before the index existed are only found by sweep(full=True).
 	
 	Codes are based on UUIDs, but can have extra strings prepended to them (the 
 	code is the whole thing).
@@ -31,17 +48,38 @@ AUTHOR
 """
 
 
-import os, time, subprocess
+import sys, os, errno, time, uuid, threading
 
 #Something that imports this module may choose to change these values, but of 
 #course one must make sure all modules that do so do it consistently.
 
-#OTEC_DIR -- place to store otecs
+#BACKEND -- how to store otecs
+#choose one of:
+#	'dir' -- one file per code, in OTEC_DIR
+#	'sqlite' -- one SQLite database, OTEC_DB
+BACKEND = 'dir'
+
+#OTEC_DIR -- place to store otecs, for the 'dir' BACKEND
 #The default is in a directory in the calling scripts current working
 #directory.
 OTEC_DIR = 'otec'
 
-#TIME_FORMAT -- format to use for times stored in the file
+#OTEC_DB -- the database file, for the 'sqlite' BACKEND
+#The database uses write-ahead logging, which does not work on network 
+#filesystems, so this must be on local disk.  Note that this means codes are 
+#only valid on the server that created them.
+OTEC_DB = 'otec.sqlite'
+
+#SWEEP_BUCKET_SECONDS -- width of the time buckets of the 'dir' BACKEND's expiration index
+SWEEP_BUCKET_SECONDS = 3600
+
+#SWEEP_EVERY -- if non-zero, sweep some expired codes every this many calls to new()
+#This is for deployments that do not run misc/otecctl from cron; each sweep 
+#handles at most SWEEP_BATCH_SIZE codes, so the cost is spread across requests.
+SWEEP_EVERY = 0
+SWEEP_BATCH_SIZE = 100
+
+#TIME_FORMAT -- format of expiration date strings given to new(), and of the times stored in legacy files
 TIME_FORMAT = '%Y-%m-%d %H:%M:%S'  #e.g. #2010-04-26 15:40:01
 
 #DEBUG -- boolean for whether or not to include full details in Exceptions and log messages
@@ -51,13 +89,16 @@ TIME_FORMAT = '%Y-%m-%d %H:%M:%S'  #e.g. #2010-04-26 15:40:01
 DEBUG = True
 
 
-def _code2path(code):
-	"""construct the full path to the otec file"""
-	return os.path.join(OTEC_DIR, code)
-
 def _tstr2tint(tstring):
-	"""convert a string formatted according to TIME_FORMAT to seconds since the epoch (an int)"""
-	return int(time.strftime('%s', time.strptime(tstring, TIME_FORMAT)))
+	"""convert a string formatted according to TIME_FORMAT (local time) to seconds since the epoch (an int)"""
+	return int(time.mktime(time.strptime(tstring, TIME_FORMAT)))  #(strptime leaves tm_isdst -1, so mktime works out whether DST applies)
+
+def _parseExpiration(data):
+	"""convert the contents of an otec file to seconds since the epoch (an int)"""
+	try:
+		return int(data)
+	except ValueError:
+		return _tstr2tint(data)  #(legacy format)
 
 def _tint2tstr(tint):
 	"""convert seconds since the epoch (an int) to a string formatted according to TIME_FORMAT"""
@@ -65,98 +106,313 @@ def _tint2tstr(tint):
 
 def _generateCode(prefix=''):
 	"""generate a new, unique code, prepending prefix to it, if given"""
-	#python uuid module introduced in 2.5, this is designed to be compatible with 2.4.3 (would use uuid.uuid4() otherwise)
-	sh = 'uuidgen -r'
-	p = subprocess.Popen(
-		sh,
-		shell=True,
-		stdin=open('/dev/null', 'r'),
-		stdout=subprocess.PIPE,
-		stderr=subprocess.PIPE
-	)
-	stdout, stderr = p.communicate()
-	if p.returncode != 0 or stderr != '':
-		if DEBUG:
-			msg = "sh code execution [%s] returned non-zero exit status [%s] and/or non-empty stdterr [%s]" % (repr(sh), p.returncode, repr(stderr.strip()))
-		else:
-			msg = "sh code execution returned non-zero exit status and/or non-empty stdterr"
-		raise Exception(msg)
-	return '%s%s' % (prefix, stdout.strip())
-
-#---
-
-def new(expiration_date, prefix=''):
-	"""create a new otec, expiring at the given date
-	
-	expires can be an int (seconds since the epoch), or a string (in the format of TIME_FORMAT above); either way, it's stored in the file as a formatted string
-	prefix is an optional string to include at the beginning of the code.
-	"""
-	
-	#create the code
-	code = _generateCode(prefix)
+	return '%s%s' % (prefix, uuid.uuid4())  #(random, from os.urandom; same format as `uuidgen -r`)
 
-	#create tstr, the expiration date string to store in the file
+def _toTint(expiration_date):
+	"""convert an expiration date given to new() to seconds since the epoch"""
 	if isinstance(expiration_date, basestring):
 		try:
-			#make sure it parses
-			_tstr2tint(expiration_date)
+			return _tstr2tint(expiration_date)
 		except ValueError:
 			raise ValueError("string [%s] must be in the time format %s" % (expiration_date, TIME_FORMAT))
-		tstr = expiration_date
 	elif isinstance(expiration_date, int):
-		tstr = _tint2tstr(expiration_date)
+		return expiration_date
 	else:
 		raise ValueError("invalid type [%s] for expiration_date [%s]" % (type(expiration_date), expiration_date))
-	
-	try:
-		f = open(_code2path(code), 'w')  #the code is in the filename, so the permissions here aren't very important; let the environment determine them
-		f.write('%s\n' % tstr)
-	finally:
+
+
+#--- stores
+
+#Each store has the methods:
+#	put(code, expiration) -- add the code, with expiration in seconds since the epoch
+#	putMany(items) -- put() each (code, expiration) in items, all at once if the store can
+#	get(code) -- return the expiration of the code, or None if there is no such code
+#	delete(code) -- remove the code, silently returning if there is no such code
+#	sweep(now, limit) -- remove up to limit codes that expired before now; return the number of (index entries looked at, codes removed)
+#	sweepUnindexed(now) -- remove every code that expired before now, even ones missing from the index; return the same as sweep()
+#	migrate() -- bring anything stored in a legacy format up to date; return the number of (codes looked at, codes migrated)
+
+class _DirStore(object):
+	"""one file per code in a directory, the 'dir' BACKEND"""
+
+	def __init__(self, dirname):
+		self.dirname = dirname
+
+	def _path(self, code):
+		if code=='' or '/' in code or code.startswith('.'): raise ValueError("malformed code [%s]" % code)
+		return os.path.join(self.dirname, code)
+
+	def _bucketDir(self, bucket):
+		return os.path.join(self.dirname, '.expiry', '%d' % bucket)
+
+	def put(self, code, expiration):
+		f = open(self._path(code), 'w')  #the code is in the filename, so the permissions here aren't very important; let the environment determine them
 		try:
+			f.write('%d\n' % expiration)
+		finally:
 			f.close()
-		except Exception:
-			pass
-	return code
 
-def isValid(code):
-	"""check if a code is valid
+		self._index(code, expiration)
 
-	Returns False if it's invalid, doesn't exist, can't be read, etc.
-	Does NOT delete the code (i.e. it could be valid again if asked again).
-	"""
-	#(making this work in 2.4.3, can't combine try+except+finally)
-	try:
+	def _index(self, code, expiration):
+		"""add the code to the expiration index, for sweep()"""
+		bucketdir = self._bucketDir(expiration // SWEEP_BUCKET_SECONDS)
+		marker = os.path.join(bucketdir, code)
+		try:
+			open(marker, 'w').close()
+		except IOError, e:
+			if e.errno!=errno.ENOENT: raise
+			try:
+				os.makedirs(bucketdir)
+			except OSError, e:
+				if e.errno!=errno.EEXIST: raise  #(another process may have just made it)
+			open(marker, 'w').close()
+
+	def putMany(self, items):
+		for code, expiration in items:
+			self.put(code, expiration)
+
+	def get(self, code):
+		try:
+			f = open(self._path(code), 'r')
+		except IOError, e:
+			if e.errno==errno.ENOENT: return None
+			raise
 		try:
-			f = open(_code2path(code), 'r')
 			data = f.read().strip()
 		finally:
+			f.close()
+		return _parseExpiration(data)
+
+	def delete(self, code):
+		"""remove the code; return whether it existed
+
+		The index entry is left for sweep() to clean up, since finding it would mean reading the code first.
+		"""
+		try:
+			os.remove(self._path(code))
+		except OSError, e:
+			if e.errno!=errno.ENOENT: raise
+			return False
+		return True
+
+	def sweep(self, now, limit):
+		looked, removed = 0, 0
+		try:
+			buckets = [ int(b) for b in os.listdir(os.path.join(self.dirname, '.expiry')) if b.isdigit() ]
+		except OSError, e:
+			if e.errno!=errno.ENOENT: raise
+			buckets = []
+		buckets.sort()
+		for bucket in buckets:
+			if (bucket + 1)*SWEEP_BUCKET_SECONDS > now: break  #(the rest are in the future)
+			bucketdir = self._bucketDir(bucket)
 			try:
-				f.close()
+				codes = os.listdir(bucketdir)
+			except OSError, e:
+				if e.errno!=errno.ENOENT: raise  #(another sweep may have finished it)
+				continue
+			for code in codes:
+				if looked >= limit: return looked, removed
+				if self.delete(code): removed += 1
+				try:
+					os.remove(os.path.join(bucketdir, code))
+				except OSError, e:
+					if e.errno!=errno.ENOENT: raise  #(another sweep may have removed it)
+				looked += 1
+			try:
+				os.rmdir(bucketdir)
+			except OSError, e:
+				if e.errno not in (errno.ENOENT, errno.ENOTEMPTY, errno.EEXIST): raise  #(another sweep may be at it, too)
+		return looked, removed
+
+	def sweepUnindexed(self, now):
+		looked, removed = 0, 0
+		for code in os.listdir(self.dirname):
+			if code.startswith('.'): continue
+			looked += 1
+			try:
+				expiration = self.get(code)
 			except Exception:
+				continue  #(not something this made; leave it alone)
+			if expiration is not None and expiration <= now:
+				if self.delete(code): removed += 1
+		looked2, removed2 = self.sweep(now, sys.maxint)
+		return looked + looked2, removed + removed2
+
+	def migrate(self):
+		looked, migrated = 0, 0
+		for code in os.listdir(self.dirname):
+			if code.startswith('.'): continue
+			looked += 1
+			path = self._path(code)
+			try:
+				f = open(path, 'r')
+			except IOError, e:
+				if e.errno==errno.ENOENT: continue  #(used or swept meanwhile)
+				raise
+			try:
+				data = f.read().strip()
+			finally:
+				f.close()
+			try:
+				int(data)
+				continue  #(already current)
+			except ValueError:
 				pass
-	except Exception:
-		return False
+			try:
+				expiration = _tstr2tint(data)
+			except ValueError:
+				continue  #(not something this made; leave it alone)
+			self._index(code, expiration)  #(not rewritten; see the module docstring)
+			migrated += 1
+		return looked, migrated
+
+class _SQLiteStore(object):
+	"""one SQLite database, the 'sqlite' BACKEND"""
+
+	def __init__(self, filename):
+		import sqlite3
+		self.filename = filename
+		self.db = sqlite3.connect(filename, timeout=30, isolation_level=None)  #(autocommit; each statement is its own transaction)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=NORMAL')
+		self.db.execute('CREATE TABLE IF NOT EXISTS otec (code TEXT PRIMARY KEY, expiration INTEGER NOT NULL)')
+		self.db.execute('CREATE INDEX IF NOT EXISTS otec_expiration ON otec (expiration)')
+
+	def put(self, code, expiration):
+		self.db.execute('INSERT INTO otec (code, expiration) VALUES (?, ?)', (code, expiration))
+
+	def putMany(self, items):
+		self.db.execute('BEGIN')
+		try:
+			self.db.executemany('INSERT INTO otec (code, expiration) VALUES (?, ?)', items)
+		except Exception:
+			self.db.execute('ROLLBACK')
+			raise
+		self.db.execute('COMMIT')
+
+	def get(self, code):
+		row = self.db.execute('SELECT expiration FROM otec WHERE code = ?', (code,)).fetchone()
+		if row is None: return None
+		return row[0]
+
+	def delete(self, code):
+		self.db.execute('DELETE FROM otec WHERE code = ?', (code,))
+
+	def sweep(self, now, limit):
+		n = self.db.execute('DELETE FROM otec WHERE rowid IN (SELECT rowid FROM otec WHERE expiration <= ? LIMIT ?)', (now, limit)).rowcount
+		return n, n
+
+	def sweepUnindexed(self, now):
+		return self.sweep(now, -1)  #(everything is indexed; -1 is no limit)
+
+	def migrate(self):
+		return 0, 0  #(there has only ever been one format)
+
+_local = threading.local()  #(.stores, per thread)
+
+def _getStore():
+	"""return the store for the current settings of BACKEND, OTEC_DIR, and OTEC_DB
+
+	Stores are per thread and per process (so database connections are not shared across threads, which sqlite3 does not allow, or across a fork).
+	"""
+	if   BACKEND=='dir'   : key = (BACKEND, OTEC_DIR, os.getpid())
+	elif BACKEND=='sqlite': key = (BACKEND, OTEC_DB , os.getpid())
+	else: raise Exception("unknown otec BACKEND [%s]" % BACKEND)
+	stores = _local.__dict__.setdefault('stores', {})
+	try:
+		return stores[key]
+	except KeyError:
+		if BACKEND=='dir': store = _DirStore(OTEC_DIR)
+		else             : store = _SQLiteStore(OTEC_DB)
+		stores[key] = store
+		return store
+
+
+#---
+
+_newcount = 0  #(for SWEEP_EVERY)
+
+def new(expiration_date, prefix=''):
+	"""create a new otec, expiring at the given date
 	
+	expires can be an int (seconds since the epoch), or a string (in the format of TIME_FORMAT above)
+	prefix is an optional string to include at the beginning of the code.
+	"""
+	return newMany([(expiration_date, prefix)])[0]
+
+def newMany(specs):
+	"""create several new otecs at once; return the list of codes
+	
+	specs is a list of (expiration_date, prefix) tuples, with the same meanings as for new(); the codes are returned in the same order.
+	For the 'sqlite' BACKEND, this is a single write to the store.
+	"""
+	items = [ (_generateCode(prefix), _toTint(expiration_date)) for expiration_date, prefix in specs ]
+	_getStore().putMany(items)
+
+	global _newcount
+	for i in range(len(items)):
+		_newcount += 1
+		if SWEEP_EVERY and _newcount % SWEEP_EVERY == 0:
+			try:
+				sweep(SWEEP_BATCH_SIZE, max_batches=1)
+			except Exception:
+				pass  #(leftover expired codes are harmless; a later sweep will get them)
+
+	return [ code for code, expiration in items ]
+
+def isValid(code):
+	"""check if a code is valid
+
+	Returns False if it's invalid, doesn't exist, can't be read, etc.
+	Does NOT delete the code (i.e. it could be valid again if asked again).
+	"""
 	try:
-		expiration_date = _tstr2tint(data)
+		expiration_date = _getStore().get(code)
 	except Exception:
 		return False
+	if expiration_date is None:
+		return False
 	
 	return time.time() < expiration_date
 
 def delete(code):
-	"""delete the code from disk, thus invalidating it
+	"""delete the code, thus invalidating it
 	
 	If it already doesn't exist, silently return.
-	Raises an exception if the file can't be deleted or ensured gone.
+	Raises an exception if the code can't be deleted or ensured gone.
 	"""
-	path = _code2path(code)
-	try:
-		os.stat(path)
-	except OSError, e:
-		if hasattr(e, 'errno') and e.errno==2:  #e.g. OSError: [Errno 2] No such file or directory: '/'...
-			return
-		else:
-			raise
-	
-	os.remove(path)  #let this raise whatever exception it may hit
+	_getStore().delete(code)  #let this raise whatever exception it may hit
+
+def sweep(batch_size=1000, max_batches=None, full=False):
+	"""remove expired codes, batch_size at a time, stopping after max_batches batches if given
+
+	If full is True, also look through every code for expired ones missing from the index (i.e. ones made before the index existed); this looks at every code, so it's slow for big OTEC_DIRs.
+	Returns a dict with the counts of index entries looked at ('looked'), codes removed ('removed'), and batches ('batches'), and the time taken ('seconds').
+	"""
+	t0 = time.time()
+	now = int(t0)
+	store = _getStore()
+	looked, removed, batches = 0, 0, 0
+	if full:
+		looked, removed = store.sweepUnindexed(now)
+		batches = 1
+	else:
+		while max_batches is None or batches < max_batches:
+			n, m = store.sweep(now, batch_size)
+			looked += n
+			removed += m
+			if n==0: break
+			batches += 1
+			if n < batch_size: break
+	return {'looked': looked, 'removed': removed, 'batches': batches, 'seconds': time.time() - t0}
+
+def migrate():
+	"""bring codes stored in a legacy format up to date (for the 'dir' BACKEND, add them to the expiration index, so sweep() finds them)
+
+	Codes are not changed, so ones used meanwhile stay used.  Returns a dict with the counts of codes looked at ('looked') and migrated ('migrated'), and the time taken ('seconds').
+	"""
+	t0 = time.time()
+	looked, migrated = _getStore().migrate()
+	return {'looked': looked, 'migrated': migrated, 'seconds': time.time() - t0}
@@ -0,0 +1,357 @@
+"""
+QR Code encoding
+
+DESCRIPTION
+	A small, in-process QR Code encoder (model 2, byte mode, error correction
+	level L or M) and a minimal PNG writer for the result.  This replaces
+	running qrencode for every qrcode.png download.
+
+	Only what openauth needs is implemented -- no numeric/alphanumeric/kanji
+	segments, no Micro QR, no structured append.
+
+REQUIREMENTS
+	n/a
+
+IMPLEMENTATION NOTES
+	The encoding follows ISO/IEC 18004: pick the smallest version that fits,
+	add Reed-Solomon error correction per block, interleave, draw the function
+	patterns, place the codewords, and choose the mask with the lowest
+	penalty score.
+
+	The PNG is 1-bit grayscale, scale pixels per module, with a margin
+	(quiet zone) of margin modules on each side -- the same defaults as
+	`qrencode -s 6`.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import struct, zlib
+
+
+#--- tables
+
+#index 0 of each is unused (there is no version 0)
+_ECC_CODEWORDS_PER_BLOCK = {
+	'L': (-1,  7, 10, 15, 20, 26, 18, 20, 24, 30, 18, 20, 24, 26, 30, 22, 24, 28, 30, 28, 28, 28, 28, 30, 30, 26, 28, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30, 30),
+	'M': (-1, 10, 16, 26, 18, 24, 16, 18, 22, 22, 26, 30, 22, 22, 24, 24, 28, 28, 26, 26, 26, 26, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28, 28),
+}
+_NUM_ERROR_CORRECTION_BLOCKS = {
+	'L': (-1, 1, 1, 1, 1, 1, 2, 2, 2, 2,  4,  4,  4,  4,  4,  6,  6,  6,  6,  7,  8,  8,  9,  9, 10, 12, 12, 12, 13, 14, 15, 16, 17, 18, 19, 19, 20, 21, 22, 24, 25),
+	'M': (-1, 1, 1, 1, 2, 2, 4, 4, 4, 5,  5,  5,  8,  9,  9, 10, 10, 11, 13, 14, 16, 17, 17, 18, 20, 21, 23, 25, 26, 28, 29, 31, 33, 35, 37, 38, 40, 43, 45, 47, 49),
+}
+_FORMAT_BITS = {'L': 1, 'M': 0}
+
+#GF(2^8) with the QR Code polynomial x^8 + x^4 + x^3 + x^2 + 1
+_GF_EXP = [0]*512
+_GF_LOG = [0]*256
+_x = 1
+for _i in range(255):
+	_GF_EXP[_i] = _x
+	_GF_LOG[_x] = _i
+	_x <<= 1
+	if _x & 0x100: _x ^= 0x11D
+for _i in range(255, 512):
+	_GF_EXP[_i] = _GF_EXP[_i-255]
+del _x, _i
+
+_MASKS = (
+	lambda x, y: (x + y) % 2 == 0,
+	lambda x, y: y % 2 == 0,
+	lambda x, y: x % 3 == 0,
+	lambda x, y: (x + y) % 3 == 0,
+	lambda x, y: (x // 3 + y // 2) % 2 == 0,
+	lambda x, y: x * y % 2 + x * y % 3 == 0,
+	lambda x, y: (x * y % 2 + x * y % 3) % 2 == 0,
+	lambda x, y: ((x + y) % 2 + x * y % 3) % 2 == 0,
+)
+
+
+#--- internal helpers
+
+def _numRawDataModules(version):
+	"""return the number of modules available for data and ecc codewords (including remainder bits)"""
+	result = (16*version + 128)*version + 64
+	if version >= 2:
+		numalign = version//7 + 2
+		result -= (25*numalign - 10)*numalign - 55
+		if version >= 7: result -= 36
+	return result
+
+def _numDataCodewords(version, ecl):
+	"""return the number of 8-bit data codewords that fit in the given version and error correction level"""
+	return _numRawDataModules(version)//8 - _ECC_CODEWORDS_PER_BLOCK[ecl][version]*_NUM_ERROR_CORRECTION_BLOCKS[ecl][version]
+
+def _rsDivisor(degree):
+	"""return the Reed-Solomon generator polynomial of the given degree (highest coefficient dropped)"""
+	result = [0]*(degree - 1) + [1]
+	root = 1
+	for i in range(degree):
+		for j in range(degree):
+			result[j] = _gfMultiply(result[j], root)
+			if j + 1 < degree: result[j] ^= result[j+1]
+		root = _gfMultiply(root, 0x02)
+	return result
+
+def _rsRemainder(data, divisor):
+	"""return the Reed-Solomon ecc codewords for data"""
+	result = [0]*len(divisor)
+	for b in data:
+		factor = b ^ result.pop(0)
+		result.append(0)
+		if factor:
+			logf = _GF_LOG[factor]
+			for i, coef in enumerate(divisor):
+				if coef: result[i] ^= _GF_EXP[_GF_LOG[coef] + logf]
+	return result
+
+def _gfMultiply(x, y):
+	if x==0 or y==0: return 0
+	return _GF_EXP[_GF_LOG[x] + _GF_LOG[y]]
+
+def _encodeCodewords(data, version, ecl):
+	"""return the list of final (data + ecc, interleaved) codewords for the given bytes"""
+	#bit stream: byte mode indicator, character count, data
+	bits = []
+	def append(value, length):
+		for i in range(length-1, -1, -1): bits.append((value >> i) & 1)
+	append(0x4, 4)
+	if version <= 9: append(len(data), 8)
+	else           : append(len(data), 16)
+	for c in data: append(ord(c), 8)
+
+	#terminator, byte alignment, then alternating pad bytes
+	capacity = _numDataCodewords(version, ecl)*8
+	append(0, min(4, capacity - len(bits)))
+	append(0, -len(bits) % 8)
+	pad = 0xEC
+	while len(bits) < capacity:
+		append(pad, 8)
+		pad ^= 0xEC ^ 0x11
+	datacodewords = [ int(''.join(map(str, bits[i:i+8])), 2) for i in range(0, len(bits), 8) ]
+
+	#split into blocks and add ecc to each
+	numblocks = _NUM_ERROR_CORRECTION_BLOCKS[ecl][version]
+	blockecclen = _ECC_CODEWORDS_PER_BLOCK[ecl][version]
+	rawcodewords = _numRawDataModules(version)//8
+	numshortblocks = numblocks - rawcodewords % numblocks
+	shortblocklen = rawcodewords//numblocks
+	divisor = _rsDivisor(blockecclen)
+	blocks = []
+	k = 0
+	for i in range(numblocks):
+		datlen = shortblocklen - blockecclen + (i >= numshortblocks and 1 or 0)
+		dat = datacodewords[k:k+datlen]
+		k += datlen
+		block = dat + _rsRemainder(dat, divisor)
+		if i < numshortblocks: block.insert(datlen, None)  #(placeholder so all blocks are the same length)
+		blocks.append(block)
+
+	#interleave
+	result = []
+	for i in range(len(blocks[0])):
+		for block in blocks:
+			if block[i] is not None: result.append(block[i])
+	return result
+
+class _Matrix(object):
+	"""the modules of one symbol, plus which of them are function patterns"""
+
+	def __init__(self, version):
+		self.version = version
+		self.size = version*4 + 17
+		self.modules    = [ [False]*self.size for i in range(self.size) ]
+		self.isfunction = [ [False]*self.size for i in range(self.size) ]
+
+	def setFunction(self, x, y, dark):
+		self.modules[y][x] = dark
+		self.isfunction[y][x] = True
+
+	def drawFunctionPatterns(self):
+		size = self.size
+		#timing patterns
+		for i in range(size):
+			self.setFunction(6, i, i % 2 == 0)
+			self.setFunction(i, 6, i % 2 == 0)
+		#finder patterns (with separators)
+		for cx, cy in ((3, 3), (size-4, 3), (3, size-4)):
+			for dy in range(-4, 5):
+				for dx in range(-4, 5):
+					x, y = cx + dx, cy + dy
+					if 0 <= x < size and 0 <= y < size:
+						self.setFunction(x, y, max(abs(dx), abs(dy)) not in (2, 4))
+		#alignment patterns
+		positions = self.alignmentPositions()
+		n = len(positions)
+		for i in range(n):
+			for j in range(n):
+				if (i, j) in ((0, 0), (0, n-1), (n-1, 0)): continue  #(overlaps a finder)
+				for dy in range(-2, 3):
+					for dx in range(-2, 3):
+						self.setFunction(positions[i] + dx, positions[j] + dy, max(abs(dx), abs(dy)) != 1)
+		#reserve the format areas (the real bits are drawn once the mask is chosen)
+		self.drawFormatBits('L', 0)
+		self.drawVersion()
+
+	def alignmentPositions(self):
+		if self.version == 1: return []
+		numalign = self.version//7 + 2
+		step = (self.version*8 + numalign*3 + 5)//(numalign*4 - 4)*2
+		result = [ self.size - 7 - i*step for i in range(numalign - 1) ] + [6]
+		result.reverse()
+		return result
+
+	def drawFormatBits(self, ecl, mask):
+		size = self.size
+		data = _FORMAT_BITS[ecl] << 3 | mask
+		rem = data
+		for i in range(10): rem = (rem << 1) ^ ((rem >> 9)*0x537)
+		bits = (data << 10 | rem) ^ 0x5412
+		bit = lambda i: (bits >> i) & 1 != 0
+		#first copy, around the top left finder
+		for i in range(0, 6): self.setFunction(8, i, bit(i))
+		self.setFunction(8, 7, bit(6))
+		self.setFunction(8, 8, bit(7))
+		self.setFunction(7, 8, bit(8))
+		for i in range(9, 15): self.setFunction(14 - i, 8, bit(i))
+		#second copy, split between the other two finders
+		for i in range(0, 8): self.setFunction(size - 1 - i, 8, bit(i))
+		for i in range(8, 15): self.setFunction(8, size - 15 + i, bit(i))
+		self.setFunction(8, size - 8, True)  #(the dark module)
+
+	def drawVersion(self):
+		if self.version < 7: return
+		rem = self.version
+		for i in range(12): rem = (rem << 1) ^ ((rem >> 11)*0x1F25)
+		bits = self.version << 12 | rem
+		for i in range(18):
+			dark = (bits >> i) & 1 != 0
+			a = self.size - 11 + i % 3
+			b = i//3
+			self.setFunction(a, b, dark)
+			self.setFunction(b, a, dark)
+
+	def drawCodewords(self, codewords):
+		size = self.size
+		i = 0
+		nbits = len(codewords)*8
+		right = size - 1
+		while right >= 1:
+			if right == 6: right = 5  #(skip the vertical timing pattern)
+			upward = (right + 1) & 2 == 0
+			for vert in range(size):
+				if upward: y = size - 1 - vert
+				else     : y = vert
+				for x in (right, right - 1):
+					if not self.isfunction[y][x] and i < nbits:
+						self.modules[y][x] = (codewords[i >> 3] >> (7 - (i & 7))) & 1 != 0
+						i += 1
+			right -= 2
+
+	def applyMask(self, mask):
+		f = _MASKS[mask]
+		for y in range(self.size):
+			row = self.modules[y]
+			isfunction = self.isfunction[y]
+			for x in range(self.size):
+				if not isfunction[x] and f(x, y): row[x] = not row[x]
+
+	def penalty(self):
+		"""return the penalty score of the current modules (lower is better)"""
+		size = self.size
+		result = 0
+		rows = [ ''.join([ m and '1' or '0' for m in row ]) for row in self.modules ]
+		cols = [ ''.join([ rows[y][x] for y in range(size) ]) for x in range(size) ]
+		for line in rows + cols:
+			#runs of 5 or more of the same color
+			run = 1
+			for i in range(1, size + 1):
+				if i < size and line[i] == line[i-1]:
+					run += 1
+				else:
+					if run >= 5: result += 3 + (run - 5)
+					run = 1
+			#finder-like patterns (the quiet zone counts as light)
+			padded = '0000%s0000' % line
+			for pattern in ('10111010000', '00001011101'):
+				start = padded.find(pattern)
+				while start != -1:
+					result += 40
+					start = padded.find(pattern, start + 1)
+		#2x2 blocks of the same color
+		for y in range(size - 1):
+			r0, r1 = rows[y], rows[y+1]
+			for x in range(size - 1):
+				if r0[x] == r0[x+1] == r1[x] == r1[x+1]: result += 3
+		#balance of dark and light
+		dark = sum([ row.count('1') for row in rows ])
+		total = size*size
+		result += ((abs(dark*20 - total*10) + total - 1)//total - 1)*10
+		return result
+
+
+#--- main methods
+
+def encode(data, ecl='L'):
+	"""return the modules of the QR Code encoding data (a byte string) as a list of rows of booleans (True is dark)
+
+	ecl is the error correction level, 'L' or 'M'.
+	Raises a ValueError if the data is too long for any version.
+	"""
+	if ecl not in _FORMAT_BITS: raise ValueError("unsupported error correction level [%s]" % ecl)
+	for version in range(1, 41):
+		countbits = version <= 9 and 8 or 16
+		if 4 + countbits + len(data)*8 <= _numDataCodewords(version, ecl)*8: break
+	else:
+		raise ValueError("data too long for a QR Code [%d bytes]" % len(data))
+
+	codewords = _encodeCodewords(data, version, ecl)
+
+	m = _Matrix(version)
+	m.drawFunctionPatterns()
+	m.drawCodewords(codewords)
+
+	best, bestpenalty = None, None
+	for mask in range(8):
+		m.applyMask(mask)
+		m.drawFormatBits(ecl, mask)
+		penalty = m.penalty()
+		if bestpenalty is None or penalty < bestpenalty:
+			best, bestpenalty = mask, penalty
+		m.applyMask(mask)  #(xor again to undo)
+	m.applyMask(best)
+	m.drawFormatBits(ecl, best)
+	return m.modules
+
+def png(data, ecl='L', scale=6, margin=4):
+	"""return the bytes of a PNG image of the QR Code encoding data
+
+	scale is the size of each module in pixels; margin is the width of the quiet zone in modules.
+	"""
+	modules = encode(data, ecl)
+	size = len(modules) + 2*margin
+	width = size*scale
+
+	def rowbytes(row):
+		#1 bit per pixel, 1 is white
+		bits = ''.join([ (dark and '0' or '1')*scale for dark in row ])
+		bits += '0'*(-len(bits) % 8)
+		return '\0' + ''.join([ chr(int(bits[i:i+8], 2)) for i in range(0, len(bits), 8) ])  #(leading filter type byte: none)
+
+	blank = rowbytes([False]*size)
+	raw = []
+	raw.append(blank*(margin*scale))
+	for row in modules:
+		raw.append(rowbytes([False]*margin + row + [False]*margin)*scale)
+	raw.append(blank*(margin*scale))
+
+	def chunk(tag, body):
+		return struct.pack('>I', len(body)) + tag + body + struct.pack('>I', zlib.crc32(tag + body) & 0xffffffff)
+
+	return ''.join([
+		'\x89PNG\r\n\x1a\n',
+		chunk('IHDR', struct.pack('>IIBBBBB', width, width, 1, 0, 0, 0, 0)),
+		chunk('IDAT', zlib.compress(''.join(raw), 9)),
+		chunk('IEND', ''),
+	])
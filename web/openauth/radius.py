@@ -0,0 +1,270 @@
+"""
+a RADIUS front end for openauth verification
+
+DESCRIPTION
+	A UDP RADIUS server (RFC 2865) that answers Access-Requests by checking
+	the PAP User-Password as an openauth code for the User-Name, through
+	verify.py, so the RADIUS servers used for second-factor authentication
+	on SSH and VPN can be this instead of a pam_google_authenticator
+	recipe.  See misc/radiusd to run it, and misc/radius_loadgen to load
+	test it.
+
+	Clients (the NASes, i.e. the SSH/VPN hosts' RADIUS plugins) are
+	identified by source IP address and each has its own shared secret.
+	Requests from unknown addresses, or with a bad Message-Authenticator,
+	are dropped without an answer, as the RFC says, as are ones whose
+	User-Name is not a plausible username (see openauth.isValidUsername()).
+	If a request has a Message-Authenticator (RFC 3579), so does the
+	response; with require_message_authenticator, requests without one are
+	dropped.
+
+	Retransmissions of a request already answered (same client, identifier,
+	and authenticator) get the same answer again rather than being verified
+	again (which would fail, since the code has now been used).
+
+REQUIREMENTS
+	n/a
+
+IMPLEMENTATION NOTES
+	This is a single-threaded select() loop on one non-blocking socket:
+	each wakeup reads and answers every datagram waiting, so many requests
+	are in flight at once without threads (verification takes tens of
+	microseconds, and only opens the secret file; see openauth's secret
+	cache, which should be sized for all users, config2.SECRET_CACHE_SIZE).
+	(This package is python 2, so there is no asyncio.)  Run one process per
+	server: the replay index and learned drift are in memory (see
+	verify.Verifier).
+
+	Only Access-Request is handled; Accounting is not.  Only PAP is
+	supported (CHAP can't work with one-time codes that must be checked
+	against a secret, not a stored password).
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, socket, select, struct, hashlib, hmac, errno
+from lilpsp import core
+import openauth, verify
+
+
+ACCESS_REQUEST   = 1
+ACCESS_ACCEPT    = 2
+ACCESS_REJECT    = 3
+
+ATTR_USER_NAME             = 1
+ATTR_USER_PASSWORD         = 2
+ATTR_REPLY_MESSAGE         = 18
+ATTR_MESSAGE_AUTHENTICATOR = 80
+
+#the most a RADIUS packet may be
+MAX_PACKET = 4096
+
+#seconds to keep answers, to repeat them for retransmitted requests
+DUPLICATE_SECONDS = 30
+
+
+
+#--- packets
+
+def parsePacket(data):
+	"""return (code, identifier, authenticator, attributes) for the packet data, where attributes is a list of (type, value)
+
+	Raises ValueError if it's malformed.
+	"""
+	if len(data) < 20: raise ValueError("packet too short")
+	code, ident, length = struct.unpack('!BBH', data[:4])
+	if length < 20 or length > len(data): raise ValueError("bad packet length")
+	authenticator = data[4:20]
+	attributes = []
+	i = 20
+	while i < length:
+		if i + 2 > length: raise ValueError("truncated attribute")
+		t, l = struct.unpack('!BB', data[i:i+2])
+		if l < 2 or i + l > length: raise ValueError("bad attribute length")
+		attributes.append((t, data[i+2:i+l]))
+		i += l
+	return code, ident, authenticator, attributes
+
+def buildPacket(code, ident, authenticator, attributes):
+	"""return the bytes of a packet"""
+	attrs = ''.join([ struct.pack('!BB', t, len(v)+2) + v for t, v in attributes ])
+	return struct.pack('!BBH', code, ident, 20 + len(attrs)) + authenticator + attrs
+
+def getAttribute(attributes, t):
+	"""return the value of the first attribute of type t, or None"""
+	for at, v in attributes:
+		if at==t: return v
+	return None
+
+def messageAuthenticator(packet, secret):
+	"""return the Message-Authenticator for packet (which must contain one, with any value), i.e. the HMAC-MD5 of the packet with that value zeroed"""
+	code, ident, authenticator, attributes = parsePacket(packet)
+	zeroed = [ (t, t==ATTR_MESSAGE_AUTHENTICATOR and '\0'*16 or v) for t, v in attributes ]
+	return hmac.new(secret, buildPacket(code, ident, authenticator, zeroed), hashlib.md5).digest()
+
+def _equal(a, b):
+	"""return whether the strings a and b are equal, taking the same time wherever they differ (hmac.compare_digest, if this python has it)"""
+	if hasattr(hmac, 'compare_digest'): return hmac.compare_digest(a, b)
+	if len(a)!=len(b): return False
+	d = 0
+	for x, y in zip(a, b):
+		d |= ord(x) ^ ord(y)
+	return d==0
+
+def _xor(a, b):
+	return ''.join([ chr(ord(x) ^ ord(y)) for x, y in zip(a, b) ])
+
+def encodePassword(password, secret, authenticator):
+	"""return the User-Password attribute value for password (RFC 2865 section 5.2)"""
+	if password=='': password = '\0'*16
+	else           : password += '\0' * (-len(password) % 16)
+	result = ''
+	last = authenticator
+	for i in range(0, len(password), 16):
+		last = _xor(password[i:i+16], hashlib.md5(secret + last).digest())
+		result += last
+	return result
+
+def decodePassword(value, secret, authenticator):
+	"""return the password from a User-Password attribute value (RFC 2865 section 5.2)"""
+	if len(value) % 16 or not value: raise ValueError("bad User-Password length")
+	result = ''
+	last = authenticator
+	for i in range(0, len(value), 16):
+		result += _xor(value[i:i+16], hashlib.md5(secret + last).digest())
+		last = value[i:i+16]
+	return result.rstrip('\0')
+
+def response(request_authenticator, ident, code, attributes, secret, message_authenticator=False):
+	"""return the bytes of a response to the request with the given identifier and authenticator"""
+	if message_authenticator:
+		attributes = list(attributes) + [(ATTR_MESSAGE_AUTHENTICATOR, '\0'*16)]
+		packet = buildPacket(code, ident, request_authenticator, attributes)
+		attributes[-1] = (ATTR_MESSAGE_AUTHENTICATOR, messageAuthenticator(packet, secret))
+	packet = buildPacket(code, ident, request_authenticator, attributes)
+	return packet[:4] + hashlib.md5(packet + secret).digest() + packet[20:]
+
+def accessRequest(ident, username, password, secret, message_authenticator=True):
+	"""return (packet bytes, request authenticator) for a PAP Access-Request (the client side, for testing)"""
+	authenticator = os.urandom(16)
+	attributes = [(ATTR_USER_NAME, username), (ATTR_USER_PASSWORD, encodePassword(password, secret, authenticator))]
+	if message_authenticator:
+		attributes.append((ATTR_MESSAGE_AUTHENTICATOR, '\0'*16))
+		packet = buildPacket(ACCESS_REQUEST, ident, authenticator, attributes)
+		attributes[-1] = (ATTR_MESSAGE_AUTHENTICATOR, messageAuthenticator(packet, secret))
+	return buildPacket(ACCESS_REQUEST, ident, authenticator, attributes), authenticator
+
+def checkResponse(packet, request_authenticator, secret):
+	"""return the code of a response packet (the client side, for testing), or raise ValueError if its authenticator is wrong"""
+	code, ident, authenticator, attributes = parsePacket(packet)
+	if hashlib.md5(packet[:4] + request_authenticator + packet[20:] + secret).digest()!=authenticator: raise ValueError("bad response authenticator")
+	return code
+
+
+#--- server
+
+def readClients(filename):
+	"""return a dict of client IP address to shared secret from a file of lines "ADDRESS SECRET" (blank lines and # comments are ignored)"""
+	clients = {}
+	f = open(filename)
+	try:
+		for line in f:
+			line = line.strip()
+			if line=='' or line.startswith('#'): continue
+			address, secret = line.split(None, 1)
+			clients[address] = secret
+	finally:
+		f.close()
+	return clients
+
+class Server(object):
+	"""the RADIUS server (see the module docstring)
+
+	clients is a dict of client IP address to shared secret.
+	"""
+
+	def __init__(self, clients, address=('', 1812), verifier=None, require_message_authenticator=False):
+		self.clients = clients
+		self.verifier = verifier or verify.Verifier()
+		self.require_message_authenticator = require_message_authenticator
+		self.answered = core.TTLCache(100000, DUPLICATE_SECONDS)  #(client address, identifier, authenticator) -> response
+		self.counts = {'accept': 0, 'reject': 0, 'duplicate': 0, 'dropped': 0, 'errors': 0}
+		self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+		self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
+		self.sock.bind(address)
+		self.sock.setblocking(0)
+		self.address = self.sock.getsockname()
+
+	def handle(self, data, client):
+		"""return the response to the datagram data from client (an (ip, port) pair), or None to not answer
+
+		This never raises an Exception (one that happens is logged, and the request is not answered), so one bad request can't stop the server.
+		"""
+		try:
+			return self._handle(data, client)
+		except Exception, e:
+			self.counts['errors'] += 1
+			core.log("radius: ERROR: failed to handle a request from client [%s]: %s" % (client[0], e), e=e)
+			return None
+
+	def _handle(self, data, client):
+		secret = self.clients.get(client[0])
+		if secret is None:
+			self.counts['dropped'] += 1
+			core.log("radius: dropped a request from unknown client [%s]" % client[0])
+			return None
+		try:
+			code, ident, authenticator, attributes = parsePacket(data)
+			if code!=ACCESS_REQUEST: raise ValueError("not an Access-Request")
+			key = (client, ident, authenticator)
+			answer = self.answered.get(key)
+			if answer is not None:
+				self.counts['duplicate'] += 1
+				return answer
+			ma = getAttribute(attributes, ATTR_MESSAGE_AUTHENTICATOR)
+			if ma is not None:
+				if not _equal(ma, messageAuthenticator(data[:struct.unpack('!H', data[2:4])[0]], secret)): raise ValueError("bad Message-Authenticator")
+			elif self.require_message_authenticator:
+				raise ValueError("no Message-Authenticator")
+			username = getAttribute(attributes, ATTR_USER_NAME)
+			password = getAttribute(attributes, ATTR_USER_PASSWORD)
+			if username is None or password is None: raise ValueError("no User-Name or User-Password")
+			if not openauth.isValidUsername(username): raise ValueError("bad User-Name %r" % username)
+			password = decodePassword(password, secret, authenticator)
+		except ValueError, e:
+			self.counts['dropped'] += 1
+			core.log("radius: dropped a request from client [%s]: %s" % (client[0], e))
+			return None
+
+		if self.verifier.verify(username, password):
+			self.counts['accept'] += 1
+			answer = response(authenticator, ident, ACCESS_ACCEPT, [], secret, ma is not None)
+		else:
+			self.counts['reject'] += 1
+			core.log("radius: rejected user [%s] from client [%s]" % (username, client[0]))
+			answer = response(authenticator, ident, ACCESS_REJECT, [(ATTR_REPLY_MESSAGE, 'Invalid code')], secret, ma is not None)
+		self.answered.set(key, answer)
+		return answer
+
+	def serveOnce(self, timeout=None):
+		"""wait up to timeout seconds for requests, and answer all that are waiting"""
+		r, w, x = select.select([self.sock], [], [], timeout)
+		if not r: return
+		while True:
+			try:
+				data, client = self.sock.recvfrom(MAX_PACKET)
+			except socket.error, e:
+				if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR): return
+				raise
+			answer = self.handle(data, client)
+			if answer is not None:
+				try:
+					self.sock.sendto(answer, client)
+				except socket.error, e:
+					core.log("radius: failed to answer client [%s]: %s" % (client[0], e))
+
+	def serveForever(self):
+		while True:
+			self.serveOnce(1.0)
@@ -0,0 +1,207 @@
+"""
+rate limiting and admission control
+
+DESCRIPTION
+	Two things keep a burst of reloads, or a scripted client, from turning
+	into unbounded emails, otecs, subprocesses, and zip builds:
+
+	- admit(flow, username, ip) takes a token from the flow's bucket for the
+	  user and from its bucket for the client address, and says how long to
+	  wait if either is empty.  The pages call it before doing any work
+	  (before otecs are made or checked, and before secrets are read), so a
+	  rejection costs one small database transaction.
+
+	- Slot(name) is a semaphore of SLOTS[name] slots shared by every process
+	  on the host, for bounding how many of something expensive (zip builds,
+	  mail sends) run at once.  acquire() waits up to SLOT_WAIT seconds for
+	  one and otherwise gives up, so a backlog is shed rather than queued.
+
+	LIMITS and SLOTS name the flows; see config2.RATE_LIMITS and
+	config2.RATE_SLOTS for what openauth uses.
+
+REQUIREMENTS
+	filesystem:
+		make sure the directory containing DB, and SLOTS_DIR, exist and are
+		writable by whatever runs this process (e.g. apache)
+
+	sqlite3 python module
+
+IMPLEMENTATION NOTES
+	Buckets are rows of (key, tokens, updated) in an SQLite database,
+	shared by all worker processes (prefork apache children, WSGI workers).
+	A bucket's tokens are refilled lazily when it's next used, so nothing
+	runs in the background; a bucket with no row is full, so rows not
+	touched for longer than any bucket takes to refill are swept now and
+	then (see SWEEP_EVERY).  Like otec's 'sqlite' backend, the database uses
+	write-ahead logging and must be on local disk, so limits are per web
+	server.
+
+	If the database can't be used (e.g. it's locked for longer than
+	DB_TIMEOUT), admit() logs it and lets the request through: the limiter
+	is there to shed load, not to be a reason the site is down.
+
+	A slot is an flock on one of the files NAME.0 .. NAME.N-1 in SLOTS_DIR,
+	so a slot held by a process that dies is freed by the kernel.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, errno, time, random, fcntl, threading
+from lilpsp import core
+
+
+#Something that imports this module may choose to change these values, but of
+#course one must make sure all modules that do so do it consistently.
+
+#DB -- the bucket database file, or None to not limit rates (admit() lets everything through)
+DB = None
+
+#DB_TIMEOUT -- seconds to wait for the database lock before giving up (and letting the request through)
+DB_TIMEOUT = 1.0
+
+#LIMITS -- flow name -> {'user': (burst, seconds per token), 'ip': (burst, seconds per token)}
+#Either scope may be left out, for no limit on it.
+LIMITS = {}
+
+#SLOTS_DIR -- the directory with the slot lock files, or None to not bound anything (acquire() always succeeds)
+SLOTS_DIR = None
+
+#SLOTS -- slot name -> how many may be held at once
+SLOTS = {}
+
+#SLOT_WAIT -- seconds acquire() waits for a free slot by default
+SLOT_WAIT = 5.0
+
+#SWEEP_EVERY -- remove the rows of full buckets every this many admit() calls (per process)
+SWEEP_EVERY = 1000
+
+
+#--- token buckets
+
+class _Store(object):
+	"""the bucket database"""
+
+	def __init__(self, filename):
+		import sqlite3
+		self.filename = filename
+		self.db = sqlite3.connect(filename, timeout=DB_TIMEOUT, isolation_level=None)  #(autocommit, except inside explicit BEGINs)
+		self.db.execute('PRAGMA journal_mode=WAL')
+		self.db.execute('PRAGMA synchronous=OFF')  #(losing the last few takes in a crash is harmless)
+		self.db.execute('CREATE TABLE IF NOT EXISTS bucket (key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)')
+
+	def take(self, buckets, now):
+		"""take a token from each of buckets, a list of (key, burst, seconds per token), if every one has one; return 0 if they did, else the seconds until they all would"""
+		self.db.execute('BEGIN IMMEDIATE')  #(take the write lock now, so two processes can't both read the same count)
+		try:
+			wait = 0
+			rows = []
+			for key, burst, per in buckets:
+				row = self.db.execute('SELECT tokens, updated FROM bucket WHERE key = ?', (key,)).fetchone()
+				if row is None: tokens = float(burst)
+				else          : tokens = min(float(burst), row[0] + (now - row[1])/per)
+				if tokens < 1: wait = max(wait, (1 - tokens)*per)
+				rows.append((key, tokens - 1, now))
+			if wait==0:
+				self.db.executemany('INSERT OR REPLACE INTO bucket (key, tokens, updated) VALUES (?, ?, ?)', rows)
+		except Exception:
+			self.db.execute('ROLLBACK')
+			raise
+		self.db.execute('COMMIT')
+		return wait
+
+	def sweep(self, before):
+		"""remove the rows of buckets untouched since before; return how many"""
+		return self.db.execute('DELETE FROM bucket WHERE updated < ?', (before,)).rowcount
+
+	def clear(self):
+		self.db.execute('DELETE FROM bucket')
+
+_local = threading.local()  #(.stores, per thread)
+_admitcount = 0  #(for SWEEP_EVERY)
+
+def _getStore():
+	"""return the store for DB (per thread and per process, so the connection is not shared across threads, which sqlite3 does not allow, or across a fork)"""
+	key = (DB, os.getpid())
+	stores = _local.__dict__.setdefault('stores', {})
+	try:
+		return stores[key]
+	except KeyError:
+		store = stores[key] = _Store(DB)
+		return store
+
+def _refillSeconds():
+	"""return the longest any bucket in LIMITS takes to fill from empty"""
+	return max([0] + [ burst*per for scopes in LIMITS.values() for burst, per in scopes.values() ])
+
+def admit(flow, username, ip, now=None):
+	"""take a token for the flow from the user's bucket and the ip address's; return None if the request may go ahead, else the seconds until it could
+
+	username or ip may be None to leave that bucket out.
+	A flow not in LIMITS is always admitted.
+	"""
+	limits = LIMITS.get(flow)
+	if DB is None or not limits: return None
+	if now is None: now = time.time()
+	buckets = []
+	if username is not None and limits.has_key('user'): buckets.append(('user:%s:%s' % (flow, username), limits['user'][0], limits['user'][1]))
+	if ip       is not None and limits.has_key('ip')  : buckets.append(('ip:%s:%s'   % (flow, ip)      , limits['ip'][0]  , limits['ip'][1]))
+	if not buckets: return None
+
+	global _admitcount
+	try:
+		store = _getStore()
+		wait = store.take(buckets, now)
+		_admitcount += 1
+		if SWEEP_EVERY and _admitcount % SWEEP_EVERY == 0:
+			store.sweep(now - _refillSeconds())
+	except Exception, e:
+		core.log("ERROR: rate limiting is not working, letting the request through: %s" % e, e=e)
+		return None
+	if wait: return wait
+	return None
+
+def reset():
+	"""empty the bucket database, i.e. fill every bucket"""
+	if DB is not None: _getStore().clear()
+
+
+#--- slots
+
+class Slot(object):
+	"""one of the SLOTS[name] slots for name (see the module docstring); a name not in SLOTS has no bound"""
+
+	def __init__(self, name):
+		self.name = name
+		self.f = None
+
+	def acquire(self, wait=None):
+		"""take a free slot, waiting up to wait seconds (default SLOT_WAIT) for one; return whether one was taken"""
+		if SLOTS_DIR is None or not SLOTS.has_key(self.name): return True
+		if wait is None: wait = SLOT_WAIT
+		deadline = time.time() + wait
+		order = range(SLOTS[self.name])
+		delay = 0.005
+		while True:
+			random.shuffle(order)  #(so waiters don't all pile onto slot 0)
+			for i in order:
+				f = open(os.path.join(SLOTS_DIR, '%s.%d' % (self.name, i)), 'a')
+				try:
+					fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+				except IOError, e:
+					f.close()
+					if e.errno not in (errno.EAGAIN, errno.EACCES): raise
+					continue
+				self.f = f
+				return True
+			now = time.time()
+			if now >= deadline: return False
+			time.sleep(min(delay, deadline - now))
+			delay = min(delay*2, 0.1)
+
+	def release(self):
+		"""free the slot, if one is held"""
+		if self.f is not None:
+			self.f.close()  #(releases the flock)
+			self.f = None
@@ -0,0 +1,426 @@
+"""
+keeping a local replica of the secrets tree
+
+DESCRIPTION
+	A Replicator keeps a copy of the secrets tree (the source, normally
+	config2.SECRETS_ROOT_DIR on the NFS share) in a local directory (the
+	replica, e.g. hadir's local cache that the RADIUS servers fail over to),
+	copying only the users whose secrets changed, instead of rsync'ing the
+	whole tree.  See misc/replicad to run one.
+
+	Each changed user's secret file is copied with openauth's atomic write
+	(a temporary file renamed into place, mode 0400), so the replica never
+	has a partial s file, and temporary files in the source (s~, .s.*) are
+	never copied.  A user whose secret is gone from the source is removed
+	from the replica.  The replica is always in config2.SECRETS_LAYOUT; the
+	source may be in either layout, or both, mid-migration.
+
+	A source that looks broken is not taken as a reason to empty the
+	replica, since it's much more likely the share isn't mounted than that
+	everyone was revoked:
+
+	- if the source directory can't be listed, or is empty, or every user
+	  is gone from it, nothing is removed from the replica for as long as
+	  that lasts (the users under a subdirectory that can't be listed are
+	  likewise kept)
+	- if a large share of the users are gone from it at once (see
+	  VANISH_MIN and VANISH_FRACTION), their removal is held back for
+	  VANISH_HOLD_SCANS scans, in case they come back, and then done
+
+	Both are logged as errors.  Changed secrets are still copied, and users
+	that go missing later are judged on their own, not along with the ones
+	held back.  allow_mass_removal turns both off (see replicad's
+	--allow-mass-removal), for when everyone really was revoked.
+
+	Changes are found two ways:
+
+	- inotify events (create, modify, delete, rename) on every directory of
+	  the source, so a change is applied as soon as it happens
+	- a scan every scan_seconds, which stats every secret file in the
+	  source and compares it to what was last copied
+
+	inotify only sees changes made through this host's kernel, so on NFS,
+	where the secrets are written by the web servers, the scan is what finds
+	most changes and should run often (e.g. every 10 seconds); where the
+	source is local, it's just a safety net for missed events (e.g. a queue
+	overflow, which also triggers one).
+
+REQUIREMENTS
+	linux, for inotify (without it, only the scan is used)
+
+IMPLEMENTATION NOTES
+	The work done for a change is proportional to the number of users that
+	changed: a read of the source file, a read of the replica's copy, and,
+	if they differ, a write and rename.  A scan is one stat per user (and a
+	listing of each directory) but no reads, so with scans only, the cost
+	does still grow with the tree, just much more slowly than rsync's.
+
+	inotify is used through ctypes (see Inotify).  Watches are added to a
+	directory before it is listed, so nothing made in between is missed.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, errno, time, struct, select, ctypes, ctypes.util
+from lilpsp import core
+import config2, openauth, checker
+
+
+#Something that imports this module may choose to change these values.
+
+#VANISH_MIN, VANISH_FRACTION -- when more than VANISH_MIN users, and more than VANISH_FRACTION of all of them, are gone from the source at once, their removal from the replica is held back...
+VANISH_MIN = 20
+VANISH_FRACTION = 0.5
+#VANISH_HOLD_SCANS -- ...for this many scans
+VANISH_HOLD_SCANS = 3
+
+
+#--- inotify
+
+IN_MODIFY      = 0x00000002
+IN_ATTRIB      = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM  = 0x00000040
+IN_MOVED_TO    = 0x00000080
+IN_CREATE      = 0x00000100
+IN_DELETE      = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF   = 0x00000800
+IN_Q_OVERFLOW  = 0x00004000
+IN_IGNORED     = 0x00008000
+IN_ONLYDIR     = 0x01000000
+IN_ISDIR       = 0x40000000
+
+IN_NONBLOCK = 00004000
+IN_CLOEXEC  = 02000000
+
+#what a Replicator watches for, on each directory
+WATCH_MASK = IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO | IN_CLOSE_WRITE | IN_ATTRIB | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR
+
+_event = struct.Struct('iIII')  #wd, mask, cookie, len (then len bytes of name)
+
+class Inotify(object):
+	"""an inotify instance (see inotify(7)); raises OSError if the system doesn't have inotify"""
+
+	def __init__(self):
+		try:
+			self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+			self._libc.inotify_init1
+		except (OSError, AttributeError):
+			raise OSError(errno.ENOSYS, "inotify is not available")
+		self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+		if self.fd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e))
+
+	def add(self, path, mask):
+		"""start watching path, and return the watch descriptor"""
+		wd = self._libc.inotify_add_watch(self.fd, path, mask)
+		if wd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, "%s: [%s]" % (os.strerror(e), path))
+		return wd
+
+	def read(self):
+		"""return a list of (wd, mask, name) for the events waiting (name is '' for events on the watched directory itself)"""
+		events = []
+		try:
+			data = os.read(self.fd, 64*1024)
+		except OSError, e:
+			if e.errno in (errno.EAGAIN, errno.EINTR): return events
+			raise
+		i = 0
+		while i + _event.size <= len(data):
+			wd, mask, cookie, length = _event.unpack_from(data, i)
+			i += _event.size
+			events.append((wd, mask, data[i:i+length].rstrip('\0')))
+			i += length
+		return events
+
+	def close(self):
+		os.close(self.fd)
+
+
+#--- replication
+
+class Replicator(object):
+	"""keeps the replica directory a copy of the source one (see the module docstring)
+
+	If use_inotify is True and inotify can't be used, this falls back to scans only (see the inotify attribute).
+	With allow_mass_removal, users gone from the source are removed from the replica even if the source looks broken.
+	"""
+
+	def __init__(self, source, replica, use_inotify=True, allow_mass_removal=False):
+		self.source = os.path.abspath(source)
+		self.replica = os.path.abspath(replica)
+		self.known = {}  #username -> (mtime, size, inode) of the source file last copied
+		self.dirty = set()  #usernames to look at
+		self.held = {}  #username -> scans since its removal was held back (see _removeGone())
+		self.allow_mass_removal = allow_mass_removal
+		self.watches = {}  #watch descriptor -> path of the directory, relative to source
+		self.counts = {'copied': 0, 'removed': 0, 'unchanged': 0, 'held': 0, 'events': 0, 'scans': 0, 'errors': 0}
+		self.inotify = None
+		if use_inotify:
+			try:
+				self.inotify = Inotify()
+			except OSError, e:
+				core.log("replica: not using inotify: %s" % e)
+		self.stopped = False
+
+	#--- the source tree
+
+	def _userAt(self, relpath):
+		"""return the user whose directory is relpath (relative to the source), or None if it's not a user directory"""
+		parts = relpath.split(os.sep)
+		if len(parts)==1 and parts[0]!='': return parts[0]
+		if len(parts)==3 and openauth._shardDirs(parts[2])==(parts[0], parts[1]): return parts[2]
+		return None
+
+	def _watch(self, relpath):
+		if self.inotify is None: return
+		try:
+			wd = self.inotify.add(os.path.join(self.source, relpath), WATCH_MASK)
+		except OSError, e:
+			if e.errno!=errno.ENOENT:  #(removed since it was listed)
+				core.log("replica: cannot watch [%s]: %s" % (relpath, e))
+			return
+		self.watches[wd] = relpath
+
+	def _walk(self, relpath, found, failed=None):
+		"""add watches to, and collect the secret files in, the source directory relpath and the ones below it
+
+		found is a dict to fill in of username -> (mtime, size, inode).
+		Directories that can't be listed (other than ones removed since they were listed) are appended to the list failed, as (relpath, exception), or logged if it's None.
+		"""
+		self._watch(relpath)
+		try:
+			entries = checker._entries(os.path.join(self.source, relpath))
+		except OSError, e:
+			if relpath and e.errno==errno.ENOENT: return  #(removed since it was listed)
+			if failed is None:
+				self.counts['errors'] += 1
+				core.log("replica: ERROR: cannot list [%s] in the source: %s" % (relpath, e), e=e)
+			else:
+				failed.append((relpath, e))
+			return
+		depth = relpath and len(relpath.split(os.sep)) or 0
+		for name, isdir in entries:
+			if isdir:
+				if depth < 3: self._walk(os.path.join(relpath, name), found, failed)
+			elif name==config2.SECRET_FILE_BASENAME:
+				username = self._userAt(relpath)
+				if username is None: continue
+				filename = os.path.join(self.source, relpath, name)
+				if username in found and filename!=openauth._getSecretFilename(username, root=self.source): continue  #(mid-migration, the one in config2.SECRETS_LAYOUT is the one used)
+				try:
+					st = os.stat(filename)
+				except OSError:  #(removed since it was listed)
+					continue
+				found[username] = (st.st_mtime, st.st_size, st.st_ino)
+
+	def scan(self, replica_too=False):
+		"""compare the source to what was last copied, and mark what differs dirty; with replica_too, also mark users in the replica not in the source
+
+		Users under a source directory that can't be listed are not marked (that's logged as an error instead); whether the others gone from the source are removed is up to apply().
+		"""
+		self.counts['scans'] += 1
+		found = {}
+		failed = []
+		self._walk('', found, failed)
+		for username, key in found.iteritems():
+			if self.known.get(username)!=key: self.dirty.add(username)
+		gone = set([ username for username in self.known if username not in found ])
+		if replica_too:
+			for dirpath, dirnames, filenames in os.walk(self.replica):
+				if config2.SECRET_FILE_BASENAME in filenames and dirpath!=self.replica:
+					username = self._userAt(os.path.relpath(dirpath, self.replica))
+					if username is not None and username not in found: gone.add(username)
+		for username in self.held.keys():
+			if username in gone: self.held[username] += 1
+			else               : del self.held[username]  #(it came back, or was removed)
+		if failed:
+			self.counts['errors'] += 1
+			core.log("replica: ERROR: cannot list %s in the source [%s]; not removing the users there from the replica" % (', '.join([ '[%s]: %s' % (relpath, e) for relpath, e in failed ]), self.source))
+			prefixes = [ os.path.join(self.source, relpath, '') for relpath, e in failed ]
+			for username in list(gone):
+				for layout in ('flat', 'hashed'):
+					filename = openauth._getSecretFilename(username, layout, self.source)
+					if [ prefix for prefix in prefixes if filename.startswith(prefix) ]: gone.discard(username)
+		self.dirty.update(gone)
+
+	def _handle(self, wd, mask, name):
+		self.counts['events'] += 1
+		if mask & IN_Q_OVERFLOW:
+			core.log("replica: inotify queue overflowed, scanning")
+			self.scan()
+			return
+		if mask & IN_IGNORED:
+			self.watches.pop(wd, None)
+			return
+		relpath = self.watches.get(wd)
+		if relpath is None or name=='': return
+		path = os.path.join(relpath, name)
+		if mask & IN_ISDIR:
+			if mask & (IN_CREATE | IN_MOVED_TO):
+				found = {}
+				self._walk(path, found)
+				self.dirty.update(found)
+			username = self._userAt(path)
+			if username is not None:
+				self.dirty.add(username)
+			elif mask & (IN_DELETE | IN_MOVED_FROM):  #(a whole shard moved or removed)
+				prefix = os.path.join(self.source, path) + os.sep
+				for username in self.known:
+					for layout in ('flat', 'hashed'):
+						if openauth._getSecretFilename(username, layout, self.source).startswith(prefix): self.dirty.add(username)
+		elif name==config2.SECRET_FILE_BASENAME:
+			username = self._userAt(relpath)
+			if username is not None: self.dirty.add(username)
+
+	#--- the replica
+
+	def _readSource(self, username):
+		"""return (contents, (mtime, size, inode)) of the user's source secret file, or None if there is none"""
+		for layout in (config2.SECRETS_LAYOUT, openauth._otherLayout()):
+			try:
+				f = open(openauth._getSecretFilename(username, layout, self.source))
+			except IOError, e:
+				if e.errno==errno.ENOENT: continue
+				raise
+			try:
+				st = os.fstat(f.fileno())
+				return f.read(), (st.st_mtime, st.st_size, st.st_ino)
+			finally:
+				f.close()
+		return None
+
+	def _removeReplica(self, username, layout):
+		"""remove the user's secret file and directory in the replica, in the given layout; return whether there was a file"""
+		filename = openauth._getSecretFilename(username, layout, self.replica)
+		try:
+			os.remove(filename)
+			removed = True
+		except OSError, e:
+			if e.errno!=errno.ENOENT: raise
+			removed = False
+		try:
+			os.rmdir(os.path.dirname(filename))
+		except OSError:
+			pass
+		return removed
+
+	def _remove(self, username):
+		"""remove the user from the replica"""
+		removed = False
+		for layout in ('flat', 'hashed'):
+			if self._removeReplica(username, layout): removed = True
+		self.known.pop(username, None)
+		self.held.pop(username, None)
+		if removed: self.counts['removed'] += 1
+
+	def _removeGone(self, gone):
+		"""remove the users in the list gone, which are gone from the source, from the replica, unless the source looks broken (see the module docstring)"""
+		if not self.allow_mass_removal:
+			total = len(set(self.known.keys() + gone))
+			try:
+				problem = None
+				if not os.listdir(self.source): problem = "it's empty"
+				elif len(gone)==total: problem = "every user is gone from it"
+			except OSError, e:
+				problem = "cannot list it: %s" % e
+			if problem is not None:
+				self.counts['errors'] += 1
+				core.log("replica: ERROR: not removing %d users from the replica, since the source [%s] looks broken: %s" % (len(gone), self.source, problem))
+				return
+			new = [ username for username in gone if not self.held.has_key(username) ]
+			if len(new) > VANISH_MIN and len(new) > VANISH_FRACTION*total:
+				self.counts['errors'] += 1
+				core.log("replica: ERROR: %d of %d users are gone from the source [%s] at once; holding back their removal from the replica for %d scans" % (len(new), total, self.source, VANISH_HOLD_SCANS))
+				for username in new:
+					self.held[username] = 0
+			gone = [ username for username in gone if self.held.get(username, VANISH_HOLD_SCANS) >= VANISH_HOLD_SCANS ]
+		for username in gone:
+			try:
+				self._remove(username)
+			except (IOError, OSError), e:
+				self.counts['errors'] += 1
+				core.log("replica: ERROR: failed to remove the secret of user [%s]: %s" % (username, e), e=e)
+		self.counts['held'] = len(self.held)
+
+	def sync(self, username):
+		"""make the replica's copy of the user's secret match the source; return False if the user is gone from the source (and leave the removal to the caller)"""
+		source = self._readSource(username)
+		if source is None: return False
+		contents, key = source
+		filename = openauth._getSecretFilename(username, root=self.replica)
+		try:
+			f = open(filename)
+			try:
+				same = f.read()==contents
+			finally:
+				f.close()
+		except IOError, e:
+			if e.errno!=errno.ENOENT: raise
+			same = False
+		if same:
+			self.counts['unchanged'] += 1
+		else:
+			if not os.path.isdir(os.path.dirname(filename)):
+				try:
+					os.makedirs(os.path.dirname(filename), checker.DIR_MODE)
+				except OSError, e:
+					if e.errno!=errno.EEXIST: raise
+			openauth._writeSecretFile(filename, contents)
+			self.counts['copied'] += 1
+		self._removeReplica(username, openauth._otherLayout())
+		self.known[username] = key
+		self.held.pop(username, None)
+		return True
+
+	def apply(self):
+		"""sync every dirty user, whether it was found by a scan or an event (then fsync the replica's directories, under config2.SECRET_FSYNC 'batch')"""
+		changed = bool(self.dirty)
+		gone = []
+		while self.dirty:
+			username = self.dirty.pop()
+			try:
+				if not self.sync(username): gone.append(username)
+			except (IOError, OSError), e:
+				self.counts['errors'] += 1
+				core.log("replica: ERROR: failed to sync the secret of user [%s]: %s" % (username, e), e=e)
+		if gone: self._removeGone(gone)
+		if changed and config2.SECRET_FSYNC=='batch':
+			try:
+				openauth.flushSecretWrites()
+			except (IOError, OSError), e:
+				core.log("replica: ERROR: failed to fsync the replica: %s" % e, e=e)
+
+	#--- main loop
+
+	def run(self, scan_seconds=300):
+		"""scan and copy everything that differs, then keep the replica up to date until stopped is set"""
+		self.scan(replica_too=True)
+		self.apply()
+		next_scan = time.time() + scan_seconds
+		while not self.stopped:
+			timeout = max(0, min(next_scan - time.time(), 1.0))
+			if self.inotify is not None:
+				try:
+					r, w, x = select.select([self.inotify.fd], [], [], timeout)
+				except select.error, e:
+					if e.args[0]!=errno.EINTR: raise
+					r = []
+				if r:
+					for wd, mask, name in self.inotify.read():
+						self._handle(wd, mask, name)
+			else:
+				time.sleep(timeout)
+			if time.time() >= next_scan:
+				self.scan()
+				next_scan = time.time() + scan_seconds
+			self.apply()
+
+	def close(self):
+		if self.inotify is not None: self.inotify.close()
@@ -0,0 +1,215 @@
+"""
+a packed, memory-mapped copy of all the secret files
+
+DESCRIPTION
+	A snapshot is one file holding the contents of every user's secret file,
+	sorted by username, with a fixed-size index and a hash table over it that
+	are both used in place.  Processes map it read-only, so however many apache children or
+	RADIUS workers read it, there is one copy of it in memory (the page
+	cache), and a process that just started doesn't need to read any secret
+	files to answer (it still opens each one, to check it's unchanged).
+
+	openauth.buildSecretSnapshot() makes one from the secrets tree (see
+	misc/secret_snapshot, to run from cron), and openauth._readSecretFile()
+	reads from config2.SECRET_SNAPSHOT_FILE, if it's set, before reading the
+	secret file itself.
+
+REQUIREMENTS
+	n/a
+
+IMPLEMENTATION NOTES
+	Each entry records the (mtime, size, inode) of the secret file it was
+	read from, and is only used when the file on disk still has them -- so
+	readers still open and fstat the file (an open, not just a stat, so that
+	on NFS the client revalidates its cached attributes; see
+	openauth._readSecretFile()), but a secret that was revoked or rewritten
+	since the snapshot was built is never served from it; the file itself
+	is read instead.  A stale snapshot only costs reads, never correctness.
+
+	A snapshot is written to a temporary file and renamed into place, so
+	readers see either the old one or the new one.  Readers stat the path
+	every CHECK_SECONDS, and map the new file when its inode has changed
+	(the generation in the header goes up by one each build).
+
+	Layout (all numbers big-endian):
+
+		header (HEADER_SIZE bytes): MAGIC, generation, build time, entry
+		  count, hash table size
+		index (ENTRY_SIZE bytes per entry, sorted by username): offset and
+		  length of the username, offset and length of the contents, and the
+		  file's mtime, size, and inode
+		hash table (4 bytes per slot, a power of two of them, at least twice
+		  the entry count): 1 + the index of the entry whose username's crc32
+		  leads to that slot (with linear probing), or 0 for an empty slot
+		data: the usernames and contents the index points to
+
+	The index alone could be binary searched, but that takes a couple dozen
+	struct unpacks per lookup, which in python costs more than the open and
+	read it saves (when the files are in the page cache); the hash table
+	takes one or two.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import os, time, struct, mmap, tempfile, zlib
+
+
+#Something that imports this module may choose to change these values.
+
+#CHECK_SECONDS -- how often readers look for a new snapshot
+CHECK_SECONDS = 5
+
+
+MAGIC = 'OASNAP1\n'
+
+_header = struct.Struct('!8sQdII')
+_entry = struct.Struct('!IHIIdQQ')
+_slot = struct.Struct('!I')
+HEADER_SIZE = _header.size
+ENTRY_SIZE = _entry.size
+
+
+def _hash(username):
+	return zlib.crc32(username) & 0xffffffff
+
+
+#--- writing
+
+def write(path, entries):
+	"""write a snapshot to path (atomically replacing any there) of entries, a list of (username, contents, (mtime, size, inode)); return its generation"""
+	generation = 1
+	try:
+		old = Snapshot(path)
+		try:
+			generation = old.generation + 1
+		finally:
+			old.close()
+	except (IOError, OSError, ValueError):
+		pass
+
+	entries = sorted(entries)
+	nslots = 1
+	while nslots < 2*len(entries): nslots *= 2
+	data_offset = HEADER_SIZE + ENTRY_SIZE*len(entries) + _slot.size*nslots
+	index = []
+	slots = [0] * nslots
+	data = []
+	for i, (username, contents, (mtime, size, ino)) in enumerate(entries):
+		index.append(_entry.pack(data_offset, len(username), data_offset+len(username), len(contents), mtime, size, ino))
+		slot = _hash(username) & (nslots-1)
+		while slots[slot]: slot = (slot+1) & (nslots-1)
+		slots[slot] = i+1
+		data.append(username)
+		data.append(contents)
+		data_offset += len(username) + len(contents)
+	header = _header.pack(MAGIC, generation, time.time(), len(entries), nslots)
+
+	fd, tmpname = tempfile.mkstemp(prefix='.%s.' % os.path.basename(path), dir=os.path.dirname(os.path.abspath(path)))
+	try:
+		f = os.fdopen(fd, 'w')
+		try:
+			f.write(header)
+			f.write(''.join(index))
+			f.write(''.join([ _slot.pack(x) for x in slots ]))
+			f.write(''.join(data))
+			f.flush()
+			os.fsync(f.fileno())
+			os.fchmod(f.fileno(), 0400)
+		finally:
+			f.close()
+		os.rename(tmpname, path)
+	except Exception:
+		try:
+			os.remove(tmpname)
+		except Exception:
+			pass
+		raise
+	return generation
+
+
+#--- reading
+
+class Snapshot(object):
+	"""one snapshot file, mapped read-only
+
+	Raises IOError or OSError if path can't be opened, and ValueError if it's not a snapshot.
+	"""
+
+	def __init__(self, path):
+		self.path = path
+		f = open(path)
+		try:
+			st = os.fstat(f.fileno())
+			self.ino = st.st_ino
+			if st.st_size < HEADER_SIZE: raise ValueError("[%s] is not a secret snapshot" % path)
+			self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		finally:
+			f.close()  #(the mapping stays valid)
+		magic, self.generation, self.built, self.count, self.nslots = _header.unpack_from(self.map, 0)
+		self.slots_offset = HEADER_SIZE + ENTRY_SIZE*self.count
+		if magic!=MAGIC or st.st_size < self.slots_offset + _slot.size*self.nslots or self.nslots & (self.nslots-1):
+			self.map.close()
+			raise ValueError("[%s] is not a secret snapshot" % path)
+
+	def _name(self, i):
+		name_offset, name_len = _entry.unpack_from(self.map, HEADER_SIZE + ENTRY_SIZE*i)[:2]
+		return self.map[name_offset:name_offset+name_len]
+
+	def get(self, username):
+		"""return (contents, (mtime, size, inode)) for the user, or None if the user is not in the snapshot"""
+		mask = self.nslots - 1
+		slot = _hash(username) & mask
+		while True:
+			i = _slot.unpack_from(self.map, self.slots_offset + _slot.size*slot)[0]
+			if i==0: return None
+			name_offset, name_len, offset, length, mtime, size, ino = _entry.unpack_from(self.map, HEADER_SIZE + ENTRY_SIZE*(i-1))
+			if self.map[name_offset:name_offset+name_len]==username: return self.map[offset:offset+length], (mtime, size, ino)
+			slot = (slot+1) & mask
+
+	def usernames(self):
+		"""return the list of users in the snapshot, sorted"""
+		return [ self._name(i) for i in xrange(self.count) ]
+
+	def close(self):
+		self.map.close()
+
+class Reader(object):
+	"""the current snapshot at path, picking up new ones as they are built (see the module docstring)"""
+
+	def __init__(self, path):
+		self.path = path
+		self.snapshot = None
+		self.checked = 0
+
+	def _check(self):
+		now = time.time()
+		if now - self.checked < CHECK_SECONDS: return
+		self.checked = now
+		try:
+			ino = os.stat(self.path).st_ino
+		except OSError:
+			ino = None
+		if self.snapshot is not None and self.snapshot.ino==ino: return
+		self.snapshot = None  #(the old one is unmapped once nothing is using it)
+		if ino is not None:
+			try:
+				self.snapshot = Snapshot(self.path)
+			except (IOError, OSError, ValueError):
+				pass
+
+	def get(self, username, key):
+		"""return the snapshot's contents for the user if it was made from the file with (mtime, size, inode) key, else None"""
+		self._check()
+		s = self.snapshot
+		if s is None: return None
+		found = s.get(username)
+		if found is None or found[1]!=key: return None
+		return found[0]
+
+	def generation(self):
+		"""return the generation of the snapshot in use, or None if there is none"""
+		self._check()
+		if self.snapshot is None: return None
+		return self.snapshot.generation
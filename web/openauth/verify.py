@@ -0,0 +1,201 @@
+"""
+checking TOTP codes against the secrets
+
+DESCRIPTION
+	verify(username, code) checks a 6-digit code from the user's device (or
+	one of their 8-digit emergency scratch codes) against their secret file,
+	the way pam_google_authenticator does on the RADIUS servers, but without
+	writing to the secret file for anything but a scratch code:
+
+	- The codes for the whole window (the file's WINDOW_SIZE option) are
+	  computed in one pass, with the HMAC key set up once, nearest time step
+	  first.
+	- With the DISALLOW_REUSE option, codes already used are remembered in a
+	  replay index in memory, instead of being recorded in the file (which
+	  is what makes pam_google_authenticator rewrite the file, through s~,
+	  on every login).
+	- A used scratch code is removed from the secret file, like
+	  pam_google_authenticator does, so it can't be used again after a
+	  restart or on another server.  That's rare, so the write (through
+	  openauth's atomic replace) costs little.  If the file can't be
+	  written, the code is refused rather than left usable.
+	- Each user's clock drift, in time steps, is learned from the codes that
+	  succeed, and the window is centered on it from then on, so a device
+	  whose clock is a few minutes off keeps working without a wider window.
+
+	The secret file itself is read through openauth's secret cache, so
+	verifying only opens and fstats it.
+
+REQUIREMENTS
+	n/a
+
+IMPLEMENTATION NOTES
+	The replay index and drift are kept in a Verifier, per process, so this
+	is meant for one long-running process doing all the verification for a
+	server (e.g. the RADIUS responder), not for forking web server children.
+	They do not survive a restart, which is harmless once the window has
+	passed (a couple of minutes).  Scratch codes don't depend on them, since
+	used ones are gone from the file.
+
+AUTHOR
+	John Brunelle <john_brunelle@harvard.edu>
+	Harvard FAS Research Computing
+"""
+
+import time, struct, hmac, hashlib, base64, threading
+from lilpsp import core
+import openauth
+
+
+#Something that imports this module may choose to change these values.
+
+#STEP_SECONDS -- the TOTP time step (what the file's STEP_SIZE option overrides)
+STEP_SECONDS = 30
+
+#DEFAULT_WINDOW_SIZE -- the number of time steps checked, when the file has no WINDOW_SIZE option (same default as pam_google_authenticator)
+DEFAULT_WINDOW_SIZE = 3
+
+#MAX_DRIFT_STEPS -- the furthest, in time steps, the learned drift of a user's clock may go in either direction
+MAX_DRIFT_STEPS = 10
+
+#PRUNE_EVERY -- every this many verifications, the replay index drops users with nothing recent in it
+PRUNE_EVERY = 10000
+
+
+#--- internal helpers
+
+def _decodeSecret(secret):
+	"""return the key bytes for a base32 secret (as written by google-authenticator, which leaves out padding)"""
+	secret = secret.upper().replace(' ', '')
+	return base64.b32decode(secret + '='*(-len(secret) % 8))
+
+def _codes(key, counters):
+	"""iterate over (counter, code) for each of counters, where code is the 6-digit code (an int) for that counter"""
+	mac = hmac.new(key, digestmod=hashlib.sha1)  #(the key is only set up once; each counter works on a copy)
+	for counter in counters:
+		m = mac.copy()
+		m.update(struct.pack('>Q', counter))
+		h = m.digest()
+		offset = ord(h[19]) & 0xf
+		yield counter, (struct.unpack('>I', h[offset:offset+4])[0] & 0x7fffffff) % 1000000
+
+def _counters(center, window_size):
+	"""return the counters in a window of window_size time steps around center, nearest first (same span as pam_google_authenticator: (window_size-1)/2 back, window_size/2 ahead)"""
+	counters = [center]
+	for d in range(1, window_size/2 + 1):
+		counters.append(center + d)
+		if d <= (window_size-1)/2: counters.append(center - d)
+	return counters
+
+
+#--- main methods
+
+class Verifier(object):
+	"""TOTP verification with a replay index and learned drift (see the module docstring)
+
+	This is safe to use from multiple threads.
+	"""
+
+	def __init__(self):
+		self.used = {}  #username -> {counter or scratch code: time until which it must be remembered}
+		self.drift = {}  #username -> learned offset of the user's clock, in time steps
+		self.lock = threading.Lock()
+		self.calls = 0
+		self.counts = {'ok': 0, 'ok_scratch': 0, 'bad': 0, 'replayed': 0, 'no_secret': 0}
+
+	def _count(self, what):
+		self.counts[what] += 1
+		return what in ('ok', 'ok_scratch')
+
+	def _prune(self, now):
+		"""forget replay entries that have expired (the caller must hold the lock)"""
+		for username in self.used.keys():
+			used = self.used[username]
+			for k in [ k for k, t in used.items() if t < now ]:
+				del used[k]
+			if not used: del self.used[username]
+
+	def verify(self, username, code, now=None):
+		"""return whether code is currently good for the user (and, if so, mark it used)
+
+		code is the string the user typed; surrounding whitespace is ignored.
+		A user with no secret file, or a corrupt one, just fails.
+		"""
+		if now is None: now = time.time()
+		code = code.strip()
+		try:
+			parsed = openauth._readSecretFile(username)
+		except (IOError, OSError):
+			return self._count('no_secret')
+		options = parsed['options']
+		disallow_reuse = 'DISALLOW_REUSE' in options
+		try:
+			step = int(options.get('STEP_SIZE', STEP_SECONDS))
+			window_size = int(options.get('WINDOW_SIZE', DEFAULT_WINDOW_SIZE))
+		except ValueError:
+			step, window_size = STEP_SECONDS, DEFAULT_WINDOW_SIZE
+
+		self.lock.acquire()
+		try:
+			self.calls += 1
+			if self.calls % PRUNE_EVERY == 0: self._prune(now)
+			drift = self.drift.get(username, 0)
+		finally:
+			self.lock.release()
+
+		#emergency scratch codes
+		if len(code)==8 and code.isdigit():
+			if code not in parsed['scratch_codes']: return self._count('bad')
+			self.lock.acquire()
+			try:
+				used = self.used.setdefault(username, {})  #(looked up now, since _prune() may have dropped the user's entries since)
+				if code in used: return self._count('replayed')
+				used[code] = now + 3600  #(only while it's being removed from the file; after that, the file no longer has it)
+			finally:
+				self.lock.release()
+			try:
+				if not openauth._removeScratchCode(username, code): return self._count('replayed')  #(used on another server)
+			except (IOError, OSError), e:
+				core.log("ERROR: cannot remove a used scratch code from the secret file of user [%s], so refusing it: %s" % (username, e), e=e)
+				self.lock.acquire()
+				try:
+					self.used.setdefault(username, {}).pop(code, None)
+				finally:
+					self.lock.release()
+				return self._count('bad')
+			return self._count('ok_scratch')
+
+		if len(code)!=6 or not code.isdigit(): return self._count('bad')
+		try:
+			key = _decodeSecret(parsed['secret'])
+		except TypeError:  #(not base32, i.e. the secret file is corrupt)
+			return self._count('bad')
+		value = int(code)
+		current = int(now // step)
+		for counter, c in _codes(key, _counters(current + drift, window_size)):
+			if c!=value: continue
+			self.lock.acquire()
+			try:
+				if disallow_reuse:
+					used = self.used.setdefault(username, {})  #(looked up now, since _prune() may have dropped the user's entries since)
+					if counter in used: return self._count('replayed')
+					used[counter] = now + (window_size + 2*MAX_DRIFT_STEPS)*step  #(long enough that the window can't come back around to it)
+				self.drift[username] = max(-MAX_DRIFT_STEPS, min(MAX_DRIFT_STEPS, counter - current))
+			finally:
+				self.lock.release()
+			return self._count('ok')
+		return self._count('bad')
+
+_verifier = Verifier()
+
+def verify(username, code, now=None):
+	"""return whether code is currently good for the user, using this process's Verifier (see Verifier.verify())"""
+	return _verifier.verify(username, code, now)
+
+def getCode(username, now=None):
+	"""return the current 6-digit code (a string) for the user, ignoring drift (for testing)"""
+	if now is None: now = time.time()
+	parsed = openauth._readSecretFile(username)
+	step = int(parsed['options'].get('STEP_SIZE', STEP_SECONDS))
+	for counter, c in _codes(_decodeSecret(parsed['secret']), [int(now // step)]):
+		return '%06d' % c